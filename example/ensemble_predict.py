@@ -0,0 +1,83 @@
+import os
+import argparse
+import json
+import copy
+import time
+import sys
+sys.path.append('..')
+from pykt.config import que_type_models
+from pykt.models import load_model
+from pykt.models.ensemble_utils import evaluate_ensemble
+from pykt.datasets import init_test_datasets
+
+
+def load_member(ckpt_dir, data_config, args):
+    """the model of one checkpoint dir, in eval mode, with its config"""
+    with open(os.path.join(ckpt_dir, "config.json")) as fin:
+        config = json.load(fin)
+    model_config = copy.deepcopy(config["model_config"])
+    for remove_item in ['use_wandb','learning_rate','add_uuid','l2','global_bs','num_gpus','pretrain_path', 'num_epochs', 'batch_size']:
+        if remove_item in model_config:
+            del model_config[remove_item]
+    model_name, emb_type = config["params"]["model_name"], config["params"]["emb_type"]
+    if model_name == "lorekt":
+        data_config["num_q"] = config["data_config"]["num_q"]
+        data_config["num_c"] = config["data_config"]["num_c"]
+    model, _ = load_model(model_name, model_config, data_config, emb_type, ckpt_dir, args=args, mode="test")
+    model.eval()
+    return model, config
+
+
+def main(params):
+    ckpt_dirs = params["ckpt_dirs"].split(",")
+    dataset_name, batch_size = params["dataset_name"], params["bz"]
+    with open("../configs/data_config.json") as fin:
+        data_config = copy.deepcopy(json.load(fin))[dataset_name]
+    data_config["dataset_name"] = dataset_name
+
+    args = argparse.Namespace(**params)
+    models, configs = [], []
+    for ckpt_dir in ckpt_dirs:
+        print(f"loading model from {ckpt_dir} ...")
+        model, config = load_member(ckpt_dir, data_config, args)
+        models.append(model)
+        configs.append(config)
+    model_name, fold = configs[0]["params"]["model_name"], configs[0]["params"]["fold"]
+    assert model_name == "lorekt" or model_name in que_type_models, "the ensemble evaluation supports lorekt and que_type_models!"
+    assert params["strategy"] == "loop" or model_name == "lorekt", "the vmap strategy is only implemented for lorekt!"
+
+    test_loader, test_window_loader, _, _ = init_test_datasets(data_config, model_name, batch_size, fold, True, params['pretrain_suffix'])
+    if model_name == "lorekt":
+        test_loader = test_window_loader
+
+    report = evaluate_ensemble(models, ckpt_dirs, test_loader, params["strategy"])
+    print(f"single pass of {len(models)} members: {report['seconds']:.2f}s")
+    if params["compare_sequential"] == 1:
+        # the cost of evaluating the checkpoints one at a time, a pass over the test data each
+        start = time.time()
+        for ckpt_dir, model in zip(ckpt_dirs, models):
+            evaluate_ensemble([model], [ckpt_dir], test_loader)
+        report["sequential_seconds"] = time.time() - start
+        print(f"{len(models)} sequential passes: {report['sequential_seconds']:.2f}s")
+
+    save_path = params["save_path"] if params["save_path"] != "None" else os.path.join(os.path.dirname(ckpt_dirs[0].rstrip("/")), f"{dataset_name}_ensemble_result.json")
+    json.dump({"dataset_name": dataset_name, "ckpt_dirs": ckpt_dirs, "strategy": params["strategy"], **report}, open(save_path, "w+"), indent=4)
+    print(f"saved the report to {save_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_dirs", type=str, default="saved_model", help='comma separated checkpoint dirs of the members, e.g. the folds or the seeds')
+    parser.add_argument("--dataset_name", type=str, default="assist2009", help='test dataset name')
+    parser.add_argument("--pretrain_suffix", type=str, default="pretrain")
+    parser.add_argument("--strategy", type=str, default="loop", help='loop, or vmap to stack the weights of the lorekt members')
+    parser.add_argument("--compare_sequential", type=int, default=0, help='also time one pass per checkpoint')
+    parser.add_argument("--save_path", type=str, default="None", help='the json report, None saves it next to the first checkpoint dir')
+    parser.add_argument("--bz", type=int, default=256)
+    parser.add_argument("--local_rank", type=int, default=0)
+
+    args = parser.parse_args()
+    print(args)
+    params = vars(args)
+
+    main(params)
@@ -0,0 +1,81 @@
+import os
+import argparse
+import json
+import copy
+import torch
+import sys
+sys.path.append('..')
+from pykt.models import load_model
+from pykt.models.export_utils import export_lorekt, load_exported, validate_export, benchmark, dcur_to_inputs
+from pykt.datasets import init_test_datasets
+
+
+def main(params):
+    ckpt_dir, batch_size = params["ckpt_dir"], params["bz"]
+    with open(os.path.join(ckpt_dir, "config.json")) as fin:
+        config = json.load(fin)
+    model_config = copy.deepcopy(config["model_config"])
+    for remove_item in ['use_wandb','learning_rate','add_uuid','l2','global_bs','num_gpus','pretrain_path', 'num_epochs', 'batch_size']:
+        if remove_item in model_config:
+            del model_config[remove_item]
+    trained_params = config["params"]
+    model_name, emb_type, fold = trained_params["model_name"], trained_params["emb_type"], trained_params["fold"]
+    assert model_name == "lorekt", "the export is only implemented for lorekt!"
+
+    dataset_name = params["dataset_name"]
+    with open("../configs/data_config.json") as fin:
+        data_config = copy.deepcopy(json.load(fin))[dataset_name]
+    data_config["dataset_name"] = dataset_name
+    data_config["num_q"] = config["data_config"]["num_q"]
+    data_config["num_c"] = config["data_config"]["num_c"]
+    test_loader, _, _, _ = init_test_datasets(data_config, model_name, batch_size, fold, True, params['pretrain_suffix'])
+
+    model, _ = load_model(model_name, model_config, data_config, emb_type, ckpt_dir, args=argparse.Namespace(**params), mode="test")
+    model.eval()
+    soft_mask = torch.load(params["soft_mask_path"], map_location="cpu") if params["soft_mask_path"] != "None" else None
+
+    batches = []
+    for dcur in test_loader:
+        batches.append(dcur)
+        if len(batches) == params["num_batches"]:
+            break
+    export_path = os.path.join(ckpt_dir, f"{emb_type}_model.{'pt' if params['export_format'] == 'torchscript' else 'onnx'}")
+    # the export and the benchmark run on cpu, the eager baseline is the same computation without tracing
+    eager_cpu = export_lorekt(copy.deepcopy(model).cpu(), export_path, dcur_to_inputs(batches[0]), params["export_format"], soft_mask)
+    exported = load_exported(export_path, params["export_format"])
+
+    lengths = [int(l) for l in params["lengths"].split(",")] if params["lengths"] != "None" else []
+    max_diff = validate_export(model, exported, batches, lengths, atol=params["atol"], soft_mask=soft_mask)
+
+    torch.set_num_threads(params["num_threads"])
+    inputs = dcur_to_inputs(batches[0])
+    eager = benchmark(eager_cpu, inputs, params["repeats"])
+    exported_time = benchmark(exported, inputs, params["repeats"])
+    print(f"eager: {eager}, {params['export_format']}: {exported_time}, speedup: {eager['mean_seconds'] / exported_time['mean_seconds']:.2f}x")
+
+    dres = {"export_path": export_path, "export_format": params["export_format"], "max_diff": max_diff,
+            "batch_size": inputs[0].size(0), "seqlen": inputs[0].size(1), "num_threads": params["num_threads"],
+            "eager": eager, "exported": exported_time}
+    json.dump(dres, open(os.path.join(ckpt_dir, f'{dataset_name}_export_result.json'), 'w+'), indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_dir", type=str, default="saved_model", help='dir of config.json and the checkpoint')
+    parser.add_argument("--dataset_name", type=str, default="assist2009", help='test dataset of the validation and the benchmark')
+    parser.add_argument("--pretrain_suffix", type=str, default="pretrain")
+    parser.add_argument("--export_format", type=str, default="torchscript", help='torchscript, or onnx (needs onnx and onnxruntime)')
+    parser.add_argument("--soft_mask_path", type=str, default="None", help='the soft masks of a finetuned model, exported with it')
+    parser.add_argument("--bz", type=int, default=64)
+    parser.add_argument("--num_batches", type=int, default=10, help='number of test batches of the validation')
+    parser.add_argument("--lengths", type=str, default="2,17,100", help='the batches are also cut to these lengths to check the dynamic axis')
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--num_threads", type=int, default=4)
+    parser.add_argument("--local_rank", type=int, default=0)
+
+    args = parser.parse_args()
+    print(args)
+    params = vars(args)
+
+    main(params)
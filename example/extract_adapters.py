@@ -0,0 +1,84 @@
+import os
+import argparse
+import json
+import torch
+import sys
+sys.path.append('..')
+from pykt.models import load_soft_mask
+from pykt.models.adapter_utils import extract_delta, delta_numel, apply_delta
+
+
+def load_state(ckpt_dir):
+    """the state dict and the config of a checkpoint dir"""
+    with open(os.path.join(ckpt_dir, "config.json")) as fin:
+        config = json.load(fin)
+    emb_type, model_config = config["params"]["emb_type"], config["model_config"]
+    adapter_path = os.path.join(ckpt_dir, emb_type+"_adapter.ckpt")
+    if os.path.exists(adapter_path):
+        # adapter finetuning, the trained parameters on top of the backbone, the adapters folded into their linears
+        state, _ = load_state(model_config["lora_backbone_path"])
+        state.update(torch.load(adapter_path, map_location="cpu"))
+        return merge_lora(state, model_config["lora_alpha"] / model_config["lora_rank"]), config
+    state = torch.load(os.path.join(ckpt_dir, emb_type+"_model.module.ckpt"), map_location="cpu")
+    state = {k[len("module."):] if k.startswith("module.") else k: v for k, v in state.items()}
+    return state, config
+
+
+def merge_lora(state, scaling):
+    """the state dict with the low-rank adapters (see LoRALinear) folded into the weights of their linears"""
+    for name in [k for k in state if k.endswith(".lora_A")]:
+        prefix = name[:-len("lora_A")]
+        lora_a, lora_b = state.pop(name), state.pop(prefix+"lora_B")
+        weight = state[prefix+"weight"]
+        state[prefix+"weight"] = weight + (scaling * lora_b.float() @ lora_a.float()).to(weight.dtype)
+    return state
+
+
+def main(params):
+    backbone_state, _ = load_state(params["backbone_dir"])
+    delta_dir = params["delta_dir"] if params["delta_dir"] != "None" else os.path.join(params["backbone_dir"], "deltas")
+    os.makedirs(delta_dir, exist_ok=True)
+
+    results = []
+    for finetuned_dir in params["finetuned_dirs"].split(","):
+        finetuned_state, config = load_state(finetuned_dir)
+        dataset_name = config["params"].get("finetune_dataset_name", "None")
+        assert dataset_name != "None", f"{finetuned_dir} is not a finetuned checkpoint!"
+        delta = {"dataset_name": dataset_name, "params": extract_delta(backbone_state, finetuned_state, params["rank"], params["atol"])}
+        if params["with_soft_mask"] == 1:
+            # the soft mask of the dataset used in the forward of finetuning, next to the checkpoint dir
+            soft_mask_path = os.path.join(os.path.dirname(finetuned_dir.rstrip("/")), f"{dataset_name}_softmasks")
+            soft_mask_args = argparse.Namespace(apply_softmask=config["params"].get("apply_softmask", "None"))
+            delta["soft_mask"] = load_soft_mask(soft_mask_path=soft_mask_path, device="cpu", args=soft_mask_args)
+
+        # the max error of the finetuned weights rebuilt from the backbone and the delta
+        max_error = 0.
+        for name, entry in delta["params"].items():
+            param = backbone_state[name].clone()
+            apply_delta(param, backbone_state[name], entry)
+            max_error = max(max_error, (param.float() - finetuned_state[name].float()).abs().max().item())
+        path = os.path.join(delta_dir, f"{dataset_name}_delta.pt")
+        torch.save(delta, path)
+        full_numel = sum(v.numel() for v in finetuned_state.values())
+        res = {"dataset_name": dataset_name, "finetuned_dir": finetuned_dir, "changed_params": len(delta["params"]),
+               "numel": delta_numel(delta["params"]), "numel_ratio": delta_numel(delta["params"]) / full_numel,
+               "max_error": max_error, "types": {name: entry["type"] for name, entry in delta["params"].items()}}
+        print(f"{dataset_name}: {res['changed_params']} changed parameters, {res['numel']} values ({res['numel_ratio']:.2%} of the checkpoint), max error: {max_error:.2e}, saved to {path}")
+        results.append(res)
+    json.dump(results, open(os.path.join(delta_dir, "deltas.json"), "w+"), indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone_dir", type=str, default="saved_model", help='checkpoint dir of the pretrained backbone')
+    parser.add_argument("--finetuned_dirs", type=str, default="None", help='comma separated checkpoint dirs finetuned from the backbone')
+    parser.add_argument("--delta_dir", type=str, default="None", help='dir of the deltas, None is backbone_dir/deltas')
+    parser.add_argument("--rank", type=int, default=0, help='rank of the low-rank weight differences, 0 keeps them exact')
+    parser.add_argument("--atol", type=float, default=0., help='differences up to atol are treated as unchanged')
+    parser.add_argument("--with_soft_mask", type=int, default=0, help='store the soft mask of each dataset with its delta')
+
+    args = parser.parse_args()
+    print(args)
+    params = vars(args)
+
+    main(params)
@@ -0,0 +1,141 @@
+import os
+import argparse
+import json
+import copy
+import math
+import time
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+from sklearn import metrics
+import sys
+sys.path.append('..')
+from pykt.models import load_model, load_soft_mask, init_optimizer
+from pykt.models.train_model import incremental_update
+from pykt.models.distill_utils import predict_probs
+from pykt.datasets.que_data_loader import KTQueDataset, datasets_dic
+from pykt.datasets.incremental_utils import read_delta, filter_vocab, append_interactions, save_sequences
+
+
+def window_auc(model, dataset, batch_size):
+    """auc of the model on the selected (new) interactions of the update windows, None without both responses"""
+    y_trues, y_scores = [], []
+    if len(dataset) == 0:
+        return None
+    model.eval()
+    with torch.no_grad():
+        for data in DataLoader(dataset, batch_size=batch_size, shuffle=False):
+            y = predict_probs(model, data)
+            sm = data["smasks"].to(y.device)
+            y_scores.append(torch.masked_select(y, sm).cpu())
+            y_trues.append(torch.masked_select(data["shft_rseqs"].to(y.device), sm).cpu())
+    ts, ps = torch.cat(y_trues).numpy(), torch.cat(y_scores).numpy()
+    if len(np.unique(ts)) < 2:
+        return None
+    return metrics.roc_auc_score(y_true=ts, y_score=ps)
+
+
+def main(params):
+    ckpt_dir = params["ckpt_dir"]
+    with open(os.path.join(ckpt_dir, "config.json")) as fin:
+        config = json.load(fin)
+    model_config = copy.deepcopy(config["model_config"])
+    for remove_item in ['use_wandb','learning_rate','add_uuid','l2','global_bs','num_gpus','pretrain_path', 'num_epochs', 'batch_size']:
+        if remove_item in model_config:
+            del model_config[remove_item]
+    trained_params = config["params"]
+    model_name, emb_type, fold = trained_params["model_name"], trained_params["emb_type"], trained_params["fold"]
+    assert model_name == "lorekt", "the incremental update is only implemented for lorekt!"
+    # the students of the finetuning dataset, or all of them for a pretrained model
+    dataset_name = trained_params.get("finetune_dataset_name", "None")
+    dataset_name = dataset_name if dataset_name != "None" else None
+
+    with open("../configs/data_config.json") as fin:
+        all_config = json.load(fin)
+    train_config = all_config[trained_params["dataset_name"]]
+    data_config = copy.deepcopy(train_config)
+    data_config["dataset_name"] = trained_params["dataset_name"]
+    data_config["num_q"] = config["data_config"]["num_q"]
+    data_config["num_c"] = config["data_config"]["num_c"]
+    seq_len = trained_params.get("seq_len", 200)
+    seq_path = params["seq_path"] if params["seq_path"] != "None" else os.path.join(train_config["dpath"], f"train_valid_sequences_quelevel_{seq_len}.csv")
+    all_folds = set(train_config["folds"])
+
+    args = argparse.Namespace(**params)
+    model, _ = load_model(model_name, model_config, data_config, emb_type, ckpt_dir, args=args, mode="test")
+    soft_mask = None
+    if params["soft_mask_path"] != "None":
+        soft_mask_args = argparse.Namespace(apply_softmask=trained_params.get("apply_softmask", "input_projection,output_projection,attention"))
+        soft_mask = load_soft_mask(soft_mask_path=params["soft_mask_path"], device=next(model.parameters()).device, args=soft_mask_args)
+
+    delta = filter_vocab(read_delta(params["delta_path"]), data_config["num_q"], data_config["num_c"])
+    if dataset_name is not None:
+        delta = delta[delta["dataset"] == datasets_dic[dataset_name]]
+    print(f"{len(delta)} new interactions of {delta.groupby(['dataset', 'uid']).ngroups} students")
+
+    start = time.time()
+    # the replay rows are the training data before the update, read from the processed cache of the sequences
+    replay_dataset = None
+    if params["replay_ratio"] > 0:
+        replay_dataset = KTQueDataset(seq_path, input_type=train_config["input_type"], folds=all_folds - {fold}, concept_num=train_config['num_c'],
+                                      max_concepts=train_config['max_concepts'], dataset_name=dataset_name)
+    seq_df = pd.read_csv(seq_path)
+    context_len = params["context_len"] if params["context_len"] >= 0 else None
+    updated, windows = append_interactions(seq_df, delta, seq_len, sorted(all_folds), context_len, train_config.get("min_seq_len", 3))
+
+    save_dir = params["save_dir"] if params["save_dir"] != "None" else f"{ckpt_dir.rstrip('/')}-update_{os.path.splitext(os.path.basename(params['delta_path']))[0]}"
+    os.makedirs(save_dir, exist_ok=True)
+    window_path = os.path.join(save_dir, f"update_windows_quelevel_{seq_len}.csv")
+    windows.to_csv(window_path, index=None)
+    def window_dataset(folds):
+        if not windows["fold"].isin(folds).any():
+            return []
+        return KTQueDataset(window_path, input_type=train_config["input_type"], folds=folds, concept_num=train_config['num_c'],
+                            max_concepts=train_config['max_concepts'])
+    # the windows of the valid fold students are held out, they measure the update
+    train_windows, valid_windows = window_dataset(all_folds - {fold}), window_dataset({fold})
+    before_auc = window_auc(model, valid_windows, params["bz"])
+
+    num_steps = min(params["max_steps"], math.ceil(params["update_epochs"] * len(train_windows) / params["bz"]))
+    opt = init_optimizer(model, "adam", params["learning_rate"])
+    print(f"{num_steps} update steps on {len(train_windows)} windows, replay ratio: {params['replay_ratio']} ...")
+    losses = incremental_update(model, train_windows, replay_dataset, opt, num_steps, params["bz"], params["replay_ratio"], soft_mask)
+    after_auc = window_auc(model, valid_windows, params["bz"])
+    seconds = time.time() - start
+    print(f"held out new interactions auc: {before_auc} -> {after_auc}, {seconds:.2f}s")
+
+    torch.save(model.state_dict(), os.path.join(save_dir, emb_type+"_model.module.ckpt"))
+    update_config = copy.deepcopy(config)
+    update_config["params"]["update_delta_path"] = params["delta_path"]
+    with open(os.path.join(save_dir, "config.json"), "w") as fout:
+        json.dump(update_config, fout, indent=4)
+    # the stored sequences get the new interactions once the model is saved
+    save_sequences(updated, seq_path)
+    dres = {"ckpt_dir": ckpt_dir, "delta_path": params["delta_path"], "seq_path": seq_path, "new_interactions": len(delta),
+            "train_windows": len(train_windows), "valid_windows": len(valid_windows), "num_steps": num_steps,
+            "loss": float(np.mean(losses)) if losses else None, "valid_auc_before": before_auc, "valid_auc_after": after_auc, "seconds": seconds}
+    json.dump(dres, open(os.path.join(save_dir, "update_result.json"), "w+"), indent=4)
+    print(f"saved the updated model to {save_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_dir", type=str, default="saved_model", help='dir of config.json and the checkpoint to update')
+    parser.add_argument("--delta_path", type=str, default="None", help='csv of the new interactions: dataset, uid, question, concept, response[, timestamp]')
+    parser.add_argument("--seq_path", type=str, default="None", help='the stored sequences, None is train_valid_sequences_quelevel_{seq_len}.csv of the training data')
+    parser.add_argument("--save_dir", type=str, default="None", help='dir of the updated checkpoint, None is {ckpt_dir}-update_{delta name}')
+    parser.add_argument("--soft_mask_path", type=str, default="None", help='soft masks of the forward, e.g. the {dataset}_softmasks of finetuning')
+    parser.add_argument("--context_len", type=int, default=-1, help='previous interactions before the new ones in an update window, -1 is seq_len // 2')
+    parser.add_argument("--max_steps", type=int, default=200, help='upper bound of the update steps')
+    parser.add_argument("--update_epochs", type=float, default=1.0, help='passes over the update windows, bounded by max_steps')
+    parser.add_argument("--replay_ratio", type=float, default=0.5, help='rows of old training data per update window in a batch, 0 disables replay')
+    parser.add_argument("--learning_rate", type=float, default=1e-5)
+    parser.add_argument("--bz", type=int, default=64)
+    parser.add_argument("--local_rank", type=int, default=0)
+
+    args = parser.parse_args()
+    print(args)
+    params = vars(args)
+
+    main(params)
@@ -0,0 +1,116 @@
+import os
+import argparse
+import json
+import copy
+import time
+import torch
+from sklearn import metrics
+import sys
+sys.path.append('..')
+from pykt.models import load_model, load_prune_impt, prune_lorekt
+from pykt.datasets import init_test_datasets
+
+device = "cpu" if not torch.cuda.is_available() else "cuda"
+
+
+def evaluate_auc(model, test_loader):
+    """auc, acc and the forward seconds of LoReKT on the test loader"""
+    model.eval()
+    y_trues, y_scores = [], []
+    seconds = 0.
+    with torch.no_grad():
+        for dcur in test_loader:
+            if device == "cuda":
+                torch.cuda.synchronize()
+            start = time.time()
+            y = model(dcur)[:, 1:]
+            if device == "cuda":
+                torch.cuda.synchronize()
+            seconds += time.time() - start
+            sm = dcur["smasks"].to(device)
+            y_scores.append(torch.masked_select(y, sm).cpu())
+            y_trues.append(torch.masked_select(dcur["shft_rseqs"].to(device), sm).cpu())
+    ts, ps = torch.cat(y_trues).numpy(), torch.cat(y_scores).numpy()
+    auc = metrics.roc_auc_score(y_true=ts, y_score=ps)
+    acc = metrics.accuracy_score(ts, [1 if p >= 0.5 else 0 for p in ps])
+    return auc, acc, seconds
+
+
+def main(params):
+    ckpt_dir, batch_size = params["ckpt_dir"], params["bz"]
+    with open(os.path.join(ckpt_dir, "config.json")) as fin:
+        config = json.load(fin)
+    model_config = copy.deepcopy(config["model_config"])
+    for remove_item in ['use_wandb','learning_rate','add_uuid','l2','global_bs','num_gpus','pretrain_path', 'num_epochs', 'batch_size']:
+        if remove_item in model_config:
+            del model_config[remove_item]
+    trained_params = config["params"]
+    model_name, emb_type, fold = trained_params["model_name"], trained_params["emb_type"], trained_params["fold"]
+    assert model_name == "lorekt", "structured pruning is only implemented for lorekt!"
+
+    dataset_name = params["dataset_name"]
+    with open("../configs/data_config.json") as fin:
+        data_config = copy.deepcopy(json.load(fin))[dataset_name]
+    data_config["dataset_name"] = dataset_name
+    data_config["num_q"] = config["data_config"]["num_q"]
+    data_config["num_c"] = config["data_config"]["num_c"]
+    _, test_window_loader, _, _ = init_test_datasets(data_config, model_name, batch_size, fold, True, params['pretrain_suffix'])
+
+    if params["impt_dirs"] != "None":
+        impt_dirs = params["impt_dirs"].split(",")
+    else:
+        # the importances computed on every pretrain dataset, saved next to the checkpoint dir
+        save_dir = os.path.dirname(ckpt_dir.rstrip("/"))
+        impt_dirs = [os.path.join(save_dir, d) for d in os.listdir(save_dir) if '_softmasks' in d]
+    head_impt, intermediate_impt = load_prune_impt(impt_dirs)
+
+    model, _ = load_model(model_name, model_config, data_config, emb_type, ckpt_dir, args=argparse.Namespace(**params), mode="test")
+    model.to(device)
+    base_auc, base_acc, base_seconds = evaluate_auc(model, test_window_loader)
+    base_params = sum(p.numel() for p in model.model.parameters())
+    print(f"unpruned: auc: {base_auc:.4f}, acc: {base_acc:.4f}, seconds: {base_seconds:.2f}, block params: {base_params}")
+
+    results = []
+    for ratio in [float(r) for r in params["ratios"].split(",")]:
+        head_ratio = ratio if "heads" in params["prune_parts"] else 0.
+        ffn_ratio = ratio if "ffn" in params["prune_parts"] else 0.
+        pruned = copy.deepcopy(model)
+        pruned_layers = prune_lorekt(pruned, head_impt, intermediate_impt, head_ratio, ffn_ratio)
+        auc, acc, seconds = evaluate_auc(pruned, test_window_loader)
+        num_params = sum(p.numel() for p in pruned.model.parameters())
+        res = {"ratio": ratio, "auc": auc, "acc": acc, "auc_drop": base_auc - auc, "speedup": base_seconds / max(seconds, 1e-12),
+               "block_params": num_params, "block_params_ratio": num_params / base_params}
+        print(f"ratio: {ratio}, auc: {auc:.4f} (drop {res['auc_drop']:.4f}), acc: {acc:.4f}, speedup: {res['speedup']:.2f}x, block params: {num_params} ({res['block_params_ratio']:.2%})")
+        results.append(res)
+
+        if params["save_pruned"] == 1:
+            pruned_dir = f"{ckpt_dir.rstrip('/')}-pruned_{params['prune_parts'].replace(',', '_')}_{ratio}"
+            os.makedirs(pruned_dir, exist_ok=True)
+            pruned_config = copy.deepcopy(config)
+            pruned_config["model_config"]["pruned_layers"] = pruned_layers
+            with open(os.path.join(pruned_dir, "config.json"), "w") as fout:
+                json.dump(pruned_config, fout, indent=4)
+            torch.save(pruned.state_dict(), os.path.join(pruned_dir, emb_type+"_model.module.ckpt"))
+            print(f"saved the pruned model to {pruned_dir}")
+
+    dres = {"dataset_name": dataset_name, "auc": base_auc, "acc": base_acc, "seconds": base_seconds, "block_params": base_params, "pruned": results}
+    json.dump(dres, open(os.path.join(ckpt_dir, f'{dataset_name}_prune_result.json'), 'w+'), indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_dir", type=str, default="saved_model", help='dir of config.json and the checkpoint of the pretrained model')
+    parser.add_argument("--impt_dirs", type=str, default="None", help='comma separated softmasks dirs, None uses every *_softmasks dir next to ckpt_dir')
+    parser.add_argument("--dataset_name", type=str, default="assist2009", help='test dataset name')
+    parser.add_argument("--pretrain_suffix", type=str, default="pretrain")
+    parser.add_argument("--bz", type=int, default=256)
+    parser.add_argument("--ratios", type=str, default="0.1,0.2,0.3,0.5", help='ratios of the heads / neurons removed in each block')
+    parser.add_argument("--prune_parts", type=str, default="heads,ffn")
+    parser.add_argument("--save_pruned", type=int, default=1)
+    parser.add_argument("--local_rank", type=int, default=0)
+
+    args = parser.parse_args()
+    print(args)
+    params = vars(args)
+
+    main(params)
@@ -0,0 +1,138 @@
+import os
+# int8 inference runs on cpu only
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+import argparse
+import json
+import copy
+import time
+import torch
+from torch import nn
+from torch.utils.data import DataLoader
+import sys
+sys.path.append('..')
+from pykt.config import que_type_models
+from pykt.models import load_model, evaluate
+from pykt.models.quant_utils import quantizable_linears, quantize_dynamic_linears, prepare_static_linears, convert_static_linears
+from pykt.datasets import init_test_datasets
+from pykt.datasets.data_loader import KTDataset
+from pykt.datasets.que_data_loader import KTQueDataset
+
+
+def calibration_loader(all_config, train_dataset_name, dataset_name, model_name, fold, batch_size, seq_len):
+    """the validation fold of the training data, whose activations set the scales of static quantization"""
+    train_config = all_config[train_dataset_name]
+    if model_name == "lorekt":
+        dpath = os.path.join(train_config["dpath"], f"train_valid_sequences_quelevel_{seq_len}.csv")
+        dataset = KTQueDataset(dpath, input_type=train_config["input_type"], folds={fold},
+                               concept_num=train_config['num_c'], max_concepts=train_config['max_concepts'], dataset_name=dataset_name)
+    elif model_name in que_type_models:
+        dataset = KTQueDataset(os.path.join(train_config["dpath"], train_config["train_valid_file_quelevel"]), input_type=train_config["input_type"],
+                               folds={fold}, concept_num=train_config['num_c'], max_concepts=train_config['max_concepts'])
+    else:
+        dataset = KTDataset(os.path.join(train_config["dpath"], train_config["train_valid_file"]), train_config["input_type"], {fold})
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+
+def timed_evaluate(model, test_loader, eval_name):
+    """auc, acc and the seconds of evaluate"""
+    start = time.time()
+    auc, acc = evaluate(nn.DataParallel(model), test_loader, eval_name)
+    return auc, acc, time.time() - start
+
+
+def main(params):
+    torch.set_num_threads(params["num_threads"])
+    ckpt_dir, batch_size = params["ckpt_dir"], params["bz"]
+    with open(os.path.join(ckpt_dir, "config.json")) as fin:
+        config = json.load(fin)
+    model_config = copy.deepcopy(config["model_config"])
+    for remove_item in ['use_wandb','learning_rate','add_uuid','l2','global_bs','num_gpus','pretrain_path', 'num_epochs', 'batch_size']:
+        if remove_item in model_config:
+            del model_config[remove_item]
+    assert "quantization" not in model_config, "the model is already quantized!"
+    trained_params = config["params"]
+    model_name, emb_type, fold = trained_params["model_name"], trained_params["emb_type"], trained_params["fold"]
+    # the lorekt branches of evaluate are named gpt4kt
+    eval_name = "gpt4kt" if model_name == "lorekt" else model_name
+
+    dataset_name = params["dataset_name"]
+    with open("../configs/data_config.json") as fin:
+        all_config = json.load(fin)
+    data_config = copy.deepcopy(all_config[dataset_name])
+    data_config["dataset_name"] = dataset_name
+    if model_name == "lorekt":
+        data_config["num_q"] = config["data_config"]["num_q"]
+        data_config["num_c"] = config["data_config"]["num_c"]
+    test_loader, test_window_loader, _, _ = init_test_datasets(data_config, model_name, batch_size, fold, True, params['pretrain_suffix'])
+    if model_name == "lorekt":
+        test_loader = test_window_loader
+
+    args = argparse.Namespace(**params)
+    model, _ = load_model(model_name, model_config, data_config, emb_type, ckpt_dir, args=args, mode="test")
+    model = model.cpu().eval()
+    base_auc, base_acc, base_seconds = timed_evaluate(model, test_loader, eval_name)
+    print(f"float: auc: {base_auc:.4f}, acc: {base_acc:.4f}, seconds: {base_seconds:.2f}")
+
+    patterns = params["modules"].split(",") if params["modules"] != "None" else None
+    skip_patterns = params["skip_modules"].split(",") if params["skip_modules"] != "None" else None
+    quantized = copy.deepcopy(model)
+    modules = quantizable_linears(quantized, patterns, skip_patterns)
+    print(f"quantizing {len(modules)} linears ({params['mode']}): {modules}")
+    if params["mode"] == "dynamic":
+        quantize_dynamic_linears(quantized, modules)
+    else:
+        prepare_static_linears(quantized, modules, params["backend"])
+        calib_loader = calibration_loader(all_config, trained_params["dataset_name"], dataset_name if model_name == "lorekt" else None,
+                                          model_name, fold, batch_size, trained_params.get("seq_len", 200))
+        calib_batches = []
+        for data in calib_loader:
+            calib_batches.append(data)
+            if len(calib_batches) == params["num_calib_batches"]:
+                break
+        evaluate(nn.DataParallel(quantized), calib_batches, eval_name)
+        convert_static_linears(quantized)
+    auc, acc, seconds = timed_evaluate(quantized, test_loader, eval_name)
+    print(f"int8: auc: {auc:.4f} (delta {auc - base_auc:+.4f}), acc: {acc:.4f} (delta {acc - base_acc:+.4f}), seconds: {seconds:.2f}, speedup: {base_seconds / max(seconds, 1e-12):.2f}x")
+
+    quant_dir = f"{ckpt_dir.rstrip('/')}-int8_{params['mode']}"
+    os.makedirs(quant_dir, exist_ok=True)
+    quant_config = copy.deepcopy(config)
+    quant_config["model_config"]["quantization"] = {"mode": params["mode"], "modules": modules, "backend": params["backend"]}
+    with open(os.path.join(quant_dir, "config.json"), "w") as fout:
+        json.dump(quant_config, fout, indent=4)
+    torch.save(quantized.state_dict(), os.path.join(quant_dir, emb_type+"_model.module.ckpt"))
+    print(f"saved the quantized model to {quant_dir}")
+
+    # the saved checkpoint is loaded back through load_model
+    reloaded, _ = load_model(model_name, quant_config["model_config"], data_config, emb_type, quant_dir, args=args, mode="test")
+    reload_auc, _, _ = timed_evaluate(reloaded, test_loader, eval_name)
+    assert abs(reload_auc - auc) < 1e-6, "the reloaded quantized model differs!"
+
+    dres = {"dataset_name": dataset_name, "mode": params["mode"], "num_threads": params["num_threads"], "modules": modules,
+            "float": {"auc": base_auc, "acc": base_acc, "seconds": base_seconds},
+            "int8": {"auc": auc, "acc": acc, "seconds": seconds},
+            "auc_delta": auc - base_auc, "acc_delta": acc - base_acc, "speedup": base_seconds / max(seconds, 1e-12),
+            "checkpoint_mb": {"float": os.path.getsize(os.path.join(ckpt_dir, emb_type+"_model.module.ckpt")) / 2**20,
+                              "int8": os.path.getsize(os.path.join(quant_dir, emb_type+"_model.module.ckpt")) / 2**20}}
+    json.dump(dres, open(os.path.join(quant_dir, f'{dataset_name}_quant_result.json'), 'w+'), indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_dir", type=str, default="saved_model", help='dir of config.json and the checkpoint of the float model')
+    parser.add_argument("--dataset_name", type=str, default="assist2009", help='test dataset name')
+    parser.add_argument("--pretrain_suffix", type=str, default="pretrain")
+    parser.add_argument("--mode", type=str, default="dynamic", help='dynamic, or static with a calibration pass over the validation fold')
+    parser.add_argument("--modules", type=str, default="None", help='comma separated fnmatch patterns of the linears to quantize, None is every nn.Linear')
+    parser.add_argument("--skip_modules", type=str, default="None", help='comma separated fnmatch patterns of the linears kept in float, e.g. out.6')
+    parser.add_argument("--backend", type=str, default="fbgemm", help='fbgemm for x86, qnnpack for arm')
+    parser.add_argument("--num_calib_batches", type=int, default=32)
+    parser.add_argument("--bz", type=int, default=256)
+    parser.add_argument("--num_threads", type=int, default=4)
+    parser.add_argument("--local_rank", type=int, default=0)
+
+    args = parser.parse_args()
+    print(args)
+    params = vars(args)
+
+    main(params)
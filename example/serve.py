@@ -0,0 +1,111 @@
+import os
+import argparse
+import asyncio
+import json
+import copy
+import time
+import numpy as np
+import sys
+sys.path.append('..')
+from pykt.models import load_model
+from pykt.models.serving import MicroBatcher, serve
+from pykt.models.adapter_utils import AdapterLOREKT
+
+
+def load_serving_model(ckpt_dir, args):
+    """the model of a checkpoint dir (config.json and the state dict), in eval mode"""
+    with open(os.path.join(ckpt_dir, "config.json")) as fin:
+        config = json.load(fin)
+    model_config = copy.deepcopy(config["model_config"])
+    for remove_item in ['use_wandb','learning_rate','add_uuid','l2','global_bs','num_gpus','pretrain_path', 'num_epochs', 'batch_size']:
+        if remove_item in model_config:
+            del model_config[remove_item]
+    model_name, emb_type = config["params"]["model_name"], config["params"]["emb_type"]
+    data_config = config["data_config"]
+    model, _ = load_model(model_name, model_config, data_config, emb_type, ckpt_dir, args=args, mode="test")
+    model.eval()
+    seq_len = model_config.get("seq_len", config["train_config"].get("seq_len", 200))
+    return model, data_config, seq_len
+
+
+async def load_test(params, data_config):
+    """a local load generator: num_clients connections send num_requests random histories in total"""
+    rng = np.random.RandomState(params["seed"])
+    num_q, num_c = max(data_config["num_q"], 1), data_config["num_c"]
+    latencies = []
+
+    async def client(cid, num_requests):
+        reader, writer = await asyncio.open_connection(params["host"], params["port"])
+        for k in range(num_requests):
+            n = rng.randint(1, params["history_len"] + 1)
+            req = {"id": f"{cid}-{k}", "questions": rng.randint(0, num_q, n).tolist(),
+                   "concepts": [[int(_)] for _ in rng.randint(0, num_c, n)], "responses": rng.randint(0, 2, n).tolist(),
+                   "next_question": int(rng.randint(0, num_q)), "next_concepts": [int(rng.randint(0, num_c))]}
+            if params["dataset_name"] != "None":
+                req["dataset"] = params["dataset_name"]
+            start = time.time()
+            writer.write((json.dumps(req) + "\n").encode())
+            await writer.drain()
+            res = json.loads(await reader.readline())
+            latencies.append(time.time() - start)
+            assert "prob" in res, res
+        writer.close()
+
+    start = time.time()
+    per_client = params["num_requests"] // params["num_clients"]
+    await asyncio.gather(*[client(cid, per_client) for cid in range(params["num_clients"])])
+    elapsed = time.time() - start
+    latencies = np.array(latencies) * 1000
+    print(f"client: {len(latencies)} requests in {elapsed:.2f}s, {len(latencies) / elapsed:.1f} requests/s, "
+          f"latency ms p50: {np.percentile(latencies, 50):.2f}, p95: {np.percentile(latencies, 95):.2f}, p99: {np.percentile(latencies, 99):.2f}")
+
+    reader, writer = await asyncio.open_connection(params["host"], params["port"])
+    writer.write((json.dumps({"op": "metrics"}) + "\n").encode())
+    await writer.drain()
+    print(f"server: {json.loads(await reader.readline())}")
+    writer.close()
+
+
+def main(params):
+    args = argparse.Namespace(**params)
+    if params["mode"] == "server":
+        model, data_config, seq_len = load_serving_model(params["ckpt_dir"], args)
+        if params["delta_dir"] != "None":
+            # one pretrained backbone for every finetuned dataset, see extract_adapters.py
+            model = AdapterLOREKT(model, params["delta_dir"], params["max_resident_deltas"])
+            print(f"serving the deltas of {model.available()}")
+        default_dataset = params["dataset_name"] if params["dataset_name"] != "None" else None
+        batcher = MicroBatcher(model, data_config["max_concepts"], seq_len, max_batch_size=params["max_batch_size"],
+                               max_wait_ms=params["max_wait_ms"], default_dataset=default_dataset,
+                               num_q=max(data_config["num_q"], 1), num_c=data_config["num_c"])
+        asyncio.get_event_loop().run_until_complete(serve(batcher, params["host"], params["port"]))
+    else:
+        with open(os.path.join(params["ckpt_dir"], "config.json")) as fin:
+            data_config = json.load(fin)["data_config"]
+        asyncio.get_event_loop().run_until_complete(load_test(params, data_config))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, default="server", help='server, or load to run the load generator against a server')
+    parser.add_argument("--ckpt_dir", type=str, default="saved_model", help='dir of config.json and the checkpoint')
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--max_wait_ms", type=float, default=5.)
+    parser.add_argument("--dataset_name", type=str, default="None", help='dataset of the requests without one')
+    parser.add_argument("--delta_dir", type=str, default="None", help='per-dataset deltas of the finetuned models, ckpt_dir is then the pretrained backbone')
+    parser.add_argument("--max_resident_deltas", type=int, default=8)
+    parser.add_argument("--local_rank", type=int, default=0)
+
+    # load generator
+    parser.add_argument("--num_clients", type=int, default=32)
+    parser.add_argument("--num_requests", type=int, default=2000)
+    parser.add_argument("--history_len", type=int, default=100, help='max number of past interactions of a request')
+    parser.add_argument("--seed", type=int, default=42)
+
+    args = parser.parse_args()
+    print(args)
+    params = vars(args)
+
+    main(params)
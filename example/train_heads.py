@@ -0,0 +1,106 @@
+import os
+import argparse
+import json
+import copy
+import time
+import torch
+from torch.utils.data import DataLoader
+import sys
+sys.path.append('..')
+from pykt.models import load_model, load_soft_mask
+from pykt.models.feature_cache import extract_features, FeatureCache, train_heads
+from pykt.datasets.que_data_loader import KTQueDataset
+
+
+def fold_loader(train_config, dataset_name, folds, batch_size, seq_len):
+    """batches of the given folds of the lorekt training data, in file order"""
+    dpath = os.path.join(train_config["dpath"], f"train_valid_sequences_quelevel_{seq_len}.csv")
+    dataset = KTQueDataset(dpath, input_type=train_config["input_type"], folds=folds, concept_num=train_config['num_c'],
+                           max_concepts=train_config['max_concepts'], dataset_name=dataset_name)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+
+def main(params):
+    ckpt_dir = params["ckpt_dir"]
+    with open(os.path.join(ckpt_dir, "config.json")) as fin:
+        config = json.load(fin)
+    model_config = copy.deepcopy(config["model_config"])
+    for remove_item in ['use_wandb','learning_rate','add_uuid','l2','global_bs','num_gpus','pretrain_path', 'num_epochs', 'batch_size']:
+        if remove_item in model_config:
+            del model_config[remove_item]
+    trained_params = config["params"]
+    model_name, emb_type, fold = trained_params["model_name"], trained_params["emb_type"], trained_params["fold"]
+    assert model_name == "lorekt", "the feature cache is only implemented for lorekt!"
+    dataset_name = params["dataset_name"] if params["dataset_name"] != "None" else None
+
+    with open("../configs/data_config.json") as fin:
+        all_config = json.load(fin)
+    train_config = all_config[trained_params["dataset_name"]]
+    data_config = copy.deepcopy(train_config)
+    data_config["dataset_name"] = trained_params["dataset_name"]
+    data_config["num_q"] = config["data_config"]["num_q"]
+    data_config["num_c"] = config["data_config"]["num_c"]
+
+    args = argparse.Namespace(**params)
+    model, _ = load_model(model_name, model_config, data_config, emb_type, ckpt_dir, args=args, mode="test")
+    soft_mask = None
+    if params["soft_mask_path"] != "None":
+        soft_mask_args = argparse.Namespace(apply_softmask=trained_params.get("apply_softmask", "input_projection,output_projection,attention"))
+        soft_mask = load_soft_mask(soft_mask_path=params["soft_mask_path"], device=next(model.parameters()).device, args=soft_mask_args)
+
+    # the backbone runs once, the caches are reused by the next runs on the same checkpoint
+    cache_dir = params["cache_dir"] if params["cache_dir"] != "None" else os.path.join(ckpt_dir, f"feature_cache_{params['dataset_name']}")
+    all_folds = set(all_config[trained_params["dataset_name"]]["folds"])
+    seq_len = trained_params.get("seq_len", 200)
+    caches = dict()
+    for split, folds in [("train", all_folds - {fold}), ("valid", {fold})]:
+        split_dir = os.path.join(cache_dir, split)
+        if not os.path.exists(os.path.join(split_dir, "meta.json")):
+            start = time.time()
+            extract_features(model, fold_loader(train_config, dataset_name, folds, params["bz"], seq_len), split_dir, soft_mask, params["dtype"])
+            print(f"extracted the {split} features in {time.time() - start:.2f}s")
+        caches[split] = FeatureCache(split_dir)
+
+    # only the heads are trained, the backbone and the embeddings stay frozen
+    heads = [name for name in ["out", "qclasifier"] if hasattr(model, name)]
+    for name, p in model.named_parameters():
+        p.requires_grad = name.split(".")[0] in heads
+    opt = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], params["learning_rate"])
+    print(f"training {heads} on {len(caches['train'])} cached positions ...")
+
+    save_dir = params["save_dir"] if params["save_dir"] != "None" else f"{ckpt_dir.rstrip('/')}-heads_{params['dataset_name']}"
+    os.makedirs(save_dir, exist_ok=True)
+    start = time.time()
+    validauc, validacc, best_epoch = train_heads(model, caches["train"], caches["valid"], params["num_epochs"], opt, params["head_bz"], save_dir)
+    seconds = time.time() - start
+    print(f"validauc: {validauc:.4f}, validacc: {validacc:.4f}, best epoch: {best_epoch}, {seconds:.2f}s")
+
+    head_config = copy.deepcopy(config)
+    head_config["params"]["head_only_dataset_name"] = params["dataset_name"]
+    with open(os.path.join(save_dir, "config.json"), "w") as fout:
+        json.dump(head_config, fout, indent=4)
+    dres = {"ckpt_dir": ckpt_dir, "dataset_name": params["dataset_name"], "heads": heads, "validauc": validauc, "validacc": validacc,
+            "best_epoch": best_epoch, "train_positions": len(caches["train"]), "seconds": seconds}
+    json.dump(dres, open(os.path.join(save_dir, "heads_result.json"), "w+"), indent=4)
+    print(f"saved the model to {save_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_dir", type=str, default="saved_model", help='dir of config.json and the checkpoint of the frozen backbone')
+    parser.add_argument("--dataset_name", type=str, default="None", help='the dataset of the heads, None keeps all the datasets of the training data')
+    parser.add_argument("--soft_mask_path", type=str, default="None", help='soft masks of the forward, e.g. the {dataset}_softmasks of finetuning')
+    parser.add_argument("--cache_dir", type=str, default="None", help='dir of the feature cache, None is ckpt_dir/feature_cache_{dataset_name}')
+    parser.add_argument("--dtype", type=str, default="float32", help='float32, or float16 for half the cache size')
+    parser.add_argument("--save_dir", type=str, default="None", help='dir of the new checkpoint, None is {ckpt_dir}-heads_{dataset_name}')
+    parser.add_argument("--num_epochs", type=int, default=20)
+    parser.add_argument("--learning_rate", type=float, default=1e-4)
+    parser.add_argument("--bz", type=int, default=256, help='batch size of the sequences when extracting the features')
+    parser.add_argument("--head_bz", type=int, default=4096, help='batch size of the cached positions when training the heads')
+    parser.add_argument("--local_rank", type=int, default=0)
+
+    args = parser.parse_args()
+    print(args)
+    params = vars(args)
+
+    main(params)
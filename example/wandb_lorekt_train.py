@@ -31,12 +31,16 @@ if __name__ == "__main__":
     parser.add_argument("--learning_rate", type=float, default=1e-4)
     parser.add_argument("--optimizer", type=str, default=None)
     parser.add_argument("--save_opt", type=int, default=0, help='.')
+    parser.add_argument("--sparse_emb", type=int, default=0, help='sparse gradients and row-wise (lazy) adam for question/concept embeddings')
 
     # multi-task
     parser.add_argument("--cf_weight", type=float, default=0.1)
     parser.add_argument("--t_weight", type=float, default=0.1)
 
     parser.add_argument("--seq_len", type=int, default=200)
+    parser.add_argument("--pack_sequences", type=int, default=0, help='pack several students into one seq_len row with a block-diagonal causal mask')
+    parser.add_argument("--stream_segments", type=int, default=0, help='feed whole student histories segment by segment, one student per batch lane')
+    parser.add_argument("--mem_len", type=int, default=0, help='number of previous positions kept as attention memory across segments, needs stream_segments')
 
     parser.add_argument("--use_wandb", type=int, default=1)
     parser.add_argument("--add_uuid", type=int, default=1)
@@ -67,6 +71,16 @@ if __name__ == "__main__":
     # finetune
     parser.add_argument("--pretrain_ckpt_path", type=str, default='None', help='.')
     parser.add_argument("--finetune_dataset_name", type=str, default='None', help='.')
+    parser.add_argument("--lora_rank", type=int, default=0, help='rank of the low-rank adapters of finetuning, the pretrained blocks are frozen, 0 finetunes all the parameters')
+    parser.add_argument("--lora_alpha", type=float, default=16, help='the adapter outputs are scaled by lora_alpha / lora_rank')
+    parser.add_argument("--lora_dropout", type=float, default=0., help='dropout on the adapter inputs')
+    parser.add_argument("--lora_targets", type=str, default='k_linear,v_linear,out_proj,linear1,linear2', help='comma separated linears of each block getting an adapter')
+
+    # distillation
+    parser.add_argument("--teacher_ckpt_path", type=str, default='None', help='checkpoint dir (with config.json) of the teacher, None disables distillation')
+    parser.add_argument("--distill_alpha", type=float, default=0.5, help='weight of the teacher soft targets, 1 - alpha for the responses')
+    parser.add_argument("--distill_temperature", type=float, default=1.0, help='temperature of the soft targets')
+    parser.add_argument("--distill_cache", type=int, default=0, help='cache the teacher predictions of the train set in a first pass')
     
 
     
@@ -6,7 +6,7 @@ import torch
 import numpy as np
 import sys
 sys.path.append('..')
-from pykt.models import evaluate,evaluate_question,load_model, evaluate_testset
+from pykt.models import evaluate,evaluate_question,load_model, evaluate_testset, evaluate_stream
 from pykt.datasets import init_test_datasets
 
 device = "cpu" if not torch.cuda.is_available() else "cuda"
@@ -74,7 +74,9 @@ def main(params):
             data_config["num_q"] = config["data_config"]["num_q"]
             data_config["num_c"] = config["data_config"]["num_c"] 
     
-    test_loader, test_window_loader, test_question_loader, test_question_window_loader = init_test_datasets(data_config, model_name, batch_size,fold,win200,params['pretrain_suffix'])
+    stream_segments = params["stream_segments"] if model_name in ["lorekt"] else 0
+    test_loader, test_window_loader, test_question_loader, test_question_window_loader = init_test_datasets(data_config, model_name, batch_size,fold,win200,params['pretrain_suffix'],
+                                                                                                         stream_segments=stream_segments, seq_len=trained_params.get("seq_len", 200))
 
     print(f"Start predicting model: {model_name}, embtype: {emb_type}, save_dir: {save_dir}, dataset_name: {dataset_name}")
     print(f"model_config: {model_config}")
@@ -106,7 +108,11 @@ def main(params):
     if model_name in ["lorekt"]:
         save_test_window_path = ""
 
-        window_testauc, window_testacc = evaluate_testset(model, test_window_loader, model_name, save_test_window_path, dataset_name, fold, soft_mask_path=None)
+        if stream_segments:
+            # whole histories segment by segment, the memory of mem_len positions replaces the overlapping windows
+            window_testauc, window_testacc = evaluate_stream(model, test_window_loader)
+        else:
+            window_testauc, window_testacc = evaluate_testset(model, test_window_loader, model_name, save_test_window_path, dataset_name, fold, soft_mask_path=None)
         print(f"window_testauc: {window_testauc}, window_testacc: {window_testacc}")
 
     question_testauc, question_testacc = -1, -1
@@ -154,6 +160,7 @@ if __name__ == "__main__":
     parser.add_argument("--pretrain_suffix", type=str, default="pretrain")
     parser.add_argument("--win200", type=bool, default=True)
     parser.add_argument("--load_finetune", type=str, default="0")
+    parser.add_argument("--stream_segments", type=int, default=0, help='lorekt: evaluate the whole test histories segment by segment with the memory of mem_len, instead of the windows')
 
     parser.add_argument("--local_rank", type=int, default=0) 
 
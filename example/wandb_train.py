@@ -5,18 +5,20 @@ from pickletools import optimize
 from tqdm import tqdm
 import torch
 torch.set_num_threads(4) 
-from torch.optim import SGD, Adam
 import copy
 import sys
 sys.path.append('..')
 
-from pykt.models import train_model,evaluate,init_model,load_model
+from pykt.models import train_model,evaluate,init_model,load_model,init_optimizer
 from pykt.utils import debug_print,set_seed
 from pykt.datasets import init_dataset4train
 import datetime
 import subprocess
 from pykt.models import compute_soft_mask
 from pykt.models import load_soft_mask, get_pretrain_overall_mask
+from pykt.models import TeacherPredDataset, cache_teacher_preds, compare_models
+from pykt.models.distill_utils import PROB_MODELS
+from torch.utils.data import DataLoader
 
 
 os.environ['CUDA_LAUNCH_BLOCKING'] = "1"
@@ -53,9 +55,32 @@ def get_pretrain_info(args):
     with open(os.path.join(ckpt_dir, "config.json")) as fin:
         ckpt_config = json.load(fin)
         model_config = ckpt_config['model_config']
+    if getattr(args, "lora_rank", 0) > 0 and args.finetune_dataset_name != "None":
+        # adapter finetuning, the pretrained config gets the adapters and the checkpoint they are trained on
+        model_config.update({"lora_rank": args.lora_rank, "lora_alpha": args.lora_alpha, "lora_dropout": args.lora_dropout,
+                             "lora_targets": args.lora_targets, "lora_backbone_path": ckpt_dir})
     return ckpt_dir, model_config
 
 
+def load_teacher(teacher_ckpt_path, data_config, args):
+    """load the (frozen) teacher of distillation from a checkpoint dir with config.json"""
+    with open(os.path.join(teacher_ckpt_path, "config.json")) as fin:
+        teacher_config = json.load(fin)
+    teacher_model_config = copy.deepcopy(teacher_config["model_config"])
+    for remove_item in ['use_wandb','learning_rate','add_uuid','l2','global_bs','num_gpus','pretrain_path', 'num_epochs', 'batch_size']:
+        if remove_item in teacher_model_config:
+            del teacher_model_config[remove_item]
+    teacher_model_name, teacher_emb_type = teacher_config["params"]["model_name"], teacher_config["params"]["emb_type"]
+    assert teacher_model_name in PROB_MODELS, f"the distillation teacher must be one of {PROB_MODELS}!"
+    print(f'loading teacher {teacher_model_name} from {teacher_ckpt_path} ...')
+    teacher, _ = load_model(teacher_model_name, teacher_model_config, data_config, teacher_emb_type, teacher_ckpt_path, args=args, mode="test")
+    teacher = teacher.to(device)
+    teacher.eval()
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+    return teacher
+
+
 def save_all_config(save_dir, params_str, args, params, train_config, model_config, data_config):
     if not args.compute_soft_mask:
 
@@ -148,6 +173,9 @@ def main(params, args=None):
         model_config = copy.deepcopy(params)
         for key in ["model_name", "dataset_name", "emb_type", "save_dir", "fold", "seed"]:
             del model_config[key]
+        # the adapters only exist in finetuning, added to the pretrained config by get_pretrain_info
+        for key in ["lora_rank", "lora_alpha", "lora_dropout", "lora_targets"]:
+            model_config.pop(key, None)
         if 'batch_size' in params:
             train_config["batch_size"] = params['batch_size']
         if 'num_epochs' in params:
@@ -229,7 +257,11 @@ def main(params, args=None):
         if args.compute_soft_mask or args.finetune_dataset_name != "None":
 
             pretrain_ckpt_dir, pretrain_model_config = get_pretrain_info(args)
-            model, opt = load_model(model_name=model_name, model_config=pretrain_model_config, data_config=data_config[dataset_name], emb_type=emb_type, ckpt_path=pretrain_ckpt_dir, args=args, mode="train", finetune=True, optimizer=optimizer)
+            # the optimizer state of the pretraining does not match the parameters trained by adapter finetuning
+            pretrain_optimizer = optimizer if pretrain_model_config.get("lora_rank", 0) == 0 else None
+            model, opt = load_model(model_name=model_name, model_config=pretrain_model_config, data_config=data_config[dataset_name], emb_type=emb_type, ckpt_path=pretrain_ckpt_dir, args=args, mode="train", finetune=True, optimizer=pretrain_optimizer)
+            trained = sum(p.numel() for p in model.parameters() if p.requires_grad)
+            print(f"trainable parameters: {trained}")
         else:
             model = init_model(model_name, model_config, data_config[dataset_name], emb_type, args)
         print(f"model_parameter:{sum(dict((p.data_ptr(), p.numel()) for p in model.parameters()).values())}")
@@ -249,12 +281,26 @@ def main(params, args=None):
         elif model_name == "iekt":
             opt = torch.optim.Adam(model.parameters(), lr=learning_rate, weight_decay=1e-6)
         else:
-            if optimizer == "sgd":
-                opt = SGD(model.parameters(), learning_rate, momentum=0.9)
-            elif optimizer == "adam":
-                opt = Adam(model.parameters(), learning_rate)
+            opt = init_optimizer(model, optimizer, learning_rate)
     # import pdb; pdb.set_trace()
     print(f"using {optimizer} optmizer ..")
+
+    # knowledge distillation, the model is the student of a pretrained teacher
+    teacher = None
+    if params.get("teacher_ckpt_path", "None") != "None":
+        # distill_forward reads the batches of KTQueDataset, without the time gaps and the contrastive views
+        assert model_name in PROB_MODELS, f"the distillation student must be one of {PROB_MODELS}!"
+        assert emb_type.find("pt") == -1 and emb_type.find("time") == -1 and emb_type.find("cl") == -1, f"distillation does not support the emb_type {emb_type}!"
+        teacher = load_teacher(params["teacher_ckpt_path"], data_config[dataset_name], args)
+        if params.get("distill_cache", 0) == 1:
+            if isinstance(curtrain, torch.utils.data.Dataset):
+                teacher_preds = cache_teacher_preds(teacher, curtrain, batch_size, os.path.join(ckpt_path, "teacher_preds.pt"))
+                curtrain = TeacherPredDataset(curtrain, teacher_preds)
+                # same sampler (the cached dataset has the rows of curtrain) and loader settings as before
+                train_loader = DataLoader(curtrain, batch_size=train_loader.batch_size, sampler=train_loader.sampler, drop_last=train_loader.drop_last,
+                                          collate_fn=train_loader.collate_fn, num_workers=train_loader.num_workers, pin_memory=train_loader.pin_memory)
+            else:
+                print('the teacher predictions can only be cached for map-style datasets, running the teacher on the fly ...')
    
     testauc, testacc = -1, -1
     window_testauc, window_testacc = -1, -1
@@ -295,12 +341,21 @@ def main(params, args=None):
 
             
 
-            testauc, testacc, window_testauc, window_testacc, validauc, validacc, best_epoch = train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, None, None, save_model, dataset_name, fold, gradient_accumulation_steps=gradient_accumulation_steps, softmask_for_forward=softmask_for_forward, model_config=pretrain_model_config, args=args)
+            testauc, testacc, window_testauc, window_testacc, validauc, validacc, best_epoch = train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, None, None, save_model, dataset_name, fold, gradient_accumulation_steps=gradient_accumulation_steps, softmask_for_forward=softmask_for_forward, model_config=pretrain_model_config, args=args, teacher=teacher)
         
         else:
-            testauc, testacc, window_testauc, window_testacc, validauc, validacc, best_epoch = train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, None, None, save_model, dataset_name, fold, gradient_accumulation_steps=gradient_accumulation_steps, args=args)
+            testauc, testacc, window_testauc, window_testacc, validauc, validacc, best_epoch = train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, None, None, save_model, dataset_name, fold, gradient_accumulation_steps=gradient_accumulation_steps, args=args, teacher=teacher)
+
+        if teacher is not None and args.local_rank <= 0:
+            # teacher vs the best student on the validation data
+            if getattr(model.module, "lora_rank", 0) > 0:
+                model.module.load_state_dict(torch.load(os.path.join(ckpt_path, emb_type+"_adapter.ckpt"), map_location="cpu"), strict=False)
+            else:
+                model.module.load_state_dict(torch.load(os.path.join(ckpt_path, emb_type+"_model.module.ckpt"), map_location="cpu"))
+            distill_report = compare_models({"teacher": teacher, "student": model.module}, valid_loader)
+            json.dump(distill_report, open(os.path.join(ckpt_path, "distill_report.json"), "w"), indent=4)
     else:
-        testauc, testacc, window_testauc, window_testacc, validauc, validacc, best_epoch = train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, None, None, save_model, dataset_name, fold)
+        testauc, testacc, window_testauc, window_testacc, validauc, validacc, best_epoch = train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, None, None, save_model, dataset_name, fold, args=args, teacher=teacher)
     
    
 
@@ -1,6 +1,10 @@
 from .simplekt_cl_utils import Crop, Mask, Reorder, Random
 import torch
 import math
+import copy
+import random
+from torch.utils.data import get_worker_info
+from torch.utils.data.dataloader import default_collate
 
 class RecWithContrastiveLearningDataset(object):
     def __init__(self, args):
@@ -49,6 +53,27 @@ class RecWithContrastiveLearningDataset(object):
         return augmented_cids_seqs, augmented_qids_seqs, augmented_res_seqs
 
 
+    def batch_processed(self, cseqs, qseqs, rseqs, seqlens, num_c, num_q, generator=None):
+        """
+        batch version of processed: augments padded [batch_size, max_len] tensors in one go,
+        returns n_pairs lists of two [batch_size, max_len] views for cids, qids and responses
+        """
+        if not hasattr(self, "batch_transform"):
+            self.batch_transform = BatchAugmentation(self.args.augment_type, tao=self.args.tao, gamma=self.args.gamma, beta=self.args.beta)
+        augmented_cids_list, augmented_qids_list, augmented_res_list = [], [], []
+        total_augmentaion_pairs = self.nCr(self.n_views, 2)
+        for i in range(total_augmentaion_pairs):
+            augmented_cids_seqs, augmented_qids_seqs, augmented_res_seqs = [], [], []
+            for j in range(2):
+                cids, qids, res = self.batch_transform(cseqs, qseqs, rseqs, seqlens, num_c, num_q, generator=generator)
+                augmented_cids_seqs.append(cids)
+                augmented_qids_seqs.append(qids)
+                augmented_res_seqs.append(res)
+            augmented_cids_list.append(augmented_cids_seqs)
+            augmented_qids_list.append(augmented_qids_seqs)
+            augmented_res_list.append(augmented_res_seqs)
+        return augmented_cids_list, augmented_qids_list, augmented_res_list
+
     def _process_sequence_label_signal(self, seq_label_signal):
         seq_class_label = torch.tensor(seq_label_signal, dtype=torch.long)
         return seq_class_label
@@ -84,3 +109,114 @@ class RecWithContrastiveLearningDataset(object):
         # seq_class_label = self._process_sequence_label_signal(seq_label_signal)
         # print(f"cf_tensors_list:{cf_tensors_list}")
         return augmented_cids_list, augmented_qids_list, augmented_res_list
+
+
+class BatchAugmentation(object):
+    """
+    Crop / Mask / Reorder / Random augmentations of simplekt_cl_utils applied to a whole padded batch.
+
+    Inputs are [batch_size, max_len] integer tensors (on any device) plus the valid length of every row,
+    the augmented views are right padded with (num_c, num_q, 0) like _one_pair_data_augmentation.
+    Every random draw goes through the given torch.Generator, so a seeded generator gives reproducible views.
+    """
+    def __init__(self, augment_type="random", tao=0.2, gamma=0.7, beta=0.2):
+        self.augment_type = augment_type
+        self.tao = tao
+        self.gamma = gamma
+        self.beta = beta
+        self.augmentations = {"crop": self.crop, "mask": self.mask, "reorder": self.reorder, "random": self.random}
+        if self.augment_type not in self.augmentations:
+            raise ValueError(f"augmentation type: '{self.augment_type}' is invalided")
+
+    def __call__(self, cseqs, qseqs, rseqs, seqlens, num_c, num_q, generator=None):
+        seqs = torch.stack([cseqs.long(), qseqs.long(), rseqs.long()], dim=-1) # [batch_size, max_len, 3]
+        seqlens = seqlens.long().clamp(min=1, max=seqs.size(1))
+        pad = torch.tensor([num_c, num_q, 0], dtype=torch.long, device=seqs.device)
+        out = self.augmentations[self.augment_type](seqs, seqlens, pad, generator)
+        return out[:, :, 0], out[:, :, 1], out[:, :, 2]
+
+    def _rand(self, shape, seqs, generator):
+        return torch.rand(shape, generator=generator, device=seqs.device)
+
+    def _gather(self, seqs, index, valid, pad):
+        index = index.clamp(min=0, max=seqs.size(1)-1)
+        out = torch.gather(seqs, 1, index.unsqueeze(-1).expand(-1, -1, seqs.size(2)))
+        return torch.where(valid.unsqueeze(-1), out, pad)
+
+    def _start(self, seqlens, sub_lens, seqs, generator):
+        # randint(0, len - sub_len - 1)
+        choices = (seqlens - sub_lens).clamp(min=1)
+        return (self._rand(seqlens.shape, seqs, generator) * choices).long().clamp(max=choices-1)
+
+    def crop(self, seqs, seqlens, pad, generator=None):
+        positions = torch.arange(seqs.size(1), device=seqs.device).unsqueeze(0)
+        sub_lens = (self.tao * seqlens).long()
+        start = self._start(seqlens, sub_lens, seqs, generator)
+        crop_lens = sub_lens.clamp(min=1)
+        return self._gather(seqs, start.unsqueeze(-1) + positions, positions < crop_lens.unsqueeze(-1), pad)
+
+    def mask(self, seqs, seqlens, pad, generator=None):
+        positions = torch.arange(seqs.size(1), device=seqs.device).unsqueeze(0)
+        valid = positions < seqlens.unsqueeze(-1)
+        mask_nums = (self.gamma * seqlens).long()
+        # a random rank among the valid positions, the first mask_nums ranks are masked
+        keys = self._rand(seqs.shape[:2], seqs, generator).masked_fill(~valid, 2.)
+        ranks = torch.argsort(torch.argsort(keys, dim=1), dim=1)
+        keep = valid & (ranks >= mask_nums.unsqueeze(-1))
+        return torch.where(keep.unsqueeze(-1), seqs, pad)
+
+    def reorder(self, seqs, seqlens, pad, generator=None):
+        positions = torch.arange(seqs.size(1), device=seqs.device).unsqueeze(0)
+        valid = positions < seqlens.unsqueeze(-1)
+        sub_lens = (self.beta * seqlens).long()
+        start = self._start(seqlens, sub_lens, seqs, generator).unsqueeze(-1)
+        sub_lens = sub_lens.unsqueeze(-1)
+        in_window = (positions >= start) & (positions < start + sub_lens)
+        # random keys inside the window keep it in place while shuffling it
+        keys = start + self._rand(seqs.shape[:2], seqs, generator) * sub_lens
+        keys = torch.where(in_window, keys, positions.float())
+        index = torch.argsort(keys, dim=1)
+        return self._gather(seqs, index, valid, pad)
+
+    def random(self, seqs, seqlens, pad, generator=None):
+        # pick one augmentation per sequence
+        choice = (self._rand(seqlens.shape, seqs, generator) * 3).long().view(-1, 1, 1)
+        out = self.crop(seqs, seqlens, pad, generator)
+        out = torch.where(choice == 1, self.mask(seqs, seqlens, pad, generator), out)
+        out = torch.where(choice == 2, self.reorder(seqs, seqlens, pad, generator), out)
+        return out
+
+
+class ContrastiveCollator(object):
+    """
+    collate_fn adding the contrastive views (cseqs_cl / qseqs_cl / rseqs_cl) to a collated batch,
+    so augmentation runs once per batch inside the DataLoader workers instead of per sample at load time.
+    Each worker seeds its own generator with seed + worker_id.
+    """
+    def __init__(self, cl_data, num_c, num_q, seed=42):
+        self.cl_data = cl_data
+        self.num_c = num_c
+        self.num_q = num_q
+        self.seed = seed
+        self.generator = None
+
+    def __call__(self, batch):
+        dcur = default_collate(batch)
+        if self.generator is None:
+            worker_info = get_worker_info()
+            worker_id = 0 if worker_info is None else worker_info.id
+            self.generator = torch.Generator(device=dcur["cseqs"].device)
+            self.generator.manual_seed(self.seed + worker_id)
+        # full rows from the shifted inputs, the selected positions + the first one are the valid length
+        cseqs = torch.cat((dcur["cseqs"][:, 0:1], dcur["shft_cseqs"]), dim=1)
+        rseqs = torch.cat((dcur["rseqs"][:, 0:1], dcur["shft_rseqs"]), dim=1)
+        if self.num_q != 0:
+            qseqs = torch.cat((dcur["qseqs"][:, 0:1], dcur["shft_qseqs"]), dim=1)
+        else:
+            qseqs = torch.zeros_like(cseqs)
+        seqlens = dcur["smasks"].long().sum(-1) + 1
+        cseqs_cl, qseqs_cl, rseqs_cl = self.cl_data.batch_processed(cseqs, qseqs, rseqs, seqlens, self.num_c, self.num_q, generator=self.generator)
+        dcur["cseqs_cl"], dcur["rseqs_cl"] = cseqs_cl, rseqs_cl
+        if self.num_q != 0:
+            dcur["qseqs_cl"] = qseqs_cl
+        return dcur
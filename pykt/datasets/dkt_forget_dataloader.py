@@ -6,6 +6,7 @@ import torch
 from torch.utils.data import Dataset
 from torch import FloatTensor, LongTensor
 import numpy as np
+from .forget_utils import load_forget_features, FORGET_KEYS
 
 ModelConf = {
     "dkt_forget": ["timestamps"]
@@ -135,11 +136,10 @@ class DktForgetDataset(Dataset):
         dori = {"qseqs": [], "cseqs": [], "rseqs": [], "tseqs": [], "utseqs": [], "smasks": []}
         # seq_qids, seq_cids, seq_rights, seq_mask = [], [], [], []
         # repeated_gap, sequence_gap, past_counts = [], [], []
-        dgaps = {"rgaps": [], "sgaps": [], "pcounts": []}
         max_rgap, max_sgap, max_pcount = 0, 0, 0
 
-        df = pd.read_csv(sequence_path)
-        df = df[df["fold"].isin(folds)]
+        df_all = pd.read_csv(sequence_path)
+        df = df_all[df_all["fold"].isin(folds)]
         dqtest = {"qidxs": [], "rests":[], "orirow":[]}
 
         flag = True
@@ -148,6 +148,11 @@ class DktForgetDataset(Dataset):
                 print(f"key: {key} not in data: {self.sequence_path}! can not run dkt_forget model!")
                 flag = False
         assert flag == True
+
+        # default: concepts
+        skill_key = "concepts" if "concepts" in self.input_type else "questions"
+        forget_feats = load_forget_features(sequence_path, df_all, skill_key)
+        dgaps = forget_feats.take(df.index.values, FORGET_KEYS)
         
         for i, row in df.iterrows():
             #use kc_id or question_id as input
@@ -163,14 +168,6 @@ class DktForgetDataset(Dataset):
             dori["rseqs"].append([int(_) for _ in row["responses"].split(",")])
             dori["smasks"].append([int(_) for _ in row["selectmasks"].split(",")])
 
-            rgap, sgap, pcount = self.calC(row)
-            dgaps["rgaps"].append(rgap)
-            dgaps["sgaps"].append(sgap)
-            dgaps["pcounts"].append(pcount)
-            max_rgap = max(rgap) if max(rgap) > max_rgap else max_rgap
-            max_sgap = max(sgap) if max(sgap) > max_sgap else max_sgap
-            max_pcount = max(pcount) if max(pcount) > max_pcount else max_pcount
-
             if self.qtest:
                 dqtest["qidxs"].append([int(_) for _ in row["qidxs"].split(",")])
                 dqtest["rests"].append([int(_) for _ in row["rest"].split(",")])
@@ -186,8 +183,10 @@ class DktForgetDataset(Dataset):
 
         dori["smasks"] = (dori["smasks"][:, 1:] != pad_val)
         # q_seqs, c_seqs, r_seqs = FloatTensor(seq_qids), FloatTensor(seq_cids), FloatTensor(seq_rights)
+        if len(df) > 0:
+            max_rgap, max_sgap, max_pcount = int(dgaps["rgaps"].max()), int(dgaps["sgaps"].max()), int(dgaps["pcounts"].max())
         for key in dgaps:
-            dgaps[key] = LongTensor(dgaps[key])
+            dgaps[key] = torch.from_numpy(dgaps[key]).long()
 
         if self.qtest:
             for key in dqtest:
@@ -195,37 +194,3 @@ class DktForgetDataset(Dataset):
             return dori, dgaps, max_rgap, max_sgap, max_pcount, dqtest
 
         return dori, dgaps, max_rgap, max_sgap, max_pcount
-
-    def log2(self, t):
-        import math
-        return round(math.log(t+1, 2))
-
-    def calC(self, row):
-        repeated_gap, sequence_gap, past_counts = [], [], []
-        uid = row["uid"]
-        # default: concepts
-        skills = row["concepts"].split(",") if "concepts" in self.input_type else row["questions"].split(",")
-        timestamps = row["timestamps"].split(",")
-        dlastskill, dcount = dict(), dict()
-        pret = None
-        for s, t in zip(skills, timestamps):
-            s, t = int(s), int(t)
-            if s not in dlastskill or s == -1:
-                curRepeatedGap = 0
-            else:
-                curRepeatedGap = self.log2((t - dlastskill[s]) / 1000 / 60) + 1 # minutes
-            dlastskill[s] = t
-
-            repeated_gap.append(curRepeatedGap)
-            if pret == None or t == -1:
-                curLastGap = 0
-            else:
-                curLastGap = self.log2((t - pret) / 1000 / 60) + 1
-            pret = t
-            sequence_gap.append(curLastGap)
-
-            dcount.setdefault(s, 0)
-            past_counts.append(self.log2(dcount[s]))
-            dcount[s] += 1
-        return repeated_gap, sequence_gap, past_counts
-            
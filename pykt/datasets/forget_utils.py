@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# coding=utf-8
+import os
+import pandas as pd
+import numpy as np
+
+# features computed by dkt_forget/bakt_time and the extra labels used by parkt/mikt
+FORGET_KEYS = ["rgaps", "sgaps", "pcounts"]
+TIME_KEYS = ["its", "tlabel", "pretlabel", "citlabel"]
+
+_forget_cache = dict()
+
+def log2_round(x):
+    """vectorized version of round(math.log(x+1, 2))"""
+    return np.round(np.log2(x + 1)).astype(np.int64)
+
+def parse_ragged(col):
+    """parse a column of comma separated int sequences into a flat array and row offsets
+
+    Args:
+        col (pd.Series): each item is like "1,2,3"
+
+    Returns:
+        (tuple): flat values (np.array) and offsets (np.array, len(col)+1)
+    """
+    col = col.astype(str)
+    lens = col.str.count(",").values + 1
+    offsets = np.zeros(len(col) + 1, dtype=np.int64)
+    np.cumsum(lens, out=offsets[1:])
+    values = np.array(",".join(col.tolist()).split(","), dtype=np.int64) if len(col) > 0 else np.zeros(0, dtype=np.int64)
+    return values, offsets
+
+def cal_forget_features(skills, timestamps, offsets, index_time=False):
+    """compute the forgetting features of all interactions of all rows at once.
+    Interactions are grouped by (row, skill) with a stable sort, so the previous (and the one before)
+    occurrence of the same skill in the same row can be read from the neighbours in the sorted order.
+    Padding (-1) is assumed to be at the end of each row, as in the processed sequence files.
+
+    Args:
+        skills (np.array): flat skill ids of all rows
+        timestamps (np.array): flat timestamps (ms) of all rows, ignored if index_time
+        offsets (np.array): row offsets of the flat arrays, len is num_rows+1
+        index_time (bool, optional): use the position in the row as time (for datasets without real timestamps). Defaults to False.
+
+    Returns:
+        dict: flat arrays of rgaps, sgaps, pcounts, its, tlabel, pretlabel, citlabel
+    """
+    n = len(skills)
+    lens = np.diff(offsets)
+    rows = np.repeat(np.arange(len(lens)), lens)
+    pos = np.arange(n) - offsets[:-1][rows]
+    t = pos.astype(np.int64) if index_time else np.asarray(timestamps, dtype=np.int64)
+    # in index mode times are positions and no unit conversion is applied
+    sec = 1 if index_time else 1000
+    ispad = (t == -1) if not index_time else np.zeros(n, dtype=bool)
+
+    # previous occurrences of the same skill in the same row
+    order = np.lexsort((skills, rows))
+    same = (rows[order][1:] == rows[order][:-1]) & (skills[order][1:] == skills[order][:-1])
+    prev = np.full(n, -1, dtype=np.int64)
+    prev[order[1:]] = np.where(same, order[:-1], -1)
+    pprev = np.where(prev >= 0, prev[np.maximum(prev, 0)], -1)
+    starts = np.concatenate([[True], ~same]) if n > 0 else np.zeros(0, dtype=bool)
+    group_start = np.maximum.accumulate(np.where(starts, np.arange(n), 0)) if n > 0 else np.zeros(0, dtype=np.int64)
+    count = np.empty(n, dtype=np.int64)
+    count[order] = np.arange(n) - group_start
+
+    # repeated gap & past counts
+    has_prev = (prev >= 0) & (skills != -1)
+    rdiff = t - t[np.maximum(prev, 0)]
+    if index_time:
+        rgaps = np.where(has_prev, rdiff, 0)
+        pcounts = count
+    else:
+        rgaps = np.where(has_prev, log2_round(np.where(has_prev, rdiff, 0) / 1000 / 60) + 1, 0)
+        pcounts = log2_round(count)
+
+    # sequence gap & interval time
+    first = pos == 0
+    tp = np.concatenate([[0], t[:-1]]) if n > 0 else t
+    tp = np.where(first, t, tp)
+    normal = ~first & ~ispad
+    sdiff = np.where(normal, t - tp, 0)
+    if index_time:
+        sgaps = sdiff
+        its = sdiff
+    else:
+        sgaps = np.where(normal, log2_round(sdiff / 1000 / 60) + 1, 0)
+        its = sdiff / 1000
+    # t_{i-2}, the first interaction plays t_{-1}
+    tpp = np.concatenate([[0, 0], t[:-2]])[:n] if n > 0 else t
+    tpp = np.where(pos <= 1, t[offsets[:-1][rows]] if n > 0 else t, tpp)
+
+    pre_it = (tp - tpp) / sec
+    post_it = (t - tpp) / sec
+    last_it = (t - tp) / sec
+    with np.errstate(divide="ignore", invalid="ignore"):
+        raw_t = np.where(normal, np.round((pre_it + 0.01) / (post_it + 0.01), 2), 0.)
+        raw_pret = np.where(normal, np.round(1 - (last_it + 0.01) / (post_it + 0.01), 2), 0.)
+    # the first pad of a row is labelled as the end of the sequence when it is followed by another pad
+    if not index_time and n > 0:
+        npad = np.bincount(rows[ispad], minlength=len(lens))
+        padpos = np.where(ispad, pos, np.iinfo(np.int64).max)
+        firstpad = np.full(len(lens), np.iinfo(np.int64).max)
+        np.minimum.at(firstpad, rows, padpos)
+        raw_t[ispad & (pos == firstpad[rows]) & (npad[rows] >= 2)] = 1.
+
+    # t_label = [0] + raw[2:] + [1], pret_label = [0, 0.5] + raw[2:]
+    nxt = np.concatenate([raw_t[1:], [0.]]) if n > 0 else raw_t
+    last = pos == lens[rows] - 1
+    tlabel = np.where(first, 0., np.where(last, 1., nxt))
+    pretlabel = np.where(first, 0., np.where(pos == 1, 0.5, raw_pret))
+
+    # concept interval time
+    has_pprev = has_prev & (pprev >= 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cit = np.round(1 - ((t - t[np.maximum(prev, 0)]) / sec + 0.01) / ((t - t[np.maximum(pprev, 0)]) / sec + 0.01), 2)
+    citlabel = np.where(has_pprev, cit, np.where(has_prev, 0.5, 0.))
+
+    return {"rgaps": rgaps, "sgaps": sgaps, "pcounts": pcounts, "its": its,
+            "tlabel": tlabel, "pretlabel": pretlabel, "citlabel": citlabel}
+
+class ForgetFeatures:
+    """per-interaction time features of a whole sequence file, stored flat with row offsets
+
+    Args:
+        dfeats (dict): flat feature arrays
+        offsets (np.array): row offsets, len is num_rows+1
+    """
+    def __init__(self, dfeats, offsets):
+        self.dfeats = dfeats
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def row(self, idx, keys=None):
+        """features of one row, dict of np.array"""
+        start, end = self.offsets[idx], self.offsets[idx+1]
+        keys = self.dfeats.keys() if keys is None else keys
+        return {key: self.dfeats[key][start:end] for key in keys}
+
+    def take(self, idxs, keys=None):
+        """features of rows with the same length (e.g. the padded sequence files), dict of np.array [len(idxs), seqlen]"""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        keys = self.dfeats.keys() if keys is None else keys
+        lens = np.diff(self.offsets)[idxs]
+        seqlen = lens[0] if len(lens) > 0 else 0
+        assert (lens == seqlen).all(), "rows must have the same length!"
+        flat = (self.offsets[idxs][:, None] + np.arange(seqlen)[None, :]).reshape(-1)
+        return {key: self.dfeats[key][flat].reshape(len(idxs), seqlen) for key in keys}
+
+def load_forget_features(sequence_path, df=None, skill_key="concepts", index_time=False):
+    """compute the forgetting features of all rows of a sequence file, cached in memory and in a pickle next to the file
+
+    Args:
+        sequence_path (str): the csv file
+        df (pd.DataFrame, optional): the content of the csv file if already loaded. Defaults to None.
+        skill_key (str, optional): column used as skill, "concepts" or "questions". Defaults to "concepts".
+        index_time (bool, optional): use positions instead of timestamps. Defaults to False.
+
+    Returns:
+        ForgetFeatures: features of all rows, in the order of the csv file
+    """
+    suffix = "_forget_" + skill_key + ("_index" if index_time else "") + ".pkl"
+    processed_data = sequence_path + suffix
+    if processed_data in _forget_cache:
+        return _forget_cache[processed_data]
+    if os.path.exists(processed_data):
+        dfeats, offsets = pd.read_pickle(processed_data)
+    else:
+        if df is None:
+            df = pd.read_csv(sequence_path)
+        skills, offsets = parse_ragged(df[skill_key])
+        if index_time:
+            timestamps = None
+        else:
+            timestamps, toffsets = parse_ragged(df["timestamps"])
+            assert (toffsets == offsets).all(), f"timestamps and {skill_key} are not aligned in {sequence_path}!"
+        dfeats = cal_forget_features(skills, timestamps, offsets, index_time)
+        pd.to_pickle([dfeats, offsets], processed_data)
+    feats = ForgetFeatures(dfeats, offsets)
+    _forget_cache[processed_data] = feats
+    return feats
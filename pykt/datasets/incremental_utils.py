@@ -0,0 +1,129 @@
+import os
+import glob
+import numpy as np
+import pandas as pd
+from .que_data_loader import datasets_dic
+from .forget_utils import _forget_cache
+
+# per interaction keys of the question level sequences, the other keys are one value per row
+SEQ_KEYS = ["questions", "concepts", "responses", "timestamps", "selectmasks"]
+ONE_KEYS = ["fold", "uid", "dataset"]
+
+
+def read_delta(delta_path):
+    """the new interactions, a csv with one interaction per line: dataset (name or id), uid, question, concept
+    (several concepts joined by _), response and optionally timestamp; the ids are the ones of the stored sequences.
+    The interactions of a student are kept in timestamp order, or in file order without timestamps.
+    """
+    delta = pd.read_csv(delta_path, dtype={"concept": str})
+    for key in ["dataset", "uid", "question", "concept", "response"]:
+        assert key in delta.columns, f"the delta file has no {key} column!"
+    delta["dataset"] = delta["dataset"].map(lambda d: datasets_dic[d] if d in datasets_dic else int(d))
+    if "timestamp" in delta.columns:
+        delta = delta.sort_values("timestamp", kind="stable")
+    return delta
+
+
+def filter_vocab(delta, num_q, num_c):
+    """drop the interactions with questions / concepts outside the embeddings of the model, new ids need retraining"""
+    def in_vocab(row):
+        return int(row["question"]) < num_q and all(int(c) < num_c for c in str(row["concept"]).split("_"))
+    keep = delta.apply(in_vocab, axis=1) if len(delta) > 0 else np.ones(0, dtype=bool)
+    if (~keep).sum() > 0:
+        print(f"dropping {(~keep).sum()} interactions with unknown questions or concepts ...")
+    return delta[keep]
+
+
+def _row_values(row, columns):
+    """the valid interactions of a stored row, key -> list"""
+    length = len(row["responses"].split(",")) - row["responses"].split(",").count("-1")
+    return {key: row[key].split(",")[:length] for key in SEQ_KEYS if key in columns}
+
+
+def _chunk(values, start, end, maxlen, selected_from=0):
+    """the padded row of the interactions [start, end), the ones before selected_from are context only (selectmasks -1)"""
+    pad = maxlen - (end - start)
+    row = {key: ",".join(v[start:end] + ["-1"] * pad) for key, v in values.items() if key != "selectmasks"}
+    row["selectmasks"] = ",".join(["-1" if p < selected_from else "1" for p in range(start, end)] + ["-1"] * pad)
+    return row
+
+
+def append_interactions(seq_df, delta, maxlen, folds, context_len=None, min_seq_len=3):
+    """append new interactions to the students' sequences of a question level sequence file (e.g.
+    train_valid_sequences_quelevel_{seq_len}.csv). A student's last row is rebuilt with the new interactions and
+    split into rows of maxlen as generate_sequences does; a new student gets the fold folds[uid % len(folds)].
+    Unlike generate_sequences, a tail shorter than min_seq_len is stored too, the next updates extend it.
+
+    The update windows cover only the new suffixes: each one holds up to maxlen - context_len new interactions
+    (selected) after the previous interactions of the student (context, not selected). The windows shorter than
+    min_seq_len (a student with fewer interactions in total) are not trained on, their interactions are the
+    context of the later windows.
+
+    Args:
+        seq_df (pd.DataFrame): the stored sequences
+        delta (pd.DataFrame): the new interactions, see read_delta
+        maxlen (int): length of the rows
+        folds (list[int]): the folds of the sequences
+        context_len (int, optional): interactions of context in a window, None is maxlen // 2. Defaults to None.
+        min_seq_len (int, optional): the min_seq_len of the data config. Defaults to 3.
+
+    Returns:
+        (tuple): the updated sequences and the update windows, both in the format of seq_df
+    """
+    context_len = maxlen // 2 if context_len is None else context_len
+    step = max(maxlen - context_len, 1)
+    columns = list(seq_df.columns)
+    for key in columns:
+        assert key in SEQ_KEYS + ONE_KEYS, f"the column {key} of the sequences is not supported!"
+    # the last row of each student
+    last_rows = seq_df.groupby(["dataset", "uid"], sort=False).tail(1)
+    last_index = dict(zip(zip(last_rows["dataset"], last_rows["uid"]), last_rows.index))
+
+    replacements, new_students, windows = dict(), [], []
+    for (dataset, uid), inters in delta.groupby(["dataset", "uid"], sort=False):
+        index = last_index.get((dataset, uid))
+        if index is not None:
+            row = seq_df.loc[index]
+            values, fold = _row_values(row, columns), row["fold"]
+        else:
+            values, fold = {key: [] for key in SEQ_KEYS if key in columns}, folds[int(uid) % len(folds)]
+        start = len(values["responses"])
+        new = {"questions": inters["question"], "concepts": inters["concept"], "responses": inters["response"], "selectmasks": [1] * len(inters)}
+        if "timestamps" in values:
+            last_time = int(values["timestamps"][-1]) if start > 0 else -1
+            new["timestamps"] = inters["timestamp"] if "timestamp" in inters.columns else range(last_time + 1, last_time + 1 + len(inters))
+        for key in values:
+            values[key] = values[key] + [str(v) for v in new[key]]
+        end = len(values["responses"])
+        one_values = {"fold": fold, "uid": uid, "dataset": dataset}
+
+        rows = [{**one_values, **_chunk(values, j, min(j + maxlen, end), maxlen)} for j in range(0, end, maxlen)]
+        if index is not None:
+            replacements[index] = rows
+        else:
+            new_students.extend(rows)
+        for j in range(start, end, step):
+            window_end = min(j + step, end)
+            if window_end < min_seq_len:
+                continue
+            windows.append({**one_values, **_chunk(values, max(0, window_end - maxlen), window_end, maxlen, selected_from=j)})
+
+    # the rebuilt rows take the place of the last rows, the new students go to the end
+    kept = seq_df.drop(index=list(replacements))
+    parts = [kept.assign(_order=kept.index.astype(float))]
+    for index, rows in replacements.items():
+        parts.append(pd.DataFrame(rows).assign(_order=index + np.arange(len(rows)) / len(rows)))
+    if new_students:
+        parts.append(pd.DataFrame(new_students).assign(_order=len(seq_df) + np.arange(len(new_students), dtype=float)))
+    updated = pd.concat(parts).sort_values("_order", kind="stable").drop(columns="_order").reset_index(drop=True)
+    return updated[columns], pd.DataFrame(windows, columns=columns)
+
+
+def save_sequences(df, seq_path):
+    """write a sequence file and remove its processed caches (see KTQueDataset and load_forget_features), which would be stale"""
+    df.to_csv(seq_path, index=None)
+    for pattern in ["_*_qlevel*.pkl", "_forget_*.pkl"]:
+        for cache_path in glob.glob(glob.escape(seq_path) + pattern):
+            os.remove(cache_path)
+    for cache_path in [k for k in _forget_cache if k.startswith(seq_path + "_forget_")]:
+        del _forget_cache[cache_path]
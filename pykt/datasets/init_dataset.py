@@ -11,17 +11,19 @@ from .parkt_dataloader import ParktDataset
 from .lpkt_dataloader import LPKTDataset
 from .lpkt_utils import generate_time2idx
 from .que_data_loader import KTQueDataset
+from .que_stream_loader import KTQueStreamLoader
 from .que_data_loader_cl import KTQueDataset4CL
 from .que_data_loader_time import KTQueDataset4PT
 from pykt.config import que_type_models
-# from .simplekt_cl_dataloader import CL4KTDataset
+from .simplekt_cl_dataloader import CL4KTDataset as AugCL4KTDataset
 from .cl_utils import sort_samples
 from .cl_dataloader import CL4KTDataset
 from .pretrain_utils import get_pretrain_data, get_pretrain_test_data
 
-def init_test_datasets(data_config, model_name, batch_size,i,win200="", suffix='pretrain'):
+def init_test_datasets(data_config, model_name, batch_size,i,win200="", suffix='pretrain', stream_segments=0, seq_len=200):
     print(f"model_name is {model_name}")
     test_question_loader, test_question_window_loader = None, None
+    stream_path = None
     if model_name in ["dkt_forget", "bakt_time"]:
         test_dataset = DktForgetDataset(os.path.join(data_config["dpath"], data_config["test_file"]), data_config["input_type"], {-1})
         test_window_dataset = DktForgetDataset(os.path.join(data_config["dpath"], data_config["test_window_file"]),
@@ -64,6 +66,7 @@ def init_test_datasets(data_config, model_name, batch_size,i,win200="", suffix='
                     test_path = os.path.join(data_config["dpath"], data_config["test_window_file_quelevel_pretrain_w200"])
                     if not os.path.exists(test_path):
                         get_pretrain_test_data(seq_len, data_config)
+                    stream_path = test_path
                     test_window_dataset = KTQueDataset(test_path,
                                 input_type=data_config["input_type"], folds=[-1], 
                                 concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'])
@@ -72,7 +75,8 @@ def init_test_datasets(data_config, model_name, batch_size,i,win200="", suffix='
                     test_window_dataset = KTDataset(os.path.join(data_config["dpath"], data_config["test_window_file"]), data_config["input_type"], {-1})                              
             else:
                 if dataset in ["assist2009", "algebra2005", "bridge2algebra2006", "nips_task34", "ednet", "peiyou", "ednet5w"]:
-                    test_window_dataset = KTQueDataset(os.path.join(data_config["dpath"], data_config[f"test_window_file_quelevel_{suffix}_w200"]),
+                    stream_path = os.path.join(data_config["dpath"], data_config[f"test_window_file_quelevel_{suffix}_w200"])
+                    test_window_dataset = KTQueDataset(stream_path,
                                 input_type=data_config["input_type"], folds=[-1], 
                                 concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'])
                 else:
@@ -98,6 +102,10 @@ def init_test_datasets(data_config, model_name, batch_size,i,win200="", suffix='
 
     test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
     test_window_loader = DataLoader(test_window_dataset, batch_size=batch_size, shuffle=False)
+    # the windows joined back into whole student histories fed segment by segment, for the segment-recurrent mode (mem_len > 0)
+    if stream_segments and stream_path is not None:
+        test_window_loader = KTQueStreamLoader(stream_path, data_config["input_type"], {-1}, data_config['num_c'], data_config['max_concepts'],
+                                batch_size, seq_len)
     # if "test_question_file" in data_config:
     #     print(f"has test_question_file!")
     #     test_question_loader,test_question_window_loader = None,None
@@ -119,7 +127,8 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
     print(f"dataset_name:{dataset_name}")
     data_config = data_config[dataset_name]
     all_folds = set(data_config["folds"])
-    if emb_type.find("cl") != -1:
+    # the contrastive models read the augmented views (cseqs_cl, rseqs_cl) of AugCL4KTDataset, not the curriculum order
+    if emb_type.find("cl") != -1 and model_name not in ["simplekt_sr", "parkt", "mikt"]:
         # train_valid_path = os.path.join(data_config["dpath"], data_config["train_valid_file"])
         # cl_dpath = sort_samples(train_valid_path, data_config["dpath"])
         # # print(f"cl_dpath:{cl_dpath}")
@@ -177,6 +186,8 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
                 if not os.path.exists(dpath):
                     print(f"loading pretrain data")
                     get_pretrain_data(seq_len, data_config)
+                # concatenate short histories into packed rows, see pack_utils.pack_sequences
+                packed = getattr(args, "pack_sequences", 0) == 1
                 datasets_dic = {"assist2009": 0, "algebra2005": 1, "bridge2algebra2006": 2, "nips_task34": 3, "ednet": 4, "peiyou": 5, "ednet5w": 6}
                 all_trains = {}
 
@@ -185,11 +196,11 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
 
                     curtrain = KTQueDataset(dpath,
                                         input_type=data_config["input_type"], folds=all_folds - {i}, 
-                                        concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], dataset_name=args.finetune_dataset_name)
+                                        concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], packed=packed, dataset_name=args.finetune_dataset_name)
 
                     curvalid = KTQueDataset(dpath,
                                         input_type=data_config["input_type"], folds={i}, 
-                                        concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], dataset_name=args.finetune_dataset_name)
+                                        concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], packed=packed, dataset_name=args.finetune_dataset_name)
 
                 
 
@@ -200,14 +211,14 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
                         if dataset_name not in args.exclude_dataset:
                             temp_train = KTQueDataset(dpath,
                                             input_type=data_config["input_type"], folds=all_folds - {i}, 
-                                            concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], dataset_name=dataset_name)
+                                            concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], packed=packed, dataset_name=dataset_name)
                             all_trains[dataset_name] = temp_train
                     
 
                 elif args.compute_soft_mask and args.finetune_dataset_name != "None":
                     temp_train = KTQueDataset(dpath,
                                         input_type=data_config["input_type"], folds=all_folds - {i}, 
-                                        concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], dataset_name=args.finetune_dataset_name)
+                                        concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], packed=packed, dataset_name=args.finetune_dataset_name)
                     all_trains[args.finetune_dataset_name] = temp_train
                         
                         
@@ -222,10 +233,18 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
 
                     curtrain = KTQueDataset(dpath,
                                     input_type=data_config["input_type"], folds=all_folds - {i}, 
-                                    concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], exclude_dataset=args.exclude_dataset)
+                                    concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], packed=packed, exclude_dataset=args.exclude_dataset)
                     curvalid = KTQueDataset(dpath,
                                     input_type=data_config["input_type"], folds={i}, 
-                                    concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], exclude_dataset=args.exclude_dataset)
+                                    concept_num=data_config['num_c'], max_concepts=data_config['max_concepts'], packed=packed, exclude_dataset=args.exclude_dataset)
+
+                # whole student histories fed segment by segment, for the segment-recurrent mode (mem_len > 0)
+                if getattr(args, "stream_segments", 0) == 1 and not args.compute_soft_mask:
+                    filters = {"dataset_name": args.finetune_dataset_name} if args.finetune_dataset_name != "None" else {"exclude_dataset": args.exclude_dataset}
+                    curtrain = KTQueStreamLoader(dpath, data_config["input_type"], all_folds - {i}, data_config['num_c'], data_config['max_concepts'],
+                                    batch_size, seq_len, shuffle=True, **filters)
+                    curvalid = KTQueStreamLoader(dpath, data_config["input_type"], {i}, data_config['num_c'], data_config['max_concepts'],
+                                    batch_size, seq_len, **filters)
                     
             else:        
                 curvalid = KTQueDataset(os.path.join(data_config["dpath"], data_config["train_valid_file_quelevel"]),
@@ -238,12 +257,12 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
         curvalid = CDKTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], {i})
         curtrain = CDKTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], all_folds - {i})
     elif model_name in ["simplekt_sr"]:
-        curvalid = CL4KTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], data_config["num_c"], data_config["num_q"], {i}, args = args)
-        curtrain = CL4KTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], data_config["num_c"], data_config["num_q"], all_folds - {i}, args = args) 
+        curvalid = AugCL4KTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], data_config["num_c"], data_config["num_q"], {i}, args = args)
+        curtrain = AugCL4KTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], data_config["num_c"], data_config["num_q"], all_folds - {i}, args = args) 
     elif model_name in ["parkt", "mikt"]:
         if emb_type.find("cl") != -1 or emb_type.find("uid") != -1:
-            curvalid = CL4KTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], data_config["num_c"], data_config["num_q"], {i}, args = args)
-            curtrain = CL4KTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], data_config["num_c"], data_config["num_q"], all_folds - {i}, args = args) 
+            curvalid = AugCL4KTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], data_config["num_c"], data_config["num_q"], {i}, args = args)
+            curtrain = AugCL4KTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), data_config["input_type"], data_config["num_c"], data_config["num_q"], all_folds - {i}, args = args) 
         elif emb_type.find("time")!= -1:
             # at2idx, it2idx = generate_time2idx(data_config)
             # curvalid = LPKTDataset(os.path.join(data_config["dpath"], data_config["train_valid_file"]), at2idx, it2idx, data_config["input_type"], {i})
@@ -262,8 +281,8 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
     
     if emb_type.find("cl") != -1:
         # train_loader = None
-        train_loader = DataLoader(curtrain, batch_size=batch_size)
-        valid_loader = DataLoader(curvalid, batch_size=batch_size)
+        train_loader = DataLoader(curtrain, batch_size=batch_size, collate_fn=getattr(curtrain, "collate_fn", None))
+        valid_loader = DataLoader(curvalid, batch_size=batch_size, collate_fn=getattr(curvalid, "collate_fn", None))
     else:
         # print(f"curvalid:{len(curvalid)}")
         # print(f"curtrain:{len(curtrain)}")
@@ -280,11 +299,14 @@ def init_dataset4train(dataset_name, model_name, emb_type, data_config, i, batch
             else:
                 all_train_loaders = None
                 
+        elif isinstance(curtrain, KTQueStreamLoader):
+            # the stream loaders batch (and shard) the segments themselves
+            train_loader, valid_loader = curtrain, curvalid
         else:
             sampler = torch.utils.data.distributed.DistributedSampler(curtrain)
-            train_loader = DataLoader(curtrain, batch_size=batch_size,sampler=sampler)
+            train_loader = DataLoader(curtrain, batch_size=batch_size,sampler=sampler, collate_fn=getattr(curtrain, "collate_fn", None))
             # train_loader = DataLoader(curtrain, batch_size=batch_size)
-            valid_loader = DataLoader(curvalid, batch_size=batch_size)
+            valid_loader = DataLoader(curvalid, batch_size=batch_size, collate_fn=getattr(curvalid, "collate_fn", None))
     
     # try:
     if model_name in ["dkt_forget", "bakt_time"]:
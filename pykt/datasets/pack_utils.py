@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding=utf-8
+import bisect
+import numpy as np
+import torch
+
+def pack_rows(lens, groups, maxlen):
+    """assign the rows to packed rows of capacity maxlen with best-fit decreasing, rows of different groups are never packed together
+
+    Args:
+        lens (np.array): number of interactions of each row
+        groups (np.array): group of each row (e.g. the dataset id)
+        maxlen (int): capacity of a packed row
+
+    Returns:
+        list: list of packed rows, each one is a list of row indices
+    """
+    bins = []
+    for group in np.unique(groups):
+        rows = np.where(groups == group)[0]
+        rows = rows[np.argsort(-lens[rows], kind="stable")]
+        # remaining capacities (sorted) of the open packed rows and their indices
+        caps, ids = [], []
+        for row in rows:
+            k = bisect.bisect_left(caps, lens[row])
+            if k == len(caps):
+                bins.append([row])
+                cap, bidx = maxlen - lens[row], len(bins) - 1
+            else:
+                bidx = ids.pop(k)
+                cap = caps.pop(k) - lens[row]
+                bins[bidx].append(row)
+            if cap > 0:
+                k = bisect.bisect_left(caps, cap)
+                caps.insert(k, cap)
+                ids.insert(k, bidx)
+    return bins
+
+def pack_sequences(dori, pad_val=-1):
+    """concatenate several students into one row of the sequence tensors of KTQueDataset,
+    so a batch of short histories does not pay for maxlen positions of padding.
+
+    The packed data has a "segs" tensor with the segment id (1, 2, ...) of each position, 0 for padding.
+    Models apply a block-diagonal causal mask with it (see models.transformer_utils.segment_mask).
+    The first interaction of each segment is not selected in "smasks", so the loss and the metrics are computed per segment
+    on the same interactions as without packing.
+
+    Args:
+        dori (dict): the tensors of KTQueDataset, qseqs/cseqs/rseqs [num_rows, maxlen(, max_concepts)], smasks/masks [num_rows, maxlen-1], dataset [num_rows]
+        pad_val (int, optional): pad value. Defaults to -1.
+
+    Returns:
+        dict: the packed tensors with the same keys and "segs" [num_packed_rows, maxlen]
+    """
+    rseqs = dori["rseqs"]
+    maxlen = rseqs.size(1)
+    lens = (rseqs != pad_val).sum(dim=1).numpy()
+    bins = pack_rows(lens, dori["dataset"].numpy(), maxlen)
+
+    rows = np.concatenate([np.array(b, dtype=np.int64) for b in bins]) if bins else np.zeros(0, dtype=np.int64)
+    bin_of = np.repeat(np.arange(len(bins)), [len(b) for b in bins])
+    seg_lens = lens[rows]
+    # start of each segment inside its packed row
+    ends = np.cumsum(seg_lens)
+    bin_first = np.searchsorted(bin_of, bin_of, side="left")
+    offsets = ends - seg_lens - (ends - seg_lens)[bin_first]
+    seg_ids = np.arange(len(rows)) - bin_first + 1
+
+    src_row = torch.from_numpy(np.repeat(rows, seg_lens))
+    src_pos = torch.from_numpy(np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - seg_lens, seg_lens))
+    dst_row = torch.from_numpy(np.repeat(bin_of, seg_lens))
+    dst_pos = torch.from_numpy(np.repeat(offsets, seg_lens)) + src_pos
+
+    dpack = dict()
+    for key in ["qseqs", "cseqs", "rseqs"]:
+        if len(dori[key]) == 0:
+            dpack[key] = dori[key]
+            continue
+        value = dori[key]
+        packed = torch.full((len(bins),) + tuple(value.shape[1:]), pad_val, dtype=value.dtype)
+        packed[dst_row, dst_pos] = value[src_row, src_pos]
+        dpack[key] = packed
+    segs = torch.zeros(len(bins), maxlen, dtype=torch.long)
+    segs[dst_row, dst_pos] = torch.from_numpy(np.repeat(seg_ids, seg_lens))
+    dpack["segs"] = segs
+
+    # selection of position t is smasks[t-1], the first interaction of a row (segment) is never selected
+    sel = torch.cat([torch.zeros(len(rseqs), 1, dtype=torch.bool), dori["smasks"].bool()], dim=1)
+    packed_sel = torch.zeros(len(bins), maxlen, dtype=torch.bool)
+    packed_sel[dst_row, dst_pos] = sel[src_row, src_pos]
+    dpack["smasks"] = packed_sel[:, 1:]
+    dpack["masks"] = (dpack["rseqs"][:, :-1] != pad_val) * (dpack["rseqs"][:, 1:] != pad_val)
+    dpack["dataset"] = dori["dataset"][torch.from_numpy(np.array([b[0] for b in bins], dtype=np.int64))]
+    print(f"packed {len(rseqs)} rows into {len(bins)} rows, {lens.sum() / max(len(bins) * maxlen, 1):.2%} of the positions are used")
+    return dpack
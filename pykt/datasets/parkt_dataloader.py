@@ -6,6 +6,7 @@ import torch
 from torch.utils.data import Dataset
 from torch import FloatTensor, LongTensor
 import numpy as np
+from .forget_utils import load_forget_features, FORGET_KEYS, TIME_KEYS
 
 ModelConf = {
     "dkt_forget": ["timestamps"]
@@ -136,11 +137,10 @@ class ParktDataset(Dataset):
         dori = {"qseqs": [], "cseqs": [], "rseqs": [], "tseqs": [], "utseqs": [], "smasks": []}
         # seq_qids, seq_cids, seq_rights, seq_mask = [], [], [], []
         # repeated_gap, sequence_gap, past_counts = [], [], []
-        dgaps = {"rgaps": [], "sgaps": [], "pcounts": [], "its":[], "tlabel":[], "pretlabel":[], "citlabel":[]}
         max_rgap, max_sgap, max_pcount, max_it = 0, 0, 0, 0
 
-        df = pd.read_csv(sequence_path)
-        df = df[df["fold"].isin(folds)]
+        df_all = pd.read_csv(sequence_path)
+        df = df_all[df_all["fold"].isin(folds)]
         dqtest = {"qidxs": [], "rests":[], "orirow":[]}
 
         # flag = True
@@ -149,6 +149,12 @@ class ParktDataset(Dataset):
         #         print(f"key: {key} not in data: {self.sequence_path}! can not run dkt_forget model!")
         #         flag = False
         # assert flag == True
+
+        # default: concepts, datasets without real timestamps use the interaction index as time
+        skill_key = "concepts" if "concepts" in self.input_type else "questions"
+        index_time = file_path.find("assist2009") != -1 or file_path.find("assist2015") != -1
+        forget_feats = load_forget_features(sequence_path, df_all, skill_key, index_time)
+        dgaps = forget_feats.take(df.index.values, FORGET_KEYS + TIME_KEYS)
         
         for i, row in df.iterrows():
             #use kc_id or question_id as input
@@ -164,25 +170,6 @@ class ParktDataset(Dataset):
             dori["rseqs"].append([int(_) for _ in row["responses"].split(",")])
             dori["smasks"].append([int(_) for _ in row["selectmasks"].split(",")])
 
-            if file_path.find("assist2009") == -1 and file_path.find("assist2015") == -1:
-                rgap, sgap, pcount, it, t_label, pret_label, cit_label = self.calC(row)
-            else:
-                rgap, sgap, pcount, it, t_label, pret_label, cit_label = self.calC_INDEX(row)
-            # print(f"sgap:{sgap}")
-            # print(f"it:{it}")
-            dgaps["rgaps"].append(rgap)
-            dgaps["sgaps"].append(sgap)
-            dgaps["pcounts"].append(pcount)
-            dgaps["its"].append(it)
-            dgaps["tlabel"].append(t_label)
-            dgaps["pretlabel"].append(pret_label)
-            dgaps["citlabel"].append(cit_label)
-
-            max_rgap = max(rgap) if max(rgap) > max_rgap else max_rgap
-            max_sgap = max(sgap) if max(sgap) > max_sgap else max_sgap
-            max_pcount = max(pcount) if max(pcount) > max_pcount else max_pcount
-            max_it = max(it) if max(it) > max_it else max_it
-
             if self.qtest:
                 dqtest["qidxs"].append([int(_) for _ in row["qidxs"].split(",")])
                 dqtest["rests"].append([int(_) for _ in row["rest"].split(",")])
@@ -198,12 +185,14 @@ class ParktDataset(Dataset):
 
         dori["smasks"] = (dori["smasks"][:, 1:] != pad_val)
         # q_seqs, c_seqs, r_seqs = FloatTensor(seq_qids), FloatTensor(seq_cids), FloatTensor(seq_rights)
+        if len(df) > 0:
+            max_rgap, max_sgap, max_pcount, max_it = [dgaps[key].max().item() for key in ["rgaps", "sgaps", "pcounts", "its"]]
         for key in dgaps:
             if key not in ["tlabel", "pretlabel", "citlabel"]:
                 # print(f"key:{key},  {dgaps[key]}")
-                dgaps[key] = LongTensor(dgaps[key])
+                dgaps[key] = torch.from_numpy(dgaps[key]).long()
             else:
-                dgaps[key] = FloatTensor(dgaps[key])
+                dgaps[key] = torch.from_numpy(dgaps[key]).float()
 
         if self.qtest:
             for key in dqtest:
@@ -211,147 +200,3 @@ class ParktDataset(Dataset):
             return dori, dgaps, max_rgap, max_sgap, max_pcount, max_it, dqtest
 
         return dori, dgaps, max_rgap, max_sgap, max_pcount, max_it
-
-    def log2(self, t):
-        import math
-        return round(math.log(t+1, 2))
-
-    def calC(self, row):
-        repeated_gap, sequence_gap, past_counts, sequence_it, t_label, pret_label, cit_label = [], [], [], [], [], [],[]
-        uid = row["uid"]
-        # default: concepts
-        skills = row["concepts"].split(",") if "concepts" in self.input_type else row["questions"].split(",")
-        timestamps = row["timestamps"].split(",")
-        dpreskill, dlastskill, dcount = dict(), dict(), dict()
-        pret, double_pret = None, None
-        cnt = 0
-        for idx,(s, t) in enumerate(zip(skills, timestamps)):
-            s, t = int(s), int(t)
-            if s not in dlastskill or s == -1:
-                curRepeatedGap = 0
-                curCIt = 0
-                dlastskill[s] = -1
-            else:
-                curRepeatedGap = self.log2((t - dlastskill[s]) / 1000 / 60) + 1 # minutes
-                if dpreskill[s] == -1:
-                    curCIt = 0.5
-                else:
-                    precit = int((t - dlastskill[s]))/1000
-                    double_precit = int((t - dpreskill[s]))/1000
-                    curCIt = round(1 - ((precit + 0.01)/(double_precit + 0.01)),2)
-            dpreskill[s] = dlastskill[s]
-            dlastskill[s] = t
-
-            repeated_gap.append(curRepeatedGap)
-            cit_label.append(curCIt)
-
-            if pret == None or t == -1:
-                if t == -1:
-                    cnt += 1
-                curLastGap = 0
-                curLastIt = 0
-                curPreT = 0
-                if idx == 0:
-                    curLableT = 0
-                    double_pret = t
-                else:
-                    if cnt == 2:
-                        t_label[-1] = 1
-                    else:
-                        curLableT = 0
-
-            else:
-                curLastGap = self.log2((t - pret) / 1000 / 60) + 1
-                # curLastIt = min(int((t - pret) / 1000 / 60) + 1,43200)
-                curLastIt = int((t - pret)) / 1000
-                curPreIt = int((pret - double_pret))/1000
-                curPostIt = int((t - double_pret))/1000
-                curLableT = round((curPreIt+0.01)/(curPostIt+0.01),2)
-                curPreT = round(1 - ((curLastIt + 0.01)/(curPostIt + 0.01)),2)
-                double_pret = pret
-            pret = t
-            sequence_gap.append(curLastGap)
-            sequence_it.append(curLastIt)
-            t_label.append(curLableT)
-            pret_label.append(curPreT)
-            
-            dcount.setdefault(s, 0)
-            past_counts.append(self.log2(dcount[s]))
-            dcount[s] += 1
-        t_label = [0]+t_label[2:]+[1]
-        pret_label = [0, 0.5]+pret_label[2:]
-    
-        return repeated_gap, sequence_gap, past_counts, sequence_it, t_label, pret_label, cit_label
-            
-
-    def calC_INDEX(self, row):
-        repeated_gap, sequence_gap, past_counts, sequence_it, t_label, pret_label, cit_label = [], [], [], [], [], [],[]
-        uid = row["uid"]
-        # default: concepts
-        skills = row["concepts"].split(",") if "concepts" in self.input_type else row["questions"].split(",")
-        timestamps = [i for i in range(len(skills))]
-        dpreskill, dlastskill, dcount = dict(), dict(), dict()
-        pret, double_pret = None, None
-        cnt = 0
-
-        for idx,(s, t) in enumerate(zip(skills, timestamps)):
-            s, t = int(s), int(t)
-            if s not in dlastskill or s == -1:
-                curRepeatedGap = 0
-                curCIt = 0
-                dlastskill[s] = -1
-            else:
-                curRepeatedGap = (t - dlastskill[s])# minutes
-                if dpreskill[s] == -1:
-                    # print(f"s:{s}")
-                    curCIt = 0.5
-                else:
-                    # print(f"s:{s}")
-                    precit = int((t - dlastskill[s]))
-                    double_precit = int((t - dpreskill[s]))
-                    curCIt = round(1 - ((precit + 0.01)/(double_precit + 0.01)),2)
-            dpreskill[s] = dlastskill[s]
-            dlastskill[s] = t
-
-            repeated_gap.append(curRepeatedGap)
-            cit_label.append(curCIt)
-
-            if pret == None or t == -1:
-                if t == -1:
-                    cnt += 1
-                curLastGap = 0
-                curLastIt = 0
-                curPreT = 0
-                if idx == 0:
-                    curLableT = 0
-                    double_pret = t
-                else:
-                    if cnt == 2:
-                        t_label[-1] = 1
-                    else:
-                        curLableT = 0
-
-            else:
-                curLastGap = (t - pret) 
-                curLastIt = int((t - pret)) 
-                curPreIt = int((pret - double_pret))
-                curPostIt = int((t - double_pret))
-                curLableT = round((curPreIt+0.01)/(curPostIt+0.01),2)
-                curPreT = round(1 - ((curLastIt + 0.01)/(curPostIt + 0.01)),2)
-                double_pret = pret
-            pret = t
-            sequence_gap.append(curLastGap)
-            sequence_it.append(curLastIt)
-            t_label.append(curLableT)
-            pret_label.append(curPreT)
-
-            dcount.setdefault(s, 0)
-            past_counts.append(dcount[s])
-            dcount[s] += 1
-        t_label = [0]+t_label[2:]+[1]
-        pret_label = [0, 0.5]+pret_label[2:]
-    
-        return repeated_gap, sequence_gap, past_counts, sequence_it, t_label, pret_label, cit_label
-
-
-
@@ -9,6 +9,7 @@ from torch.utils.data import Dataset
 from torch import FloatTensor, LongTensor
 import numpy as np
 import joblib
+from .pack_utils import pack_sequences
 
 
 datasets_dic = {"assist2009": 0, "algebra2005": 1, "bridge2algebra2006": 2, "nips_task34": 3, "ednet": 4, "peiyou": 5, "ednet5w": 6}
@@ -24,9 +25,10 @@ class KTQueDataset(Dataset):
         input_type (list[str]): the input type of the dataset, values are in ["questions", "concepts"]
         folds (set(int)): the folds used to generate dataset, -1 for test data
         qtest (bool, optional): is question evaluation or not. Defaults to False.
+        packed (bool, optional): pack several students into one row, see pack_utils.pack_sequences. Defaults to False.
     """
 
-    def __init__(self, file_path, input_type, folds,concept_num,max_concepts, qtest=False, dataset_name=None, exclude_dataset=None):
+    def __init__(self, file_path, input_type, folds,concept_num,max_concepts, qtest=False, dataset_name=None, exclude_dataset=None, packed=False):
         super(KTQueDataset, self).__init__()
         sequence_path = file_path
         self.input_type = input_type
@@ -58,6 +60,8 @@ class KTQueDataset(Dataset):
             except MemoryError:
                 with open(processed_data, 'rb') as f:
                     self.dori = joblib.load(f)
+        if packed:
+            self.dori = pack_sequences(self.dori)
         print(f"file path: {file_path}, qlen: {len(self.dori['qseqs'])}, clen: {len(self.dori['cseqs'])}, rlen: {len(self.dori['rseqs'])}")
 
     def __len__(self):
@@ -84,12 +88,13 @@ class KTQueDataset(Dataset):
             - **rshft_seqs (torch.tensor)**: response id sequence of the 1~seqlen-1 interactions
             - **mask_seqs (torch.tensor)**: masked value sequence, shape is seqlen-1
             - **select_masks (torch.tensor)**: is select to calculate the performance or not, 0 is not selected, 1 is selected, only available for 1~seqlen-1, shape is seqlen-1
+            - **segs (torch.tensor)**: only for packed data, segment id of the 0~seqlen-1 interactions, 0 is padding, shape is seqlen
             - **dcur (dict)**: used only self.qtest is True, for question level evaluation
         """
         dcur = dict()
         mseqs = self.dori["masks"][index]
         for key in self.dori:
-            if key in ["masks", "smasks","dataset"]:
+            if key in ["masks", "smasks","dataset","segs"]:
                 continue
             if len(self.dori[key]) == 0:
                 dcur[key] = self.dori[key]
@@ -107,6 +112,8 @@ class KTQueDataset(Dataset):
         dcur["masks"] = mseqs
         dcur["smasks"] = self.dori["smasks"][index]
         dcur["dataset_id"] = self.dori["dataset"][index]
+        if "segs" in self.dori:
+            dcur["segs"] = self.dori["segs"][index]
         # print("tseqs", dcur["tseqs"])
         return dcur
 
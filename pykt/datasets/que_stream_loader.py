@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+from .que_data_loader import datasets_dic
+
+
+class KTQueStreamLoader:
+    """Loader of the segment-recurrent mode of LOREKT (mem_len > 0).
+    The chunks of a student in the sequence file are joined back into the whole history, which is fed in order
+    as segments of seqlen interactions, one student per batch lane, so the model can carry the memory of the previous
+    segment of the lane. Consecutive segments overlap by one interaction (the last one of a segment is the first one
+    of the next), so every interaction except the first one of a student is predicted exactly once, with the usual
+    selection of the 1~seqlen-1 interactions of a segment. The sequence file can also be a window file (see
+    generate_window_sequences), whose rows of a student overlap: a row after the first one only adds its selected
+    interactions.
+
+    Each batch has the keys of KTQueDataset and:
+        - **new_seqs (torch.tensor)**: [batch_size] bool, the lane starts a new student, i.e. its memory must be reset
+
+    Args:
+        file_path (str): train_valid/test file path
+        input_type (list[str]): the input type of the dataset, values are in ["questions", "concepts"]
+        folds (set(int)): the folds used to generate dataset, -1 for test data
+        concept_num (int): number of concepts
+        max_concepts (int): max number of concepts of a question
+        batch_size (int): number of lanes
+        seqlen (int): segment length
+        dataset_name (str, optional): only load this dataset. Defaults to None.
+        exclude_dataset (str, optional): comma separated datasets to exclude. Defaults to None.
+        shuffle (bool, optional): shuffle the students every epoch (see set_epoch). Defaults to False.
+    """
+    def __init__(self, file_path, input_type, folds, concept_num, max_concepts, batch_size, seqlen, dataset_name=None, exclude_dataset=None, shuffle=False, pad_val=-1):
+        if "questions" not in input_type or "concepts" not in input_type:
+            raise("The input types must contain both questions and concepts")
+        self.concept_num = concept_num
+        self.max_concepts = max_concepts
+        self.batch_size = batch_size
+        self.seqlen = seqlen
+        self.shuffle = shuffle
+        self.pad_val = pad_val
+        self.epoch = 0
+        # train_model calls loader.sampler.set_epoch
+        self.sampler = self
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.num_replicas = dist.get_rank(), dist.get_world_size()
+        else:
+            self.rank, self.num_replicas = 0, 1
+        self.students = self.__load_data__(file_path, sorted(list(folds)), dataset_name, exclude_dataset)
+        print(f"file path: {file_path}, students: {len(self.students)}, interactions: {sum(len(s['rseqs']) for s in self.students)}")
+
+    def __load_data__(self, sequence_path, folds, dataset_name=None, exclude_dataset=None):
+        """join the chunks or windows of each student (consecutive rows with the same uid and dataset) back into one history"""
+        df = pd.read_csv(sequence_path)
+        df = df[df["fold"].isin(folds)].copy()
+        if dataset_name:
+            df = df[df["dataset"] == datasets_dic[dataset_name]]
+        elif exclude_dataset:
+            for cur_exclude_dataset in exclude_dataset.split(","):
+                df = df[df["dataset"] != datasets_dic[cur_exclude_dataset]]
+
+        students, prev_key = [], None
+        for _, row in df.iterrows():
+            responses = [int(_) for _ in row["responses"].split(",")]
+            length = sum(1 for r in responses if r != self.pad_val)
+            skills = []
+            for concept in row["concepts"].split(",")[:length]:
+                cur = [int(_) for _ in concept.split("_")]
+                skills.append(cur + [self.pad_val] * (self.max_concepts - len(cur)))
+            cur = {"qseqs": [int(_) for _ in row["questions"].split(",")[:length]], "cseqs": skills,
+                   "rseqs": responses[:length], "smasks": [int(_) for _ in row["selectmasks"].split(",")[:length]]}
+            key = (row["uid"], row["dataset"])
+            if key != prev_key:
+                students.append({"dataset": int(row["dataset"]), **cur})
+            else:
+                # the unselected interactions of a following row are the context of a window, already in the history
+                selected = [j for j, m in enumerate(cur["smasks"]) if m == 1]
+                for k in cur:
+                    students[-1][k].extend([cur[k][j] for j in selected])
+            prev_key = key
+        for s in students:
+            s["qseqs"], s["cseqs"], s["smasks"] = np.array(s["qseqs"]), np.array(s["cseqs"]).reshape(-1, self.max_concepts), np.array(s["smasks"])
+            s["rseqs"] = np.array(s["rseqs"], dtype=np.float32)
+        return students
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def num_segments(self, n):
+        """segments of a student with n interactions, each one has at least two interactions"""
+        stride = self.seqlen - 1
+        return max(1, int(np.ceil((n - 1) / stride)))
+
+    def plan(self):
+        """assign the students to the lanes of all the ranks, a lane takes the next student when its current one ends.
+        The plan is made on the global order, so every rank runs the same number of steps (a DDP step needs all the
+        ranks), the lanes of a rank that run out of students are idle until the end, like the padding of DistributedSampler.
+
+        Returns:
+            list: for every step, a list of (student, segment) per lane of this rank, None for an idle lane
+        """
+        order = np.arange(len(self.students))
+        if self.shuffle:
+            order = np.random.RandomState(self.epoch).permutation(order)
+        # lane l of the global plan is the lane l % batch_size of the rank l // batch_size
+        lanes = [[] for _ in range(self.batch_size * self.num_replicas)]
+        # greedy: the next student goes to the lane that is free first
+        free_at = np.zeros(len(lanes), dtype=np.int64)
+        for sidx in order:
+            lane = int(np.argmin(free_at))
+            nseg = self.num_segments(len(self.students[sidx]["rseqs"]))
+            lanes[lane].extend([(sidx, k) for k in range(nseg)])
+            free_at[lane] += nseg
+        nsteps = int(free_at.max()) if len(order) > 0 else 0
+        lanes = lanes[self.rank * self.batch_size: (self.rank + 1) * self.batch_size]
+        return [[lane[t] if t < len(lane) else None for lane in lanes] for t in range(nsteps)]
+
+    def __len__(self):
+        return len(self.plan())
+
+    def segment(self, sidx, k):
+        """the padded arrays of the k-th segment of a student"""
+        s, stride, seqlen = self.students[sidx], self.seqlen - 1, self.seqlen
+        start = k * stride
+        cur = {key: s[key][start: start + seqlen] for key in ["qseqs", "cseqs", "rseqs", "smasks"]}
+        pad = seqlen - len(cur["rseqs"])
+        for key in cur:
+            cur[key] = np.concatenate([cur[key], np.full((pad,) + cur[key].shape[1:], self.pad_val, dtype=cur[key].dtype)])
+        return cur
+
+    def __iter__(self):
+        seqlen, pad_val = self.seqlen, self.pad_val
+        empty = {"qseqs": np.full(seqlen, pad_val), "cseqs": np.full((seqlen, self.max_concepts), pad_val),
+                 "rseqs": np.full(seqlen, pad_val, dtype=np.float32), "smasks": np.full(seqlen, pad_val)}
+        for step in self.plan():
+            segs, new_seqs, dataset_ids = [], [], []
+            for item in step:
+                if item is None:
+                    segs.append(empty)
+                    new_seqs.append(True)
+                    dataset_ids.append(0)
+                else:
+                    segs.append(self.segment(*item))
+                    new_seqs.append(item[1] == 0)
+                    dataset_ids.append(self.students[item[0]]["dataset"])
+            batch = {key: torch.from_numpy(np.stack([s[key] for s in segs])) for key in empty}
+            batch["qseqs"], batch["cseqs"], batch["smasks"] = batch["qseqs"].long(), batch["cseqs"].long(), batch["smasks"].long()
+            masks = (batch["rseqs"][:, :-1] != pad_val) * (batch["rseqs"][:, 1:] != pad_val)
+            dcur = dict()
+            for key in ["qseqs", "rseqs"]:
+                dcur[key] = batch[key][:, :-1] * masks
+                dcur["shft_" + key] = batch[key][:, 1:] * masks
+            dcur["cseqs"], dcur["shft_cseqs"] = batch["cseqs"][:, :-1], batch["cseqs"][:, 1:]
+            dcur["masks"] = masks
+            dcur["smasks"] = (batch["smasks"][:, 1:] != pad_val) * masks
+            dcur["dataset_id"] = torch.tensor(dataset_ids)
+            dcur["new_seqs"] = torch.tensor(new_seqs)
+            yield dcur
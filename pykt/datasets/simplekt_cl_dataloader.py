@@ -1,7 +1,7 @@
 import random
 import torch
 import os
-from .data_augmentation import RecWithContrastiveLearningDataset
+from .data_augmentation import RecWithContrastiveLearningDataset, ContrastiveCollator
 from torch.utils.data import Dataset
 import copy
 import pandas as pd
@@ -20,6 +20,7 @@ class CL4KTDataset(Dataset):
         input_type (list[str]): the input type of the dataset, values are in ["questions", "concepts"]
         folds (set(int)): the folds used to generate dataset, -1 for test data
         qtest (bool, optional): is question evaluation or not. Defaults to False.
+        args: augmentation args, with args.batch_augment the views are built per batch by self.collate_fn instead of once at load time
     """
     def __init__(self, file_path, input_type, num_c, num_q, folds, qtest=False, args=None):
         super(CL4KTDataset, self).__init__()
@@ -31,12 +32,17 @@ class CL4KTDataset(Dataset):
         # print(f"self.num_c:{num_c}")
         folds = sorted(list(folds))
         folds_str = "_" + "_".join([str(_) for _ in folds])
+        self.batch_augment = getattr(args, "batch_augment", 0)
+        cl_str = "_clbatch" if self.batch_augment else "_cl"
         if self.qtest:
-            processed_data = file_path + "_cl" + folds_str + "_qtest.pkl"
+            processed_data = file_path + cl_str + folds_str + "_qtest.pkl"
         else:
-            processed_data = file_path + "_cl" + folds_str + ".pkl"
+            processed_data = file_path + cl_str + folds_str + ".pkl"
         
         self.cl_data = RecWithContrastiveLearningDataset(args=args)
+        self.collate_fn = None
+        if self.batch_augment:
+            self.collate_fn = ContrastiveCollator(self.cl_data, num_c, num_q, seed=getattr(args, "seed", 42))
 
         if not os.path.exists(processed_data):
             print(f"Start preprocessing {file_path} fold: {folds_str}...")
@@ -84,7 +90,7 @@ class CL4KTDataset(Dataset):
         dcur = dict()
         mseqs = self.dori["masks"][index]
         for key in self.dori:
-            if key in ["masks", "smasks"]:
+            if key in ["masks", "smasks", "cseqs_cl", "qseqs_cl", "rseqs_cl"]:
                 continue
             if len(self.dori[key]) == 0:
                 dcur[key] = self.dori[key]
@@ -98,11 +104,12 @@ class CL4KTDataset(Dataset):
                 dcur["shft_"+key] = shft_seqs
         dcur["masks"] = mseqs
         dcur["smasks"] = self.dori["smasks"][index]
-        dcur["cseqs_cl"] = self.dori["cseqs_cl"][index]
-        dcur["rseqs_cl"] = self.dori["rseqs_cl"][index]
         dcur["uid"] = self.dori["uid"][index]
-        if self.num_q != 0:
-            dcur["qseqs_cl"] = self.dori["qseqs_cl"][index]
+        if not self.batch_augment:
+            dcur["cseqs_cl"] = self.dori["cseqs_cl"][index]
+            dcur["rseqs_cl"] = self.dori["rseqs_cl"][index]
+            if self.num_q != 0:
+                dcur["qseqs_cl"] = self.dori["qseqs_cl"][index]
         # print("tseqs", dcur["tseqs"])
         if not self.qtest:
             return dcur
@@ -158,17 +165,18 @@ class CL4KTDataset(Dataset):
             dori["rseqs"].append(rseqs)
             interaction_num += dori["smasks"][-1].count(1)
 
-            # cl data
-            if "questions" in self.input_type:
-                input_ids = [(x[0], x[1], x[2]) for x in zip(cseqs, qseqs, rseqs)]
-                cseqs_cl, qseqs_cl, rseqs_cl = self.cl_data.processed(input_ids, seqlen, self.num_c, self.num_q)
-            else:
-                qseqs = [0 for x in range(len(rseqs))]
-                input_ids = [(x[0], x[1], x[2]) for x in zip(cseqs, qseqs, rseqs)]
-                cseqs_cl, qseqs_cl, rseqs_cl = self.cl_data.processed(input_ids, seqlen, self.num_c, self.num_q)
-            dori["cseqs_cl"].append(cseqs_cl)
-            dori["qseqs_cl"].append(qseqs_cl)
-            dori["rseqs_cl"].append(rseqs_cl)
+            # cl data, built per batch by self.collate_fn with batch_augment
+            if not self.batch_augment:
+                if "questions" in self.input_type:
+                    input_ids = [(x[0], x[1], x[2]) for x in zip(cseqs, qseqs, rseqs)]
+                    cseqs_cl, qseqs_cl, rseqs_cl = self.cl_data.processed(input_ids, seqlen, self.num_c, self.num_q)
+                else:
+                    qseqs = [0 for x in range(len(rseqs))]
+                    input_ids = [(x[0], x[1], x[2]) for x in zip(cseqs, qseqs, rseqs)]
+                    cseqs_cl, qseqs_cl, rseqs_cl = self.cl_data.processed(input_ids, seqlen, self.num_c, self.num_q)
+                dori["cseqs_cl"].append(cseqs_cl)
+                dori["qseqs_cl"].append(qseqs_cl)
+                dori["rseqs_cl"].append(rseqs_cl)
 
             if self.qtest:
                 dqtest["qidxs"].append([int(_) for _ in row["qidxs"].split(",")])
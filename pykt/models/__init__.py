@@ -1,5 +1,9 @@
-from .evaluate_model import evaluate, evaluate_testset,evaluate_question,evaluate_splitpred_question,effective_fusion
+from .evaluate_model import evaluate, evaluate_testset,evaluate_stream,evaluate_question,evaluate_splitpred_question,effective_fusion
 from .train_model import train_model
 from .init_model import init_model,load_model
+from .optim_utils import init_optimizer
+from .prune_utils import load_prune_impt, prune_lorekt
+from .distill_utils import TeacherPredDataset, cache_teacher_preds, compare_models
+from .state_cache import KTStateCache, observe
 from .lpkt_utils import lpkt_evaluate_multi_ahead
 from .softmask_utils import impt_norm, compute_soft_mask, load_soft_mask, get_pretrain_overall_mask
\ No newline at end of file
@@ -0,0 +1,142 @@
+import os
+import collections
+import torch
+from ..datasets.que_data_loader import datasets_dic
+
+
+def extract_delta(backbone_state, finetuned_state, rank=0, atol=0.):
+    """the compact difference of a finetuned checkpoint from the pretrained backbone. Unchanged parameters are dropped,
+    tables whose rows changed only partly (e.g. the question and dataset embeddings) keep the changed rows, and with
+    rank > 0 the other matrices keep a rank-r SVD of their difference when it is smaller than the dense one
+
+    Args:
+        backbone_state (dict): state dict of the pretrained model
+        finetuned_state (dict): state dict of the finetuned model, with the same parameters
+        rank (int, optional): rank of the low-rank differences, 0 keeps them dense (exact). Defaults to 0.
+        atol (float, optional): differences up to atol are treated as unchanged. Defaults to 0.
+
+    Returns:
+        dict: name -> {"type": "dense", "diff"} or {"type": "rows", "index", "rows"} or {"type": "lowrank", "left", "right"}
+    """
+    delta = dict()
+    for name, value in finetuned_state.items():
+        base = backbone_state[name]
+        assert base.shape == value.shape, f"{name} has another shape in the finetuned checkpoint!"
+        if not torch.is_floating_point(value):
+            if not torch.equal(base, value):
+                delta[name] = {"type": "dense", "diff": value.clone()}
+            continue
+        diff = (value.float() - base.float()).cpu()
+        changed = diff.abs() > atol
+        if not changed.any():
+            continue
+        if diff.dim() == 2 and changed.any(dim=1).float().mean() < 0.5:
+            index = changed.any(dim=1).nonzero().squeeze(1)
+            delta[name] = {"type": "rows", "index": index, "rows": diff[index]}
+        elif diff.dim() == 2 and 0 < rank and rank * sum(diff.shape) < diff.numel():
+            u, s, vh = torch.linalg.svd(diff, full_matrices=False)
+            delta[name] = {"type": "lowrank", "left": u[:, :rank] * s[:rank], "right": vh[:rank]}
+        else:
+            delta[name] = {"type": "dense", "diff": diff}
+    return delta
+
+
+def delta_numel(delta):
+    """number of stored values of a delta"""
+    return sum(v.numel() for d in delta.values() for k, v in d.items() if k != "type")
+
+
+def apply_delta(param, base, entry):
+    """param = base + the difference of one parameter, in place"""
+    if entry["type"] == "dense" and not torch.is_floating_point(param):
+        param.copy_(entry["diff"])
+        return
+    param.copy_(base)
+    if entry["type"] == "dense":
+        param.add_(entry["diff"].to(param))
+    elif entry["type"] == "rows":
+        param.index_add_(0, entry["index"].to(param.device), entry["rows"].to(param))
+    else:
+        param.add_((entry["left"] @ entry["right"]).to(param))
+
+
+class AdapterLOREKT:
+    """one pretrained LoReKT backbone serving several finetuned datasets: the delta of a dataset (see extract_delta,
+    saved as {delta_dir}/{dataset_name}_delta.pt) is loaded on the first request of the dataset and applied to the
+    shared weights while its rows run; at most capacity deltas are resident, the least recently used ones are dropped.
+    A batch with several datasets is run one dataset group at a time. Callable as LOREKT on a batch, see predict_probs.
+
+    Args:
+        model (LOREKT): the pretrained backbone in eval mode
+        delta_dir (str): dir of the deltas
+        capacity (int, optional): max number of resident deltas. Defaults to 8.
+    """
+    def __init__(self, model, delta_dir, capacity=8):
+        self.model = model.module if hasattr(model, "module") else model
+        self.model_name = self.model.model_name
+        self.delta_dir = delta_dir
+        self.capacity = capacity
+        self.deltas = collections.OrderedDict()
+        self.params = dict(self.model.state_dict(keep_vars=True))
+        # the backbone values of the parameters changed by some delta, saved on the first change
+        self.base = dict()
+        self.active = None
+        self.loads = 0
+
+    def available(self):
+        return sorted(f[:-len("_delta.pt")] for f in os.listdir(self.delta_dir) if f.endswith("_delta.pt"))
+
+    def get_delta(self, dataset_name):
+        if dataset_name in self.deltas:
+            self.deltas.move_to_end(dataset_name)
+            return self.deltas[dataset_name]
+        path = os.path.join(self.delta_dir, f"{dataset_name}_delta.pt")
+        if not os.path.exists(path):
+            return None
+        print(f"loading the delta of {dataset_name} from {path} ...")
+        device = next(self.model.parameters()).device
+        delta = torch.load(path, map_location=device)
+        self.deltas[dataset_name] = delta
+        self.loads += 1
+        while len(self.deltas) > self.capacity:
+            evicted, _ = self.deltas.popitem(last=False)
+            if evicted == self.active:
+                self.activate(None)
+        return delta
+
+    def activate(self, dataset_name):
+        """set the shared weights to the finetuned ones of the dataset, None (or a dataset without delta) is the backbone"""
+        if dataset_name == self.active:
+            return
+        old = self.deltas.get(self.active, {"params": {}})["params"] if self.active is not None else {}
+        delta = self.get_delta(dataset_name) if dataset_name is not None else None
+        new = delta["params"] if delta is not None else {}
+        with torch.no_grad():
+            for name in old:
+                if name not in new:
+                    self.params[name].copy_(self.base[name])
+            for name, entry in new.items():
+                if name not in self.base:
+                    self.base[name] = self.params[name].detach().clone()
+                apply_delta(self.params[name], self.base[name], entry)
+        self.active = dataset_name if delta is not None else None
+
+    def soft_mask(self):
+        if self.active is None:
+            return None
+        return self.deltas[self.active].get("soft_mask")
+
+    def __call__(self, dcur):
+        """the predictions [bs, seqlen] of LOREKT.forward, each row with the weights of its dataset"""
+        dataset_ids = dcur["dataset_id"].long().cpu()
+        names = {v: k for k, v in datasets_dic.items()}
+        preds = None
+        for dataset_id in dataset_ids.unique().tolist():
+            rows = (dataset_ids == dataset_id).nonzero().squeeze(1)
+            self.activate(names.get(dataset_id))
+            sub = {k: v[rows] if torch.is_tensor(v) and v.dim() > 0 and v.size(0) == len(dataset_ids) else v for k, v in dcur.items()}
+            y = self.model(sub, soft_mask=self.soft_mask())
+            if preds is None:
+                preds = y.new_zeros(len(dataset_ids), y.size(1))
+            preds[rows.to(y.device)] = y
+        return preds
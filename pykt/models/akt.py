@@ -3,9 +3,9 @@ from torch import nn
 from torch.nn.init import xavier_uniform_
 from torch.nn.init import constant_
 import math
-import torch.nn.functional as F
 from enum import IntEnum
-import numpy as np
+from .akt_utils import distance_attention
+from .transformer_utils import causal_mask as get_src_mask
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -16,7 +16,7 @@ class Dim(IntEnum):
 
 class AKT(nn.Module):
     def __init__(self, n_question, n_pid, d_model, n_blocks, dropout, d_ff=256, 
-            kq_same=1, final_fc_dim=512, num_attn_heads=8, separate_qa=False, l2=1e-5, emb_type="qid", emb_path="", pretrain_dim=768):
+            kq_same=1, final_fc_dim=512, num_attn_heads=8, separate_qa=False, l2=1e-5, emb_type="qid", emb_path="", pretrain_dim=768, attn_chunk_size=0):
         super().__init__()
         """
         Input:
@@ -25,6 +25,7 @@ class AKT(nn.Module):
             num_attn_heads: number of heads in multi-headed attention
             d_ff : dimension for fully conntected net inside the basic block
             kq_same: if key query same, kq_same=1, else = 0
+            attn_chunk_size: number of queries per attention block, 0 means the whole sequence at once
         """
         self.model_name = "akt"
         self.n_question = n_question
@@ -51,7 +52,7 @@ class AKT(nn.Module):
 
         # Architecture Object. It contains stack of attention block
         self.model = Architecture(n_question=n_question, n_blocks=n_blocks, n_heads=num_attn_heads, dropout=dropout,
-                                    d_model=d_model, d_feature=d_model / num_attn_heads, d_ff=d_ff,  kq_same=self.kq_same, model_type=self.model_type, emb_type=self.emb_type)
+                                    d_model=d_model, d_feature=d_model / num_attn_heads, d_ff=d_ff,  kq_same=self.kq_same, model_type=self.model_type, emb_type=self.emb_type, attn_chunk_size=attn_chunk_size)
 
         self.out = nn.Sequential(
             nn.Linear(d_model + embed_l,
@@ -119,7 +120,7 @@ class AKT(nn.Module):
 
 class Architecture(nn.Module):
     def __init__(self, n_question,  n_blocks, d_model, d_feature,
-                 d_ff, n_heads, dropout, kq_same, model_type, emb_type):
+                 d_ff, n_heads, dropout, kq_same, model_type, emb_type, attn_chunk_size=0):
         super().__init__()
         """
             n_block : number of stacked blocks in the attention
@@ -133,12 +134,12 @@ class Architecture(nn.Module):
         if model_type in {'akt'}:
             self.blocks_1 = nn.ModuleList([
                 TransformerLayer(d_model=d_model, d_feature=d_model // n_heads,
-                                 d_ff=d_ff, dropout=dropout, n_heads=n_heads, kq_same=kq_same, emb_type=emb_type)
+                                 d_ff=d_ff, dropout=dropout, n_heads=n_heads, kq_same=kq_same, emb_type=emb_type, attn_chunk_size=attn_chunk_size)
                 for _ in range(n_blocks)
             ])
             self.blocks_2 = nn.ModuleList([
                 TransformerLayer(d_model=d_model, d_feature=d_model // n_heads,
-                                 d_ff=d_ff, dropout=dropout, n_heads=n_heads, kq_same=kq_same, emb_type=emb_type)
+                                 d_ff=d_ff, dropout=dropout, n_heads=n_heads, kq_same=kq_same, emb_type=emb_type, attn_chunk_size=attn_chunk_size)
                 for _ in range(n_blocks*2)
             ])
 
@@ -171,7 +172,7 @@ class Architecture(nn.Module):
 
 class TransformerLayer(nn.Module):
     def __init__(self, d_model, d_feature,
-                 d_ff, n_heads, dropout,  kq_same, emb_type):
+                 d_ff, n_heads, dropout,  kq_same, emb_type, attn_chunk_size=0):
         super().__init__()
         """
             This is a Basic Block of Transformer paper. It containts one Multi-head attention object. Followed by layer norm and postion wise feedforward net and dropout layer.
@@ -179,7 +180,7 @@ class TransformerLayer(nn.Module):
         kq_same = kq_same == 1
         # Multi-Head Attention Block
         self.masked_attn_head = MultiHeadAttention(
-            d_model, d_feature, n_heads, dropout, kq_same=kq_same, emb_type=emb_type)
+            d_model, d_feature, n_heads, dropout, kq_same=kq_same, emb_type=emb_type, attn_chunk_size=attn_chunk_size)
 
         # Two layer norm layer and two droput layer
         self.layer_norm1 = nn.LayerNorm(d_model)
@@ -208,9 +209,7 @@ class TransformerLayer(nn.Module):
         """
 
         seqlen, batch_size = query.size(1), query.size(0)
-        nopeek_mask = np.triu(
-            np.ones((1, 1, seqlen, seqlen)), k=mask).astype('uint8')
-        src_mask = (torch.from_numpy(nopeek_mask) == 0).to(device)
+        src_mask = get_src_mask(seqlen, mask, query.device)
         if mask == 0:  # If 0, zero-padding is needed.
             # Calls block.masked_attn_head.forward() method
             query2 = self.masked_attn_head(
@@ -231,13 +230,14 @@ class TransformerLayer(nn.Module):
 
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, d_model, d_feature, n_heads, dropout, kq_same, bias=True, emb_type="qid"):
+    def __init__(self, d_model, d_feature, n_heads, dropout, kq_same, bias=True, emb_type="qid", attn_chunk_size=0):
         super().__init__()
         """
         It has projection layer for getting keys, queries and values. Followed by attention and a connected layer.
         """
         self.d_model = d_model
         self.emb_type = emb_type
+        self.attn_chunk_size = attn_chunk_size
         if emb_type.endswith("avgpool"):
             # pooling
             #self.pool =  nn.AvgPool2d(pool_size, stride=1, padding=pool_size//2, count_include_pad=False, )
@@ -313,7 +313,7 @@ class MultiHeadAttention(nn.Module):
             if self.emb_type.find("pdiff") == -1:
                 pdiff = None
             scores = attention(q, k, v, self.d_k,
-                            mask, self.dropout, zero_pad, gammas, pdiff)
+                            mask, self.dropout, zero_pad, gammas, pdiff, self.attn_chunk_size)
 
             # concatenate heads and put through final linear layer
             concat = scores.transpose(1, 2).contiguous()\
@@ -331,58 +331,11 @@ class MultiHeadAttention(nn.Module):
         return scores
 
 
-def attention(q, k, v, d_k, mask, dropout, zero_pad, gamma=None, pdiff=None):
+def attention(q, k, v, d_k, mask, dropout, zero_pad, gamma=None, pdiff=None, chunk_size=0):
     """
     This is called by Multi-head atention object to find the values.
     """
-    # d_k: 每一个头的dim
-    scores = torch.matmul(q, k.transpose(-2, -1)) / \
-        math.sqrt(d_k)  # BS, 8, seqlen, seqlen
-    bs, head, seqlen = scores.size(0), scores.size(1), scores.size(2)
-
-    x1 = torch.arange(seqlen).expand(seqlen, -1).to(device)
-    x2 = x1.transpose(0, 1).contiguous()
-
-    with torch.no_grad():
-        scores_ = scores.masked_fill(mask == 0, -1e32)
-        scores_ = F.softmax(scores_, dim=-1)  # BS,8,seqlen,seqlen
-        scores_ = scores_ * mask.float().to(device) # 结果和上一步一样
-        distcum_scores = torch.cumsum(scores_, dim=-1)  # bs, 8, sl, sl
-        disttotal_scores = torch.sum(
-            scores_, dim=-1, keepdim=True)  # bs, 8, sl, 1 全1
-        # print(f"distotal_scores: {disttotal_scores}")
-        position_effect = torch.abs(
-            x1-x2)[None, None, :, :].type(torch.FloatTensor).to(device)  # 1, 1, seqlen, seqlen 位置差值
-        # bs, 8, sl, sl positive distance
-        dist_scores = torch.clamp(
-            (disttotal_scores-distcum_scores)*position_effect, min=0.) # score <0 时，设置为0
-        dist_scores = dist_scores.sqrt().detach()
-    m = nn.Softplus()
-    gamma = -1. * m(gamma).unsqueeze(0)  # 1,8,1,1 一个头一个gamma参数， 对应论文里的theta
-    # Now after do exp(gamma*distance) and then clamp to 1e-5 to 1e5
-    if pdiff == None:
-        total_effect = torch.clamp(torch.clamp(
-            (dist_scores*gamma).exp(), min=1e-5), max=1e5) # 对应论文公式1中的新增部分
-    else:
-        diff = pdiff.unsqueeze(1).expand(pdiff.shape[0], dist_scores.shape[1], pdiff.shape[1], pdiff.shape[2])
-        diff = diff.sigmoid().exp()
-        total_effect = torch.clamp(torch.clamp(
-            (dist_scores*gamma*diff).exp(), min=1e-5), max=1e5) # 对应论文公式1中的新增部分
-    scores = scores * total_effect
-
-    scores.masked_fill_(mask == 0, -1e32)
-    scores = F.softmax(scores, dim=-1)  # BS,8,seqlen,seqlen
-    # print(f"before zero pad scores: {scores.shape}")
-    # print(zero_pad)
-    if zero_pad:
-        pad_zero = torch.zeros(bs, head, 1, seqlen).to(device)
-        scores = torch.cat([pad_zero, scores[:, :, 1:, :]], dim=2) # 第一行score置0
-    # print(f"after zero pad scores: {scores}")
-    scores = dropout(scores)
-    output = torch.matmul(scores, v)
-    # import sys
-    # sys.exit()
-    return output
+    return distance_attention(q, k, v, d_k, mask, dropout, zero_pad, gamma, pdiff, chunk_size)
 
 
 class LearnablePositionalEmbedding(nn.Module):
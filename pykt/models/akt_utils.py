@@ -0,0 +1,22 @@
+from .transformer_utils import DistanceDecay, attention
+
+def distance_attention(q, k, v, d_k, mask, dropout, zero_pad, gamma, pdiff=None, chunk_size=0):
+    """
+    The monotonic attention of AKT, i.e. the shared attention with the DistanceDecay score modifier. The masks and the
+    position effect are cached per (seqlen, device), the distance term is computed in place, and the queries can be
+    processed in blocks of chunk_size so only [bs, head, chunk_size, seqlen] intermediates are alive at the same time.
+
+    Args:
+        q, k, v (torch.tensor): [bs, head, seqlen, d_k]
+        d_k (int): dim of each head
+        mask (torch.tensor): [1, 1, seqlen, seqlen] bool mask
+        dropout (nn.Dropout): dropout on the attention weights
+        zero_pad (bool): the first query attends to nothing
+        gamma (torch.tensor): [head, 1, 1] decay rate of each head
+        pdiff (torch.tensor, optional): [bs, seqlen, 1] difficulty of the questions. Defaults to None.
+        chunk_size (int, optional): number of queries per block, 0 means no chunking. Defaults to 0.
+
+    Returns:
+        torch.tensor: [bs, head, seqlen, d_k]
+    """
+    return attention(q, k, v, d_k, mask, dropout, zero_pad, modifiers=[DistanceDecay(gamma, pdiff)], chunk_size=chunk_size)
@@ -3,7 +3,7 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 import numpy as np
-from .utils import ut_mask
+from .utils import ut_mask, linear_readout
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -72,7 +72,11 @@ class ATKT(nn.Module):
         return final_output
 
 
-    def forward(self, skill, answer, perturbation=None):
+    def forward(self, skill, answer, perturbation=None, target=None):
+        """
+        target: the concepts to predict, [batch_size, seqlen]. If given, only the logits of the targets are computed
+        and the prediction of shape [batch_size, seqlen] is returned instead of the one of all concepts.
+        """
         emb_type = self.emb_type
         r = answer
         
@@ -96,7 +100,10 @@ class ATKT(nn.Module):
         # print(f"out: {out.shape}")
         out=self.attention_module(out)
         # print(f"after attn out: {out.shape}")
-        res = self.sig(self.fc(self.dropout_layer(out)))
+        if target is not None:
+            res = self.sig(linear_readout(self.fc, self.dropout_layer(out), target))
+        else:
+            res = self.sig(self.fc(self.dropout_layer(out)))
 
         # res = res[:, :-1, :]
         # pred_res = self._get_next_pred(res, skill)
@@ -0,0 +1,118 @@
+import os
+import time
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset, DataLoader
+from sklearn import metrics
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# the models whose predictions of the 1~seqlen-1 interactions predict_probs reads, e.g. IEKT returns flat logits
+# of the selected interactions and LPKT / GNN4KT have no predict_one_step
+PROB_MODELS = ["lorekt", "gpt4kt", "qdkt", "qikt"]
+
+def predict_probs(model, data):
+    """the predictions of the 1~seqlen-1 interactions [bs, seqlen-1] of a PROB_MODELS member (eval mode)
+
+    Args:
+        model (nn.Module): the model, optionally wrapped by DDP
+        data (dict): a batch of KTQueDataset
+
+    Returns:
+        torch.tensor: [bs, seqlen-1]
+    """
+    module = model.module if hasattr(model, "module") else model
+    if module.model_name not in PROB_MODELS:
+        raise ValueError(f"the predictions of {module.model_name} are not supported, the models are {PROB_MODELS}")
+    if module.model_name in ["lorekt", "gpt4kt"]:
+        return module(data)[:, 1:]
+    return module.predict_one_step(data)
+
+
+class TeacherPredDataset(Dataset):
+    """a dataset whose items carry the cached predictions of the teacher (teacher_preds, [seqlen-1]), see cache_teacher_preds
+
+    Args:
+        dataset (Dataset): the train dataset, e.g. KTQueDataset
+        teacher_preds (torch.tensor): [len(dataset), seqlen-1]
+    """
+    def __init__(self, dataset, teacher_preds):
+        assert len(dataset) == len(teacher_preds), "the cached teacher predictions do not match the dataset!"
+        self.dataset = dataset
+        self.teacher_preds = teacher_preds
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        dcur = dict(self.dataset[index])
+        dcur["teacher_preds"] = self.teacher_preds[index]
+        return dcur
+
+
+def cache_teacher_preds(teacher, dataset, batch_size, cache_path):
+    """the first pass of distillation, the teacher predictions of every row of the dataset are computed once (by rank 0)
+    and saved to cache_path, so the teacher is not run again in every epoch. An existing cache file is reused.
+
+    Args:
+        teacher (nn.Module): the teacher model
+        dataset (Dataset): the train dataset
+        batch_size (int): batch size of the pass
+        cache_path (str): the .pt file of the predictions
+
+    Returns:
+        torch.tensor: [len(dataset), seqlen-1]
+    """
+    rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+    if rank == 0 and not os.path.exists(cache_path):
+        print(f'caching the teacher predictions to {cache_path} ...')
+        teacher.eval()
+        preds = []
+        with torch.no_grad():
+            for data in DataLoader(dataset, batch_size=batch_size, shuffle=False):
+                preds.append(predict_probs(teacher, data).float().cpu())
+        torch.save(torch.cat(preds), cache_path)
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+    return torch.load(cache_path, map_location="cpu")
+
+
+def compare_models(models, data_loader):
+    """auc, acc and throughput of several models (e.g. the teacher and the distilled student) on the same data
+
+    Args:
+        models (dict): name -> model
+        data_loader (DataLoader): the evaluation data
+
+    Returns:
+        dict: name -> {"auc", "acc", "seconds", "interactions_per_second", "params"}
+    """
+    report = dict()
+    for name, model in models.items():
+        model.eval()
+        y_trues, y_scores = [], []
+        seconds, num_interactions = 0., 0
+        with torch.no_grad():
+            for data in data_loader:
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                start = time.time()
+                y = predict_probs(model, data)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                seconds += time.time() - start
+                sm = data["smasks"].to(y.device)
+                y_scores.append(torch.masked_select(y, sm).cpu())
+                y_trues.append(torch.masked_select(data["shft_rseqs"].to(y.device), sm).cpu())
+                num_interactions += int(data["masks"].sum())
+        ts, ps = torch.cat(y_trues).numpy(), torch.cat(y_scores).numpy()
+        report[name] = {
+            "auc": metrics.roc_auc_score(y_true=ts, y_score=ps),
+            "acc": metrics.accuracy_score(ts, [1 if p >= 0.5 else 0 for p in ps]),
+            "seconds": seconds,
+            "interactions_per_second": num_interactions / max(seconds, 1e-12),
+            "params": sum(p.numel() for p in model.parameters()),
+        }
+        print(f"{name}: auc: {report[name]['auc']:.4f}, acc: {report[name]['acc']:.4f}, "
+              f"{report[name]['interactions_per_second']:.1f} interactions/s, params: {report[name]['params']}")
+    return report
@@ -5,6 +5,7 @@ import torch
 import pickle
 
 from torch.nn import Module, Embedding, LSTM, Linear, Dropout
+from .utils import linear_readout
 
 
 class DKT(Module):
@@ -38,7 +39,11 @@ class DKT(Module):
         with open(filename, 'ab') as f:
             pickle.dump(torch.cat(tensors_to_cat, dim=0).cpu(), f)
 
-    def forward(self, q, r):
+    def forward(self, q, r, target=None):
+        """
+        target: the concepts to predict, [batch_size, seqlen]. If given, only the logits of the targets are computed
+        and the prediction of shape [batch_size, seqlen] is returned instead of the one of all concepts.
+        """
         # print(f"q.shape is {q.shape}")
         emb_type = self.emb_type
         if emb_type == "qid":
@@ -50,7 +55,29 @@ class DKT(Module):
         # print(f"h: {h.shape}")
         # h.register_hook(lambda grad: self.backward_gradient_reporting_template(grad, self._temp_filename))
         h = self.dropout_layer(h)
+        if target is not None:
+            return torch.sigmoid(linear_readout(self.out_layer, h, target))
         y = self.out_layer(h)
         y = torch.sigmoid(y)
 
-        return y
\ No newline at end of file
+        return y
+
+    def init_state(self, batch_size):
+        """the knowledge state of new students, the (h, c) of the LSTM with the batch first"""
+        weight = self.out_layer.weight
+        h = torch.zeros(batch_size, self.hidden_size, device=weight.device, dtype=weight.dtype)
+        return (h, h.clone())
+
+    def step(self, state, q, r=None):
+        """
+        one interaction of each student from the cached state, instead of replaying the history.
+        q: the concepts [batch_size], r: the responses [batch_size], None only predicts.
+        Returns the new state and the prediction of q made before its response [batch_size].
+        """
+        h, c = state
+        prob = torch.sigmoid(linear_readout(self.out_layer, self.dropout_layer(h), q))
+        if r is None:
+            return state, prob
+        xemb = self.interaction_emb(q + self.num_c * r)
+        _, (h, c) = self.lstm_layer(xemb.unsqueeze(1), (h.unsqueeze(0).contiguous(), c.unsqueeze(0).contiguous()))
+        return (h.squeeze(0), c.squeeze(0)), prob
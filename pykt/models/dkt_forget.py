@@ -1,5 +1,6 @@
 import torch
 from torch.nn import Module, Embedding, LSTM, Linear, Dropout
+from .utils import linear_readout
 
 device = "cpu" if not torch.cuda.is_available() else "cuda"
 
@@ -23,7 +24,11 @@ class DKTForget(Module):
         self.out_layer = Linear(self.hidden_size + ntotal, self.num_c)
         
 
-    def forward(self, q, r, dgaps):
+    def forward(self, q, r, dgaps, target=None):
+        """
+        target: the concepts to predict, [batch_size, seqlen]. If given, only the logits of the targets are computed
+        and the prediction of shape [batch_size, seqlen] is returned instead of the one of all concepts.
+        """
         q, r = q.to(device), r.to(device)
         emb_type = self.emb_type
         if emb_type == "qid":
@@ -34,6 +39,8 @@ class DKTForget(Module):
         h, _ = self.lstm_layer(theta_in)
         theta_out = self.c_integration(h, dgaps["shft_rgaps"].to(device).long(), dgaps["shft_sgaps"].to(device).long(), dgaps["shft_pcounts"].to(device).long())
         theta_out = self.dropout_layer(theta_out)
+        if target is not None:
+            return torch.sigmoid(linear_readout(self.out_layer, theta_out, target.to(device)))
         y = self.out_layer(theta_out)
         y = torch.sigmoid(y)
 
@@ -1,5 +1,6 @@
 import torch
 from torch.nn import Module, Embedding, LSTM, Linear, Dropout
+from .utils import linear_readout
 
 class DKTPlus(Module):
     def __init__(self, num_c, emb_size, lambda_r, lambda_w1, lambda_w2, dropout=0.1, emb_type="qid", emb_path="", pretrain_dim=768):
@@ -20,7 +21,11 @@ class DKTPlus(Module):
         self.out_layer = Linear(self.hidden_size, self.num_c)
         
 
-    def forward(self, q, r):
+    def forward(self, q, r, target=None):
+        """
+        target: the concepts to predict, [batch_size, seqlen]. If given, only the logits of the targets are computed
+        and the prediction of shape [batch_size, seqlen] is returned instead of the one of all concepts.
+        """
         emb_type = self.emb_type
         if emb_type == "qid":
             x = q + self.num_c * r
@@ -28,6 +33,8 @@ class DKTPlus(Module):
 
         h, _ = self.lstm_layer(xemb)
         h = self.dropout_layer(h)
+        if target is not None:
+            return torch.sigmoid(linear_readout(self.out_layer, h, target))
         y = self.out_layer(h)
         y = torch.sigmoid(y)
 
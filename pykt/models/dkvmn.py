@@ -79,4 +79,31 @@ class DKVMN(Module):
         if not qtest:
             return p
         else:
-            return p, f
\ No newline at end of file
+            return p, f
+
+    def init_state(self, batch_size):
+        """the knowledge state of new students, the value memory Mvt"""
+        return (self.Mv0.unsqueeze(0).repeat(batch_size, 1, 1),)
+
+    def step(self, state, q, r=None):
+        """
+        one interaction of each student from the cached state, instead of replaying the history.
+        q: the concepts [batch_size], r: the responses [batch_size], None only predicts.
+        Returns the new state and the prediction of q made before its response [batch_size].
+        """
+        Mvt, = state
+        k = self.k_emb_layer(q)
+        w = torch.softmax(torch.matmul(k, self.Mk.T), dim=-1)
+
+        # Read Process
+        f = torch.tanh(self.f_layer(torch.cat([(w.unsqueeze(-1) * Mvt).sum(-2), k], dim=-1)))
+        prob = torch.sigmoid(self.p_layer(self.dropout_layer(f))).squeeze(-1)
+        if r is None:
+            return state, prob
+
+        # Write Process
+        v = self.v_emb_layer(q + self.num_c * r)
+        e = torch.sigmoid(self.e_layer(v))
+        a = torch.tanh(self.a_layer(v))
+        Mvt = Mvt * (1 - (w.unsqueeze(-1) * e.unsqueeze(1))) + (w.unsqueeze(-1) * a.unsqueeze(1))
+        return (Mvt,), prob
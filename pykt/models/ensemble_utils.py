@@ -0,0 +1,88 @@
+import copy
+import time
+import numpy as np
+import torch
+from sklearn import metrics
+from .distill_utils import predict_probs
+from .export_utils import LOREKTInference, dcur_to_inputs
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def check_compatible(models):
+    """the members of an ensemble must have the same model and the same parameter shapes"""
+    names = [m.module.model_name if hasattr(m, "module") else m.model_name for m in models]
+    assert len(set(names)) == 1, f"the checkpoints are of different models: {names}!"
+    shapes = [{k: tuple(v.shape) for k, v in m.state_dict().items()} for m in models]
+    for i, shape in enumerate(shapes[1:], 1):
+        assert shape == shapes[0], f"the checkpoint {i} has other parameter shapes than the checkpoint 0!"
+
+
+class StackedLOREKT:
+    """the members of a LoReKT ensemble as one module with stacked weights, every batch is run through all of them
+    by torch.func.vmap over LOREKTInference (which has no activation checkpointing, unsupported by vmap)
+
+    Args:
+        models (list[LOREKT]): the members, on the same device
+    """
+    def __init__(self, models):
+        from torch.func import stack_module_state, functional_call, vmap
+        members = [LOREKTInference(m).eval() for m in models]
+        self.params, self.buffers = stack_module_state(members)
+        base = copy.deepcopy(members[0]).to("meta")
+        def run(params, buffers, inputs):
+            return functional_call(base, (params, buffers), inputs)
+        self.run = vmap(run, in_dims=(0, 0, None))
+
+    def __call__(self, data):
+        """the predictions of the members [K, bs, seqlen-1]"""
+        inputs = tuple(x.to(device) for x in dcur_to_inputs(data))
+        return self.run(self.params, self.buffers, inputs)[:, :, 1:]
+
+
+def ensemble_predict(models, data, stacked=None):
+    """the predictions [K, bs, seqlen-1] of the K members on one batch, the batch is moved to the device once"""
+    data = {k: v.to(device) if torch.is_tensor(v) else v for k, v in data.items()}
+    if stacked is not None:
+        return stacked(data)
+    return torch.stack([predict_probs(model, data) for model in models])
+
+
+def evaluate_ensemble(models, names, test_loader, strategy="loop"):
+    """evaluate K compatible checkpoints in a single pass over the test data, each batch is loaded once and run
+    through all the members, the ensemble prediction is the mean of their probabilities
+
+    Args:
+        models (list[nn.Module]): the members in eval mode, PROB_MODELS members (see predict_probs)
+        names (list[str]): names of the members in the report, e.g. the checkpoint dirs
+        test_loader (DataLoader): batches of KTQueDataset
+        strategy (str, optional): loop runs the members one after another, vmap stacks the weights of LoReKT
+            members and runs them as one batched module. Defaults to "loop".
+
+    Returns:
+        dict: {name: {"auc", "acc"}} of the members and the "ensemble", and the "seconds" of the pass
+    """
+    check_compatible(models)
+    for model in models:
+        model.eval()
+    stacked = StackedLOREKT(models) if strategy == "vmap" else None
+    y_trues, y_scores = [], []
+    start = time.time()
+    with torch.no_grad():
+        for data in test_loader:
+            ys = ensemble_predict(models, data, stacked)
+            sm = data["smasks"].to(ys.device)
+            y_scores.append(torch.stack([torch.masked_select(y, sm) for y in ys]).cpu())
+            y_trues.append(torch.masked_select(data["shft_rseqs"].to(ys.device), sm).cpu())
+    seconds = time.time() - start
+    ts, ps = torch.cat(y_trues).numpy(), torch.cat(y_scores, dim=1).numpy()
+
+    report = dict()
+    for name, p in list(zip(names, ps)) + [("ensemble", ps.mean(0))]:
+        report[name] = {
+            "auc": metrics.roc_auc_score(y_true=ts, y_score=p),
+            "acc": metrics.accuracy_score(ts, np.where(p >= 0.5, 1, 0)),
+        }
+        print(f"{name}: auc: {report[name]['auc']:.4f}, acc: {report[name]['acc']:.4f}")
+    report["seconds"] = seconds
+    return report
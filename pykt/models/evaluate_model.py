@@ -1,10 +1,11 @@
 import numpy as np
 import torch
 from torch import nn
-from torch.nn.functional import one_hot
 from sklearn import metrics
 from pykt.config import que_type_models
 from ..datasets.lpkt_utils import generate_time2idx
+from .utils import gather_readout
+from ..datasets.forget_utils import load_forget_features, FORGET_KEYS, TIME_KEYS
 import pandas as pd
 import os
 import json
@@ -177,7 +178,7 @@ def evaluate_testset(model, test_loader, model_name, save_path="", dataset_name=
                     pickle.dump(data,f)
                 '''
                 y, rpreds, qh = model(dcur)
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y = gather_readout(y, cshft)
             elif model_name in ["bakt_qikt"]:
                 y = model(dcur)
             elif model_name in ["bakt_time"]:
@@ -216,11 +217,9 @@ def evaluate_testset(model, test_loader, model_name, save_path="", dataset_name=
                 if q.size(1) != 0:
                     c,cshft = q,qshft#question level 
             elif model_name in ["dkt", "dkt+"]:
-                y = model(c.long(), r.long())
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y = model(c.long(), r.long(), target=cshft)
             elif model_name in ["dkt_forget"]:
-                y = model(c.long(), r.long(), dgaps)
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y = model(c.long(), r.long(), dgaps, target=cshft)
             elif model_name in ["dkvmn","deep_irt", "skvmn","deep_irt"]:
                 y = model(cc.long(), cr.long())
                 y = y[:,1:]
@@ -233,15 +232,12 @@ def evaluate_testset(model, test_loader, model_name, save_path="", dataset_name=
                 y, reg_loss = model(cc.long(), cr.long(), cq.long())
                 y = y[:,1:]
             elif model_name in ["atkt", "atktfix"]:
-                y, _ = model(c.long(), r.long())
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y, _ = model(c.long(), r.long(), target=cshft)
             elif model_name == "gkt":
                 y = model(cc.long(), cr.long())
             elif model_name == "gnn4kt":
-                y = model(dcur)
-                if model.module.emb_type.find("lstm") != -1:
-                    y = (y * one_hot(qshft.long(), model.module.num_q)).sum(-1)
-                else:
+                y = model(dcur, readout=True)
+                if model.module.emb_type.find("lstm") == -1:
                     y = y[:, 1:]
                 c,cshft = q,qshft#question level 
             elif model_name == "lpkt":
@@ -289,6 +285,30 @@ def evaluate_testset(model, test_loader, model_name, save_path="", dataset_name=
     #     pd.to_pickle(dres, save_path+".pkl")
     return auc, acc
 
+def evaluate_stream(model, stream_loader, soft_mask=None):
+    """auc and acc of LOREKT on whole student histories fed segment by segment (datasets.que_stream_loader.KTQueStreamLoader),
+    with mem_len > 0 each segment attends to the memory of the previous ones of its lane, every interaction except the
+    first one of a student is predicted once, as in the window evaluation but without recomputing the overlapping windows.
+    """
+    module = model.module if hasattr(model, "module") else model
+    module.eval()
+    module.reset_mems()
+    y_trues, y_scores = [], []
+    with torch.no_grad():
+        for dcur in stream_loader:
+            y = module(dcur, soft_mask=soft_mask)[:, 1:]
+            sm = dcur["smasks"].to(y.device)
+            y_scores.append(torch.masked_select(y, sm).detach().cpu().numpy())
+            y_trues.append(torch.masked_select(dcur["shft_rseqs"].to(y.device), sm).detach().cpu().numpy())
+    module.reset_mems()
+    ts = np.concatenate(y_trues, axis=0)
+    ps = np.concatenate(y_scores, axis=0)
+    print(f"ts.shape: {ts.shape}, ps.shape: {ps.shape}")
+    auc = metrics.roc_auc_score(y_true=ts, y_score=ps)
+    prelabels = [1 if p >= 0.5 else 0 for p in ps]
+    acc = metrics.accuracy_score(ts, prelabels)
+    return auc, acc
+
 def evaluate(model, test_loader, model_name, save_path="", dataset_name="", fold="", attn_cnt_path=""):
     if save_path != "":
         fout = open(save_path, "w", encoding="utf8")
@@ -332,7 +352,7 @@ def evaluate(model, test_loader, model_name, save_path="", dataset_name="", fold
                     pickle.dump(data,f)
                 '''
                 y, rpreds, qh = model(dcur)
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y = gather_readout(y, cshft)
             elif model_name in ["bakt_qikt"]:
                 y = model(dcur)
             elif model_name in ["bakt_time"]:
@@ -365,11 +385,9 @@ def evaluate(model, test_loader, model_name, save_path="", dataset_name="", fold
                 if q.size(1) != 0:
                     c,cshft = q,qshft#question level 
             elif model_name in ["dkt", "dkt+"]:
-                y = model(c.long(), r.long())
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y = model(c.long(), r.long(), target=cshft)
             elif model_name in ["dkt_forget"]:
-                y = model(c.long(), r.long(), dgaps)
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y = model(c.long(), r.long(), dgaps, target=cshft)
             elif model_name in ["dkvmn","deep_irt", "skvmn","deep_irt"]:
                 y = model(cc.long(), cr.long())
                 y = y[:,1:]
@@ -382,15 +400,12 @@ def evaluate(model, test_loader, model_name, save_path="", dataset_name="", fold
                 y, reg_loss = model(cc.long(), cr.long(), cq.long())
                 y = y[:,1:]
             elif model_name in ["atkt", "atktfix"]:
-                y, _ = model(c.long(), r.long())
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y, _ = model(c.long(), r.long(), target=cshft)
             elif model_name == "gkt":
                 y = model(cc.long(), cr.long())
             elif model_name == "gnn4kt":
-                y = model(dcur)
-                if model.module.emb_type.find("lstm") != -1:
-                    y = (y * one_hot(qshft.long(), model.module.num_q)).sum(-1)
-                else:
+                y = model(dcur, readout=True)
+                if model.module.emb_type.find("lstm") == -1:
                     y = y[:, 1:]
                 c,cshft = q,qshft#question level 
             elif model_name == "lpkt":
@@ -737,16 +752,13 @@ def evaluate_question(model, test_loader, model_name, fusion_type=["early_fusion
                 es = torch.cat((start_hemb, es), dim=1) # add the first hidden emb  
             elif model_name in ["cdkt"]:
                 y, _, _ = model(dcurori)#c.long(), r.long(), q.long())
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y = gather_readout(y, cshft)
             elif model_name in ["dkt", "dkt+"]:
-                y, _, _ = model(c.long(), r.long())
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y = model(c.long(), r.long(), target=cshft)
             elif model_name in ["dkt_forget"]:
-                y = model(c.long(), r.long(), dgaps)
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y = model(c.long(), r.long(), dgaps, target=cshft)
             elif model_name in ["atkt", "atktfix"]:
-                y, _ = model(c.long(), r.long())
-                y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+                y, _ = model(c.long(), r.long(), target=cshft)
             elif model_name == "gkt":
                 y = model(cc.long(), cr.long())
             elif model_name == "hawkes":
@@ -840,200 +852,16 @@ def evaluate_question(model, test_loader, model_name, fusion_type=["early_fusion
     return aucs, accs
 
 
-def log2(t):
-    import math
-    return round(math.log(t+1, 2))
-
-def MIKT_calC(row, data_config):
-    uid = row["uid"]
-    repeated_gap, sequence_gap, past_counts, sequence_it, t_label, pret_label, cit_label = [], [], [], [], [], [],[]
-    # default: concepts
-    skills = row["concepts"].split(",")
-    timestamps = row["timestamps"].split(",")
-    dpreskill, dlastskill, dcount = dict(), dict(), dict()
-    pret, double_pret = None, None
-    cnt = 0
-    for idx,(s, t) in enumerate(zip(skills, timestamps)):
-        s, t = int(s), int(t)
-        if s not in dlastskill or s == -1:
-            curRepeatedGap = 0
-            curCIt = 0
-            dlastskill[s] = -1
-        else:
-            curRepeatedGap = log2((t - dlastskill[s]) / 1000 / 60) + 1 # minutes
-            if dpreskill[s] == -1:
-                curCIt = 0.5
-            else:
-                precit = int((t - dlastskill[s]))/1000
-                double_precit = int((t - dpreskill[s]))/1000
-                curCIt = round(1 - ((precit + 0.01)/(double_precit + 0.01)),2)
-        dpreskill[s] = dlastskill[s]
-        dlastskill[s] = t
-
-        repeated_gap.append(curRepeatedGap)
-        cit_label.append(curCIt)
-
-        if pret == None or t == -1:
-            if t == -1:
-                cnt += 1
-            curLastGap = 0
-            curLastIt = 0
-            curPreT = 0
-            if idx == 0:
-                curLableT = 0
-                double_pret = t
-            else:
-                if cnt == 2:
-                    t_label[-1] = 1
-                else:
-                    curLableT = 0
-
-        else:
-            curLastGap = log2((t - pret) / 1000 / 60) + 1
-            # curLastIt = min(int((t - pret) / 1000 / 60) + 1,43200)
-            curLastIt = int((t - pret)) / 1000
-            curPreIt = int((pret - double_pret))/1000
-            curPostIt = int((t - double_pret))/1000
-            curLableT = round((curPreIt+0.01)/(curPostIt+0.01),2)
-            curPreT = round(1 - ((curLastIt + 0.01)/(curPostIt + 0.01)),2)
-            double_pret = pret
-        pret = t
-        sequence_gap.append(curLastGap)
-        sequence_it.append(curLastIt)
-        t_label.append(curLableT)
-        pret_label.append(curPreT)
-        
-        dcount.setdefault(s, 0)
-        ccount = log2(dcount[s])
-        ccount = data_config["num_pcount"] - 1 if ccount >= data_config["num_pcount"] else ccount
-        past_counts.append(ccount)
-        dcount[s] += 1
-    t_label = [0]+t_label[2:]+[1]
-    pret_label = [0, 0.5]+pret_label[2:]
-
-    return repeated_gap, sequence_gap, past_counts, sequence_it, t_label, pret_label, cit_label
-
-def calC(row, data_config):
-    repeated_gap, sequence_gap, past_counts = [], [], []
-    uid = row["uid"]
-    # default: concepts
-    skills = row["concepts"].split(",")
-    timestamps = row["timestamps"].split(",")
-    dlastskill, dcount = dict(), dict()
-    pret = None
-    idx = -1
-    for s, t in zip(skills, timestamps):
-        idx += 1
-        s, t = int(s), int(t)
-        if s not in dlastskill or s == -1:
-            curRepeatedGap = 0
-        else:
-            curRepeatedGap = log2((t - dlastskill[s]) / 1000 / 60) + 1 # minutes
-        dlastskill[s] = t
-
-        repeated_gap.append(curRepeatedGap)
-        if pret == None or t == -1:
-            curLastGap = 0
-        else:
-            curLastGap = log2((t - pret) / 1000 / 60) + 1
-        pret = t
-        sequence_gap.append(curLastGap)
-
-        dcount.setdefault(s, 0)
-        ccount = log2(dcount[s])
-        ccount = data_config["num_pcount"] - 1 if ccount >= data_config["num_pcount"] else ccount
-        past_counts.append(ccount)
-        
-        dcount[s] += 1
-    return repeated_gap, sequence_gap, past_counts    
-
-def MIKT_calC_INDEX(row, data_config):
-    repeated_gap, sequence_gap, past_counts, sequence_it, t_label, pret_label, cit_label = [], [], [], [], [], [],[]
-    uid = row["uid"]
-    # default: concepts
-    skills = row["concepts"].split(",")
-    # print(f"skills:{skills}")
-    timestamps = [i for i in range(len(skills))]
-    dpreskill, dlastskill, dcount = dict(), dict(), dict()
-    pret, double_pret = None, None
-    cnt = 0
-
-    for idx,(s, t) in enumerate(zip(skills, timestamps)):
-        s, t = int(s), int(t)
-        if s not in dlastskill or s == -1:
-            curRepeatedGap = 0
-            curCIt = 0
-            dlastskill[s] = -1
-        else:
-            curRepeatedGap = (t - dlastskill[s])# minutes
-            if dpreskill[s] == -1:
-                # print(f"s:{s}")
-                curCIt = 0.5
-            else:
-                # print(f"s:{s}")
-                precit = int((t - dlastskill[s]))
-                double_precit = int((t - dpreskill[s]))
-                curCIt = round(1 - ((precit + 0.01)/(double_precit + 0.01)),2)
-        dpreskill[s] = dlastskill[s]
-        dlastskill[s] = t
-
-        curRepeatedGap = data_config["num_rgap"] - 1 if curRepeatedGap >= data_config["num_rgap"] else curRepeatedGap
-        repeated_gap.append(curRepeatedGap)
-        cit_label.append(curCIt)
-
-        if pret == None or t == -1:
-            if t == -1:
-                cnt += 1
-            curLastGap = 0
-            curLastIt = 0
-            curPreT = 0
-            if idx == 0:
-                curLableT = 0
-                double_pret = t
-            else:
-                if cnt == 2:
-                    t_label[-1] = 1
-                else:
-                    curLableT = 0
-
-        else:
-            curLastGap = (t - pret) 
-            curLastIt = int((t - pret)) 
-            curPreIt = int((pret - double_pret))
-            curPostIt = int((t - double_pret))
-            curLableT = round((curPreIt+0.01)/(curPostIt+0.01),2)
-            curPreT = round(1 - ((curLastIt + 0.01)/(curPostIt + 0.01)),2)
-            double_pret = pret
-        pret = t
-        sequence_gap.append(curLastGap)
-        sequence_it.append(curLastIt)
-        t_label.append(curLableT)
-        pret_label.append(curPreT)
-
-        dcount.setdefault(s, 0)
-        ccount = dcount[s]
-        ccount = data_config["num_pcount"] - 1 if ccount >= data_config["num_pcount"] else ccount
-        past_counts.append(ccount)
-
-    t_label = [0]+t_label[2:]+[1]
-    pret_label = [0, 0.5]+pret_label[2:]
-
-    return repeated_gap, sequence_gap, past_counts, sequence_it, t_label, pret_label, cit_label       
-
-def get_info_dkt_forget(row, data_config, model_name, dataset_name):
-    dforget = dict()
+def get_info_dkt_forget(forget_feats, idx, data_config, model_name, index_time=False):
+    """the forgetting features of one row of the test file, clipped to the embedding sizes of the model"""
     if model_name not in ["mikt"]:
-        rgap, sgap, pcount = calC(row, data_config)
-
-        ## TODO
-        dforget["rgaps"], dforget["sgaps"], dforget["pcounts"] = rgap, sgap, pcount
+        dforget = forget_feats.row(idx, FORGET_KEYS)
     else:
-        if dataset_name not in ["assist2009", "assist2015"]:
-            rgap, sgap, pcount, its, tlabel, pretlabel, cit_label = MIKT_calC(row, data_config)
-        else:
-            rgap, sgap, pcount, its, tlabel, pretlabel, cit_label = MIKT_calC_INDEX(row, data_config)
-        dforget["rgaps"], dforget["sgaps"], dforget["pcounts"], dforget["its"], dforget["tlabel"], dforget["pretlabel"], dforget["citlabel"] = rgap, sgap, pcount, its, tlabel, pretlabel, cit_label        
-    return dforget
+        dforget = forget_feats.row(idx, FORGET_KEYS + TIME_KEYS)
+        if index_time:
+            dforget["rgaps"] = np.minimum(dforget["rgaps"], data_config["num_rgap"] - 1)
+    dforget["pcounts"] = np.minimum(dforget["pcounts"], data_config["num_pcount"] - 1)
+    return {key: dforget[key].tolist() for key in dforget}
 
 def evaluate_splitpred_question(model, data_config, testf, model_name, save_path="", use_pred=False, train_ratio=0.2, atkt_pad=False):
     if save_path != "":
@@ -1047,6 +875,11 @@ def evaluate_splitpred_question(model, data_config, testf, model_name, save_path
         idx = 0
         df = pd.read_csv(testf)
         dcres, dqres = {"trues": [], "preds": []}, {"trues": [], "late_mean": [], "late_vote": [], "late_all": []}
+        dataset_name = data_config["dpath"].split("/")[-1]
+        if model_name in ["dkt_forget", "bakt_time", "parkt", "mikt"]:
+            # computed once for the whole test file instead of per student
+            index_time = model_name in ["mikt"] and dataset_name in ["assist2009", "assist2015"]
+            forget_feats = load_forget_features(testf, df, "concepts", index_time)
         for i, row in df.iterrows():
             # print(f"idx: {idx}")
             # if idx == 2:
@@ -1054,8 +887,7 @@ def evaluate_splitpred_question(model, data_config, testf, model_name, save_path
             #     sys.exit()
             model.module.eval()
 
-            dataset_name = data_config["dpath"].split("/")[-1]
-            dforget = dict() if model_name not in ["dkt_forget", "bakt_time", "parkt", "mikt"] else get_info_dkt_forget(row, data_config, model_name, dataset_name)
+            dforget = dict() if model_name not in ["dkt_forget", "bakt_time", "parkt", "mikt"] else get_info_dkt_forget(forget_feats, i, data_config, model_name, index_time)
 
             concepts, responses = row["concepts"].split(","), row["responses"].split(",")
             ###
@@ -1717,14 +1549,12 @@ def predict_each_group2(dtotal, dcur, dforget, curdforget, is_repeat, qidx, uid,
             # create input
             dcurinfos = {"qseqs": curq, "cseqs": curc, "rseqs": curr}
             y, _, _ = model(dcurinfos)
-            y = (y * one_hot(curcshft.long(), model.module.num_c)).sum(-1)
+            y = gather_readout(y, curcshft)
         elif model_name in ["dkt", "dkt+"]:
-            y = model(curc.long(), curr.long())
-            y = (y * one_hot(curcshft.long(), model.module.num_c)).sum(-1)
+            y = model(curc.long(), curr.long(), target=curcshft)
         elif model_name in ["dkt_forget"]:
-            y = model(curc.long(), curr.long(), dgaps)
+            y = model(curc.long(), curr.long(), dgaps, target=curcshft)
             # y = model(curc.long(), curr.long(), curd, curdshft)
-            y = (y * one_hot(curcshft.long(), model.module.num_c)).sum(-1)
         elif model_name in ["dkvmn","deep_irt", "skvmn"]:
             y = model(ccc.long(), ccr.long())
             y = y[:,1:]
@@ -1746,8 +1576,7 @@ def predict_each_group2(dtotal, dcur, dforget, curdforget, is_repeat, qidx, uid,
                 curc = torch.cat((curc, pad), axis=1)
                 curr = torch.cat((curr, pad), axis=1)
                 curcshft = torch.cat((curcshft, pad), axis=1)
-            y, _ = model(curc.long(), curr.long())
-            y = (y * one_hot(curcshft.long(), model.module.num_c)).sum(-1)
+            y, _ = model(curc.long(), curr.long(), target=curcshft)
         elif model_name == "lpkt":
             ccit = torch.cat((curit[:,0:1], curitshft), dim=1)
             y = model(ccq.long(), ccr.long(), ccit.long())
@@ -0,0 +1,171 @@
+import time
+import inspect
+import numpy as np
+import torch
+from torch import nn
+
+INPUT_NAMES = ["questions", "concepts", "responses", "dataset_id"]
+
+
+def dcur_to_inputs(dcur):
+    """the tensor inputs of LOREKTInference from a batch of KTQueDataset: questions [bs, seqlen], concepts
+    [bs, seqlen, max_concepts], responses [bs, seqlen] (the first interaction followed by the shifted ones) and dataset_id [bs]"""
+    q = torch.cat((dcur["qseqs"][:, 0:1], dcur["shft_qseqs"]), dim=1).long()
+    c = torch.cat((dcur["cseqs"][:, 0:1], dcur["shft_cseqs"]), dim=1).long()
+    r = torch.cat((dcur["rseqs"][:, 0:1], dcur["shft_rseqs"]), dim=1).long()
+    if "dataset_id" in dcur:
+        dataset_id = dcur["dataset_id"].long()
+    else:
+        dataset_id = torch.zeros(q.size(0), dtype=torch.long)
+    return q, c, r, dataset_id
+
+
+class LOREKTInference(nn.Module):
+    """the inference of LoReKT as a tensor-in / tensor-out module that traces cleanly: no dict input, no emb_type
+    branches at run time (the configuration of the model is fixed at export) and no activation checkpointing.
+    The output is the same as LOREKT.forward in eval mode.
+
+    Args:
+        model (LOREKT): the model, optionally wrapped by DDP
+        soft_mask (dict, optional): the soft masks of finetuning, exported as buffers. Defaults to None.
+    """
+    def __init__(self, model, soft_mask=None):
+        super().__init__()
+        module = model.module if hasattr(model, "module") else model
+        assert module.emb_type.find("pt") == -1, "the time gaps are not supported by the export!"
+        self.lorekt = module
+        self.soft_mask_keys = []
+        for key in ["attention", "input_projection", "output_projection"]:
+            if soft_mask and soft_mask.get(key) is not None:
+                self.register_buffer(f"soft_mask_{key}", soft_mask[key].detach().float())
+                self.soft_mask_keys.append(key)
+
+    def forward(self, q, c, r, dataset_id):
+        """
+        q: questions [bs, seqlen], c: concepts [bs, seqlen, max_concepts] (-1 is padding), r: responses [bs, seqlen],
+        dataset_id: [bs]. Returns the predictions [bs, seqlen], position t from the interactions before t.
+        """
+        model = self.lorekt
+        soft_mask = None
+        if self.soft_mask_keys:
+            soft_mask = {key: None for key in ["attention", "input_projection", "output_projection"]}
+            for key in self.soft_mask_keys:
+                soft_mask[key] = getattr(self, f"soft_mask_{key}")
+
+        dataset_embed_data = None
+        if model.add_dataset_embed or model.concat_dataset_embed:
+            dataset_embed_data = model.dataset_emb(dataset_id).unsqueeze(1)
+        q_embed_data = model.embed_questions(q, c, dataset_embed_data if model.add_dataset_embed else None)
+        qa_embed_data = q_embed_data + model.qa_embed(r)
+
+        arch = model.model
+        x = q_embed_data + arch.position_emb(q_embed_data)
+        y = qa_embed_data + arch.position_emb(qa_embed_data)
+        for idx, block in enumerate(arch.blocks_2):
+            x = block(x, x, y, idx, soft_mask, 0)
+
+        if model.concat_dataset_embed:
+            concat_q = torch.cat([x, q_embed_data, dataset_embed_data.expand(-1, x.size(1), -1)], dim=-1)
+        else:
+            concat_q = torch.cat([x, q_embed_data], dim=-1)
+        return torch.sigmoid(model.out(concat_q).squeeze(-1))
+
+
+def export_lorekt(model, path, example_inputs, export_format="torchscript", soft_mask=None, opset_version=17):
+    """export LoReKT for inference, the batch and sequence axes are dynamic (at least 2 interactions per row)
+
+    Args:
+        model (LOREKT): the model
+        path (str): the output file, loaded with torch.jit.load (torchscript) or an ONNX runtime (onnx)
+        example_inputs (tuple): (questions, concepts, responses, dataset_id) of a batch, see dcur_to_inputs
+        export_format (str, optional): torchscript or onnx. Defaults to "torchscript".
+        soft_mask (dict, optional): the soft masks of finetuning. Defaults to None.
+        opset_version (int, optional): ONNX opset. Defaults to 17.
+
+    Returns:
+        LOREKTInference: the exported module in eval mode
+    """
+    wrapper = LOREKTInference(model, soft_mask).eval()
+    example_inputs = tuple(example_inputs)
+    with torch.no_grad():
+        if export_format == "torchscript":
+            traced = torch.jit.trace(wrapper, example_inputs, check_trace=False)
+            traced.save(path)
+        elif export_format == "onnx":
+            kwargs = dict()
+            if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+                kwargs["dynamo"] = False
+            torch.onnx.export(wrapper, example_inputs, path, input_names=INPUT_NAMES, output_names=["preds"],
+                              dynamic_axes={"questions": {0: "batch", 1: "seqlen"}, "concepts": {0: "batch", 1: "seqlen"},
+                                            "responses": {0: "batch", 1: "seqlen"}, "dataset_id": {0: "batch"},
+                                            "preds": {0: "batch", 1: "seqlen"}},
+                              opset_version=opset_version, **kwargs)
+        else:
+            raise ValueError(f"unknown export format {export_format}")
+    print(f"exported the model to {path}")
+    return wrapper
+
+
+def load_exported(path, export_format="torchscript"):
+    """a callable (questions, concepts, responses, dataset_id) -> predictions of an exported model"""
+    if export_format == "torchscript":
+        module = torch.jit.load(path, map_location="cpu")
+        module.eval()
+        def run(*inputs):
+            with torch.no_grad():
+                return module(*inputs)
+        return run
+    import onnxruntime
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    def run(*inputs):
+        feeds = {name: x.cpu().numpy() for name, x in zip(INPUT_NAMES, inputs)}
+        return torch.from_numpy(session.run(None, feeds)[0])
+    return run
+
+
+def validate_export(model, exported, batches, lengths=(), atol=1e-4, soft_mask=None):
+    """the max absolute difference between the eager model and the exported one on the batches, each batch is also
+    cut to the given lengths to check the dynamic sequence axis
+
+    Args:
+        model (LOREKT): the eager model
+        exported (callable): see load_exported
+        batches (list): batches of KTQueDataset
+        lengths (tuple, optional): sequence lengths the batches are also cut to. Defaults to ().
+        atol (float, optional): the tolerance. Defaults to 1e-4.
+        soft_mask (dict, optional): the soft masks exported with the model. Defaults to None.
+
+    Returns:
+        float: the max difference
+    """
+    model.eval()
+    if soft_mask:
+        model_device = next(model.parameters()).device
+        soft_mask = {key: None if value is None else value.to(model_device) for key, value in soft_mask.items()}
+    max_diff = 0.
+    with torch.no_grad():
+        for dcur in batches:
+            inputs = dcur_to_inputs(dcur)
+            for length in [inputs[0].size(1)] + [l for l in lengths if l < inputs[0].size(1)]:
+                cut = [x[:, :length] for x in inputs[:3]] + [inputs[3]]
+                cut_dcur = {"qseqs": cut[0][:, :-1], "shft_qseqs": cut[0][:, 1:], "cseqs": cut[1][:, :-1], "shft_cseqs": cut[1][:, 1:],
+                            "rseqs": cut[2][:, :-1], "shft_rseqs": cut[2][:, 1:], "dataset_id": cut[3]}
+                y = model(cut_dcur, soft_mask=soft_mask).cpu()
+                y_exported = exported(*[x.cpu() for x in cut])
+                max_diff = max(max_diff, (y - y_exported).abs().max().item())
+    print(f"max difference between the eager and the exported model: {max_diff}")
+    assert max_diff <= atol, f"the exported model differs from the eager one by {max_diff}!"
+    return max_diff
+
+
+def benchmark(fn, inputs, repeats=20, warmup=3):
+    """mean and p95 seconds of fn(*inputs) over repeats calls"""
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(*inputs)
+        seconds = []
+        for _ in range(repeats):
+            start = time.time()
+            fn(*inputs)
+            seconds.append(time.time() - start)
+    return {"mean_seconds": float(np.mean(seconds)), "p95_seconds": float(np.percentile(seconds, 95))}
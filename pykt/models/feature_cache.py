@@ -0,0 +1,159 @@
+import os
+import json
+import numpy as np
+import torch
+from torch.nn.functional import binary_cross_entropy, cross_entropy
+from sklearn import metrics
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# per cached position: the backbone features and the labels of the heads, -1 where the head has no loss
+FEATURES = ("d_output", "q_embed")
+LABELS = {"dataset_id": np.int64, "label": np.float32, "cls_label": np.int64}
+
+
+def extract_features(model, loader, cache_dir, soft_mask=None, dtype="float32"):
+    """run the frozen LoReKT backbone once over a loader and write the inputs of the heads per position to a
+    memory-mapped store: d_output and q_embed_data (see LOREKT.encode) of the positions with a loss, the dataset id,
+    the response predicted by out (label) and the question predicted by qclasifier (cls_label, predc emb_types)
+
+    Args:
+        model (LOREKT): the model, optionally wrapped by DDP
+        loader (DataLoader): batches of KTQueDataset
+        cache_dir (str): dir of the store, read with FeatureCache
+        soft_mask (dict, optional): the soft masks of the forward. Defaults to None.
+        dtype (str, optional): float32, or float16 for half the size. Defaults to "float32".
+
+    Returns:
+        int: number of cached positions
+    """
+    module = model.module if hasattr(model, "module") else model
+    os.makedirs(cache_dir, exist_ok=True)
+    predc = module.emb_type.find("predc") != -1
+    files = {name: open(os.path.join(cache_dir, f"{name}.bin"), "wb") for name in list(FEATURES) + list(LABELS)}
+    rows = 0
+    module.eval()
+    with torch.no_grad():
+        for dcur in loader:
+            d_output, q_embed_data = module.encode(dcur, soft_mask=soft_mask)
+            sm = dcur["smasks"].bool().to(device)
+            pid_data = torch.cat((dcur["qseqs"][:, 0:1], dcur["shft_qseqs"]), dim=1).long().to(device)
+            target = torch.cat((dcur["rseqs"][:, 0:1], dcur["shft_rseqs"]), dim=1).float().to(device)
+            # out predicts the response of position t from t - 1 (preds[:, 1:]), qclasifier the question of position t (cpreds[:, :-1])
+            no_pos = sm.new_zeros(sm.size(0), 1)
+            pred_mask = torch.cat((no_pos, sm), dim=1)
+            cls_mask = torch.cat((sm, no_pos), dim=1) if predc else torch.zeros_like(pred_mask)
+            keep = pred_mask | cls_mask
+            dataset_id = dcur["dataset_id"].long().to(device)[:, None].expand_as(keep)
+            values = {
+                "d_output": d_output[keep], "q_embed": q_embed_data[keep], "dataset_id": dataset_id[keep],
+                "label": torch.where(pred_mask, target, torch.full_like(target, -1))[keep],
+                "cls_label": torch.where(cls_mask, pid_data, torch.full_like(pid_data, -1))[keep],
+            }
+            for name, value in values.items():
+                value = value.cpu().numpy()
+                files[name].write(value.astype(dtype if name in FEATURES else LABELS[name]).tobytes())
+            rows += int(keep.sum())
+    for f in files.values():
+        f.close()
+    meta = {"rows": rows, "d_model": module.model.d_model, "dtype": dtype, "predc": predc}
+    json.dump(meta, open(os.path.join(cache_dir, "meta.json"), "w"), indent=4)
+    print(f"cached the features of {rows} positions to {cache_dir}")
+    return rows
+
+
+class FeatureCache:
+    """the store written by extract_features, read lazily through np.memmap in batches of positions
+
+    Args:
+        cache_dir (str): dir of the store
+    """
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, "meta.json")) as fin:
+            self.meta = json.load(fin)
+        rows, d_model = self.meta["rows"], self.meta["d_model"]
+        self.arrays = dict()
+        for name in FEATURES:
+            self.arrays[name] = np.memmap(os.path.join(cache_dir, f"{name}.bin"), dtype=self.meta["dtype"], mode="r", shape=(rows, d_model))
+        for name, dtype in LABELS.items():
+            self.arrays[name] = np.memmap(os.path.join(cache_dir, f"{name}.bin"), dtype=dtype, mode="r", shape=(rows,))
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def batches(self, batch_size, shuffle=False):
+        """dicts of tensors of batch_size positions, the positions of a batch are read in file order"""
+        order = np.random.permutation(len(self)) if shuffle else np.arange(len(self))
+        for start in range(0, len(self), batch_size):
+            index = np.sort(order[start:start+batch_size])
+            yield {name: torch.from_numpy(np.asarray(array[index])) for name, array in self.arrays.items()}
+
+
+def head_outputs(module, batch):
+    """the probabilities of out and the logits of qclasifier (None without predc) of a batch of cached positions"""
+    d_output = batch["d_output"].float().to(device).unsqueeze(1)
+    q_embed_data = batch["q_embed"].float().to(device).unsqueeze(1)
+    dataset_embed_data = None
+    if module.concat_dataset_embed:
+        dataset_embed_data = module.dataset_emb(batch["dataset_id"].to(device)).unsqueeze(1)
+    concat_q = module.concat_features(d_output, q_embed_data, dataset_embed_data).squeeze(1)
+    preds = torch.sigmoid(module.out(concat_q).squeeze(-1))
+    cpreds = module.qclasifier(concat_q) if module.emb_type.find("predc") != -1 else None
+    return preds, cpreds
+
+
+def evaluate_heads(model, cache, batch_size=4096):
+    """auc and acc of out on the cached positions"""
+    module = model.module if hasattr(model, "module") else model
+    module.eval()
+    y_trues, y_scores = [], []
+    with torch.no_grad():
+        for batch in cache.batches(batch_size):
+            preds, _ = head_outputs(module, batch)
+            label = batch["label"].to(device)
+            y_scores.append(preds[label >= 0].cpu())
+            y_trues.append(label[label >= 0].cpu())
+    ts, ps = torch.cat(y_trues).numpy(), torch.cat(y_scores).numpy()
+    auc = metrics.roc_auc_score(y_true=ts, y_score=ps)
+    acc = metrics.accuracy_score(ts, np.where(ps >= 0.5, 1, 0))
+    return auc, acc
+
+
+def train_heads(model, train_cache, valid_cache, num_epochs, opt, batch_size=4096, ckpt_path=None):
+    """train the heads of LoReKT on cached backbone features, the loss of train_model (BCE of the responses,
+    plus cf_weight * CE of the questions for predc). The model is saved to ckpt_path when the valid auc improves.
+
+    Args:
+        model (LOREKT): the model, optionally wrapped by DDP, the optimizer should only hold the head parameters
+        train_cache (FeatureCache): positions of the train set
+        valid_cache (FeatureCache): positions of the valid set
+        num_epochs (int): number of epochs
+        opt (optimizer): optimizer of the heads
+        batch_size (int, optional): number of positions of a batch. Defaults to 4096.
+        ckpt_path (str, optional): dir of the checkpoint, None does not save. Defaults to None.
+
+    Returns:
+        (tuple): the best valid auc, its acc and epoch
+    """
+    module = model.module if hasattr(model, "module") else model
+    max_auc, best_acc, best_epoch = 0, 0, -1
+    for i in range(1, num_epochs + 1):
+        module.train()
+        loss_mean = []
+        for batch in train_cache.batches(batch_size, shuffle=True):
+            preds, cpreds = head_outputs(module, batch)
+            label, cls_label = batch["label"].to(device), batch["cls_label"].to(device)
+            loss = binary_cross_entropy(preds[label >= 0].double(), label[label >= 0].double())
+            if cpreds is not None and (cls_label >= 0).any():
+                loss = loss + module.cf_weight * cross_entropy(cpreds[cls_label >= 0], cls_label[cls_label >= 0])
+            opt.zero_grad()
+            loss.backward()
+            opt.step()
+            loss_mean.append(loss.detach().cpu().numpy())
+        auc, acc = evaluate_heads(model, valid_cache, batch_size)
+        if auc > max_auc + 1e-3:
+            if ckpt_path is not None:
+                torch.save(module.state_dict(), os.path.join(ckpt_path, module.emb_type+"_model.module.ckpt"))
+            max_auc, best_acc, best_epoch = auc, acc, i
+        print(f"Epoch: {i}, loss: {np.mean(loss_mean):.4f}, validauc: {auc:.4f}, validacc: {acc:.4f}, best epoch: {best_epoch}, best auc: {max_auc:.4f}")
+    return max_auc, best_acc, best_epoch
@@ -4,7 +4,9 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import math
+import scipy.sparse as sp
 from torch.autograd import Variable
+from .gkt_utils import graph_neighbors
 
 # refs https://github.com/jhljx/GKT
 import torch
@@ -23,8 +25,9 @@ class GKT(nn.Module):
         emb_type (str, optional): emb_type. Defaults to "qid".
         emb_path (str, optional): emb_path. Defaults to "".
         bias (bool, optional): add bias for DNN. Defaults to True.
+        sparse_graph (bool, optional): graph is a scipy sparse matrix, neighbor messages are only computed on its edges. Defaults to False.
     """
-    def __init__(self, num_c, hidden_dim, emb_size, graph_type="dense", graph=None, dropout=0.5, emb_type="qid", emb_path="",bias=True):
+    def __init__(self, num_c, hidden_dim, emb_size, graph_type="dense", graph=None, dropout=0.5, emb_type="qid", emb_path="",bias=True, sparse_graph=False):
         super(GKT, self).__init__()
         self.model_name = "gkt"
         self.num_c = num_c
@@ -32,20 +35,20 @@ class GKT(nn.Module):
         self.emb_size = emb_size
         self.res_len = 2
         self.graph_type = graph_type
-        self.graph = nn.Parameter(graph)  # [num_c, num_c]
-        self.graph.requires_grad = False  # fix parameter
+        self.sparse_graph = sparse_graph or sp.issparse(graph)
+        if self.sparse_graph:
+            # csr neighbor lists, [num_c + 1], [num_edge], [num_edge], [num_edge]
+            nbr_ptr, nbr_idx, nbr_adj, nbr_reverse_adj = graph_neighbors(graph)
+            self.register_buffer("nbr_ptr", nbr_ptr)
+            self.register_buffer("nbr_idx", nbr_idx)
+            self.register_buffer("nbr_adj", nbr_adj)
+            self.register_buffer("nbr_reverse_adj", nbr_reverse_adj)
+        else:
+            self.graph = nn.Parameter(graph)  # [num_c, num_c]
+            self.graph.requires_grad = False  # fix parameter
         self.emb_type = emb_type
         self.emb_path = emb_path
 
-
-        # one-hot feature and question
-        one_hot_feat = torch.eye(self.res_len * self.num_c).to(device)
-        self.one_hot_feat = one_hot_feat
-        # self.one_hot_q = torch.eye(self.num_c, device=self.one_hot_feat.device)
-        # zero_padding = torch.zeros(1, self.num_c, device=self.one_hot_feat.device)
-        self.one_hot_q = torch.eye(self.num_c).to(device)
-        zero_padding = torch.zeros(1, self.num_c).to(device)
-        self.one_hot_q = torch.cat((self.one_hot_q, zero_padding), dim=0)
         
         if emb_type.startswith("qid"):
             # concept and concept & response embeddings
@@ -90,13 +93,8 @@ class GKT(nn.Module):
             tmp_ht: aggregation results of concept hidden knowledge state and concept(& response) embedding
         """
         qt_mask = torch.ne(qt, -1)  # [batch_size], qt != -1
-        x_idx_mat = torch.arange(self.res_len * self.num_c, device=device)
-        x_embedding = self.interaction_emb(x_idx_mat)  # [res_len * num_c, emb_size]#the emb for each concept with answer?
-        # print(xt[qt_mask])
-        # print(self.one_hot_feat)
-        masked_feat = F.embedding(xt[qt_mask], self.one_hot_feat)  # [mask_num, res_len * num_c] A simple lookup table that looks up embeddings in a fixed dictionary and size.
-        #nn.functional.embedding(input, weight, padding_idx=None, max_norm=None, norm_type=2.0, scale_grad_by_freq=False, sparse=False)
-        res_embedding = masked_feat.mm(x_embedding)  # [mask_num, emb_size]
+        # look up the concept & response embedding directly instead of one-hot [mask_num, res_len * num_c] x table
+        res_embedding = self.interaction_emb(xt[qt_mask].long())  # [mask_num, emb_size]
         mask_num = res_embedding.shape[0]
 
         concept_idx_mat = self.num_c * torch.ones((batch_size, self.num_c), device=device).long()
@@ -131,9 +129,15 @@ class GKT(nn.Module):
         self_index_tuple = (torch.arange(mask_num, device=qt.device), masked_qt.long())
         self_ht = masked_tmp_ht[self_index_tuple]  # [mask_num, hidden_dim + emb_size]
         self_features = self.f_self(self_ht)  # [mask_num, hidden_dim]
+        concept_embedding, rec_embedding, z_prob = None, None, None
+        if self.sparse_graph:
+            neigh_features = self._sparse_neighbor_features(masked_tmp_ht, self_ht, masked_qt.long())
+            m_next = tmp_ht[:, :, :self.hidden_dim]
+            m_next[qt_mask] = neigh_features
+            m_next[qt_mask] = m_next[qt_mask].index_put(self_index_tuple, self_features)
+            return m_next, concept_embedding, rec_embedding, z_prob
         expanded_self_ht = self_ht.unsqueeze(dim=1).repeat(1, self.num_c, 1)  #[mask_num, num_c, hidden_dim + emb_size]
         neigh_ht = torch.cat((expanded_self_ht, masked_tmp_ht), dim=-1)  #[mask_num, num_c, 2 * (hidden_dim + emb_size)]
-        concept_embedding, rec_embedding, z_prob = None, None, None
 
      
         adj = self.graph[masked_qt.long(), :].unsqueeze(dim=-1)  # [mask_num, num_c, 1]
@@ -147,6 +151,34 @@ class GKT(nn.Module):
         m_next[qt_mask] = m_next[qt_mask].index_put(self_index_tuple, self_features)
         return m_next, concept_embedding, rec_embedding, z_prob
 
+    def _sparse_neighbor_features(self, masked_tmp_ht, self_ht, masked_qt):
+        r"""
+        Parameters:
+            masked_tmp_ht: temporal hidden representations of all concepts of the answering students
+            self_ht: temporal hidden representation of the answered concept
+            masked_qt: answered concept indices
+        Shape:
+            masked_tmp_ht: [mask_num, num_c, hidden_dim + emb_size]
+            self_ht: [mask_num, hidden_dim + emb_size]
+            masked_qt: [mask_num]
+            neigh_features: [mask_num, num_c, hidden_dim]
+        Return:
+            neigh_features: f_in / f_out messages, only evaluated on the graph edges of the answered concepts (zero elsewhere)
+        """
+        mask_num = masked_qt.shape[0]
+        starts = self.nbr_ptr[masked_qt]
+        counts = self.nbr_ptr[masked_qt + 1] - starts  # [mask_num]
+        edge_owner = torch.repeat_interleave(torch.arange(mask_num, device=masked_qt.device), counts)  # [num_edge]
+        edge_offset = torch.arange(edge_owner.shape[0], device=masked_qt.device) - (torch.cumsum(counts, 0) - counts)[edge_owner]
+        edge_id = starts[edge_owner] + edge_offset
+        edge_c = self.nbr_idx[edge_id]
+        neigh_ht = torch.cat((self_ht[edge_owner], masked_tmp_ht[edge_owner, edge_c]), dim=-1)  # [num_edge, 2 * (hidden_dim + emb_size)]
+        edge_features = self.nbr_adj[edge_id].unsqueeze(-1) * self.f_neighbor_list[0](neigh_ht) + \
+            self.nbr_reverse_adj[edge_id].unsqueeze(-1) * self.f_neighbor_list[1](neigh_ht)  # [num_edge, hidden_dim]
+        neigh_features = edge_features.new_zeros(mask_num, self.num_c, self.hidden_dim)
+        neigh_features = neigh_features.index_put((edge_owner, edge_c), edge_features)
+        return neigh_features
+
     # Update step, as shown in Section 3.3.2 of the paper
     def _update(self, tmp_ht, ht, qt):
         r"""
@@ -209,11 +241,10 @@ class GKT(nn.Module):
         Return:
             pred: predicted correct probability of the question answered at the next timestamp
         """
-        next_qt = q_next
-        next_qt = torch.where(next_qt != -1, next_qt, self.num_c * torch.ones_like(next_qt, device=yt.device))
-        one_hot_qt = F.embedding(next_qt.long(), self.one_hot_q)  # [batch_size, num_c]
-        # dot product between yt and one_hot_qt
-        pred = (yt * one_hot_qt).sum(dim=1)  # [batch_size, ]
+        next_qt = q_next.long()
+        # gather the next concept instead of a dot product with its one-hot row, padding (-1) gives 0
+        pred = yt.gather(1, next_qt.clamp(min=0).unsqueeze(-1)).squeeze(-1)  # [batch_size, ]
+        pred = torch.where(next_qt != -1, pred, torch.zeros_like(pred))
         return pred
 
 
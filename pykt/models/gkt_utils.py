@@ -3,65 +3,130 @@ import torch
 import os
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 
-def get_gkt_graph(num_c, dpath, trainfile, testfile, graph_type="dense", tofile="./graph.npz"):
+_graph_cache = dict()
+
+def get_gkt_graph(num_c, dpath, trainfile, testfile, graph_type="dense", tofile="./graph.npz", sparse=False):
     graph = None
     df_train = pd.read_csv(os.path.join(dpath, trainfile))
     df_test = pd.read_csv(os.path.join(dpath, testfile))
     df = pd.concat([df_train, df_test])  
     if graph_type == 'dense':
-        graph = build_dense_graph(num_c)
+        graph = build_dense_graph(num_c, sparse=sparse)
     elif graph_type == 'transition':
-        graph = build_transition_graph(df, num_c)
-    np.savez(os.path.join(dpath, tofile), matrix = graph)
+        graph = build_transition_graph(df, num_c, sparse=sparse)
+    if sparse:
+        sp.save_npz(os.path.join(dpath, tofile), graph)
+    else:
+        np.savez(os.path.join(dpath, tofile), matrix = graph)
     return graph
 
-def build_transition_graph(df, concept_num):
+def load_gkt_graph(data_config, graph_type="dense", sparse=False):
+    """load the gkt graph of a dataset, building it on the first call
+
+    The graph is built from train_valid_original_file and test_original_file, which do not depend on
+    the fold, so it is cached per dataset (dpath), graph type and format: on disk next to the data and
+    in memory for the rest of the process.
+
+    Args:
+        data_config (dict): the data config of the dataset
+        graph_type (str, optional): dense or transition. Defaults to "dense".
+        sparse (bool, optional): return a scipy csr matrix instead of a dense torch tensor. Defaults to False.
+
+    Returns:
+        torch.Tensor or scipy.sparse.csr_matrix: graph
+    """
+    key = (data_config["dpath"], graph_type, sparse)
+    if key in _graph_cache:
+        return _graph_cache[key]
+    fname = f"gkt_graph_{graph_type}_sparse.npz" if sparse else f"gkt_graph_{graph_type}.npz"
+    graph_path = os.path.join(data_config["dpath"], fname)
+    if os.path.exists(graph_path):
+        if sparse:
+            graph = sp.load_npz(graph_path).tocsr()
+        else:
+            graph = torch.tensor(np.load(graph_path, allow_pickle=True)['matrix']).float()
+    else:
+        graph = get_gkt_graph(data_config["num_c"], data_config["dpath"], 
+                data_config["train_valid_original_file"], data_config["test_original_file"], graph_type=graph_type, tofile=fname, sparse=sparse)
+        if not sparse:
+            graph = torch.tensor(graph).float()
+    _graph_cache[key] = graph
+    return graph
+
+def build_transition_graph(df, concept_num, sparse=False):
     """generate transition graph
 
+    Transitions between consecutive concepts (after dropping -1 paddings) are counted in one pass
+    over the flattened concept column, self transitions are dropped and every row is normalized.
+
     Args:
         df (da): _description_
         concept_num (int): number of concepts
+        sparse (bool, optional): return a scipy csr matrix instead of a dense torch tensor. Defaults to False.
 
     Returns:
         numpy: graph
     """
-    graph = np.zeros((concept_num, concept_num))
-    for _, row in df.iterrows():
-        questions = list(filter(lambda x: x != '-1',
-                                row['concepts'].split(',')))
-        seq_len = len(questions)
-        for i in range(seq_len-1):
-            pre = int(questions[i])
-            next = int(questions[i+1])
-            graph[pre, next] += 1
-    np.fill_diagonal(graph, 0)
+    seqs = df['concepts'].str.split(',')
+    lens = seqs.str.len().values
+    concepts = np.array([c for seq in seqs for c in seq], dtype=np.int64)
+    rows = np.repeat(np.arange(len(lens)), lens)
+    keep = concepts != -1
+    concepts, rows = concepts[keep], rows[keep]
+    same_row = rows[:-1] == rows[1:]
+    pre, next = concepts[:-1][same_row], concepts[1:][same_row]
+    not_self = pre != next
+    pre, next = pre[not_self], next[not_self]
+    # duplicated (pre, next) pairs are summed up when converting to csr
+    graph = sp.coo_matrix((np.ones(len(pre)), (pre, next)), shape=(concept_num, concept_num)).tocsr()
     # row normalization
-    rowsum = np.array(graph.sum(1))
-
-    def inv(x):
-        if x == 0:
-            return x
-        return 1. / x
-
-    inv_func = np.vectorize(inv)
-    r_inv = inv_func(rowsum).flatten()
-    r_mat_inv = np.diag(r_inv)
-    graph = r_mat_inv.dot(graph)
-    graph = torch.from_numpy(graph).float()
+    rowsum = np.array(graph.sum(1)).flatten()
+    r_inv = np.zeros_like(rowsum)
+    r_inv[rowsum != 0] = 1. / rowsum[rowsum != 0]
+    graph = sp.diags(r_inv).dot(graph).tocsr()
+    if sparse:
+        return graph
+    graph = torch.from_numpy(graph.toarray()).float()
     
     return graph
 
-def build_dense_graph(concept_num):
+def build_dense_graph(concept_num, sparse=False):
     """generate dense graph
 
     Args:
         concept_num (int): number of concepts
+        sparse (bool, optional): return a scipy csr matrix instead of a dense torch tensor. Defaults to False.
 
     Returns:
         numpy: graph
     """
     graph = 1. / (concept_num - 1) * np.ones((concept_num, concept_num))
     np.fill_diagonal(graph, 0)
+    if sparse:
+        return sp.csr_matrix(graph)
     graph = torch.from_numpy(graph).float()
-    return graph
\ No newline at end of file
+    return graph
+
+def graph_neighbors(graph):
+    """turn a sparse graph into csr neighbor lists used by GKT
+
+    The neighbors of concept i are the concepts j with graph[i, j] != 0 or graph[j, i] != 0.
+
+    Args:
+        graph (scipy.sparse.spmatrix): [num_c, num_c] graph
+
+    Returns:
+        tuple: indptr [num_c + 1], indices [num_edge], adj weights graph[i, j] [num_edge], reverse adj weights graph[j, i] [num_edge]
+    """
+    adj = sp.csr_matrix(graph)
+    reverse_adj = adj.T.tocsr()
+    pattern = ((adj != 0) + (reverse_adj != 0)).tocsr()
+    pattern.sort_indices()
+    rows = np.repeat(np.arange(pattern.shape[0]), np.diff(pattern.indptr))
+    cols = pattern.indices
+    adj_w = np.asarray(adj[rows, cols]).flatten()
+    reverse_w = np.asarray(reverse_adj[rows, cols]).flatten()
+    return torch.from_numpy(pattern.indptr.astype(np.int64)), torch.from_numpy(cols.astype(np.int64)), \
+        torch.from_numpy(adj_w).float(), torch.from_numpy(reverse_w).float()
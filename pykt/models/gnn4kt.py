@@ -1,11 +1,8 @@
 from __future__ import print_function, division
 import argparse
 import random
-import numpy as np
 import torch
 import torch.nn as nn
-from torch.nn.init import xavier_uniform_
-from torch.nn.init import constant_
 import math
 import torch.nn.functional as F
 from enum import IntEnum
@@ -13,6 +10,8 @@ from torch.nn.parameter import Parameter
 from torch.optim import Adam
 from torch.nn import Linear
 from .gnn4kt_util import GNNLayer
+from .utils import linear_readout, pooled_concept_emb
+from .transformer_utils import TransformerLayer
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -31,9 +30,11 @@ class MLP(nn.Module):
         self.out = nn.Linear(hidden_dim, output_dim)
         self.act = torch.nn.Sigmoid()
 
-    def forward(self, x):
+    def forward(self, x, target=None):
         for lin in self.lins:
             x = F.relu(lin(x))
+        if target is not None:
+            return linear_readout(self.out, self.dropout(x), target)
         return self.out(self.dropout(x))
 
 class LSTM4Graph(nn.Module):
@@ -110,26 +111,15 @@ class GNN4KT(nn.Module):
         self.m = nn.Sigmoid()
 
     def get_avg_skill_emb(self,c):
-        # add zero for padding
-        concept_emb_cat = torch.cat(
-            [torch.zeros(1, self.emb_size).to(device), 
-            self.concept_emb], dim=0)
-        # shift c
-
-        related_concepts = (c+1).long()
-        #[batch_size, seq_len, emb_dim]
-        concept_emb_sum = concept_emb_cat[related_concepts, :].sum(
-            axis=-2)
-
-        #[batch_size, seq_len,1]
-        concept_num = torch.where(related_concepts != 0, 1, 0).sum(
-            axis=-1).unsqueeze(-1)
-        concept_num = torch.where(concept_num == 0, 1, concept_num)
-        concept_avg = (concept_emb_sum / concept_num)
-        return concept_avg
-
-
-    def forward(self, dcur):
+        #[batch_size, seq_len, emb_dim], -1 is padding
+        return pooled_concept_emb(self.concept_emb, c)
+
+
+    def forward(self, dcur, readout=False):
+        """
+        readout: in lstm mode, only compute the logits of the next questions (shft_qseqs) and return [batch_size, seqlen-1]
+        instead of the prediction of all questions.
+        """
         # input_data
         q, c, r = dcur["qseqs"].long().to(device), dcur["cseqs"].long().to(device), dcur["rseqs"].long().to(device)
         qshft, cshft, rshft = dcur["shft_qseqs"].long().to(device), dcur["shft_cseqs"].long().to(device), dcur["shft_rseqs"].long().to(device)
@@ -173,7 +163,7 @@ class GNN4KT(nn.Module):
                 output, _ = self.model(q_embed_data, qa_embed_data+h)
         if self.emb_type.find("lstm") != -1:
             input_combined = torch.cat((output[:,:-1,:], q_embed_data[:,1:,:]), -1)
-            y = self.out_question_all(input_combined)
+            y = self.out_question_all(input_combined, target=qshft if readout else None)
         elif self.emb_type.find("trf") != -1:
             input_combined = torch.cat((output, q_embed_data), -1)
             y = self.out(input_combined).squeeze(-1)
@@ -233,156 +223,6 @@ class Architecture(nn.Module):
         all_x = torch.stack(all_x,dim=0)
         return x, all_x
 
-class TransformerLayer(nn.Module):
-    def __init__(self, d_model, d_feature,
-                 d_ff, n_heads, dropout,  kq_same):
-        super().__init__()
-        """
-            This is a Basic Block of Transformer paper. It containts one Multi-head attention object. Followed by layer norm and postion wise feedforward net and dropout layer.
-        """
-        kq_same = kq_same == 1
-        # Multi-Head Attention Block
-        self.masked_attn_head = MultiHeadAttention(
-            d_model, d_feature, n_heads, dropout, kq_same=kq_same)
-
-        # Two layer norm layer and two droput layer
-        self.layer_norm1 = nn.LayerNorm(d_model)
-        self.dropout1 = nn.Dropout(dropout)
-
-        self.linear1 = nn.Linear(d_model, d_ff)
-        self.activation = nn.ReLU()
-        self.dropout = nn.Dropout(dropout)
-        self.linear2 = nn.Linear(d_ff, d_model)
-
-        self.layer_norm2 = nn.LayerNorm(d_model)
-        self.dropout2 = nn.Dropout(dropout)
-
-    def forward(self, mask, query, key, values, apply_pos=True):
-        """
-        Input:
-            block : object of type BasicBlock(nn.Module). It contains masked_attn_head objects which is of type MultiHeadAttention(nn.Module).
-            mask : 0 means, it can peek only past values. 1 means, block can peek only current and pas values
-            query : Query. In transformer paper it is the input for both encoder and decoder
-            key : Keys. In transformer paper it is the input for both encoder and decoder
-            Values. In transformer paper it is the input for encoder and  encoded output for decoder (in masked attention part)
-
-        Output:
-            query: Input gets changed over the layer and returned.
-
-        """
-
-        seqlen, batch_size = query.size(1), query.size(0)
-        nopeek_mask = np.triu(
-            np.ones((1, 1, seqlen, seqlen)), k=mask).astype('uint8')
-        src_mask = (torch.from_numpy(nopeek_mask) == 0).to(device)
-        if mask == 0:  # If 0, zero-padding is needed.
-            # Calls block.masked_attn_head.forward() method
-            query2 = self.masked_attn_head(
-                query, key, values, mask=src_mask, zero_pad=True) # 只能看到之前的信息，当前的信息也看不到，此时会把第一行score全置0，表示第一道题看不到历史的interaction信息，第一题attn之后，对应value全0
-        else:
-            # Calls block.masked_attn_head.forward() method
-            query2 = self.masked_attn_head(
-                query, key, values, mask=src_mask, zero_pad=False)
-
-        query = query + self.dropout1((query2)) # 残差1
-        query = self.layer_norm1(query) # layer norm
-        if apply_pos:
-            query2 = self.linear2(self.dropout( # FFN
-                self.activation(self.linear1(query))))
-            query = query + self.dropout2((query2)) # 残差
-            query = self.layer_norm2(query) # lay norm
-        return query
-
-
-class MultiHeadAttention(nn.Module):
-    def __init__(self, d_model, d_feature, n_heads, dropout, kq_same, bias=True):
-        super().__init__()
-        """
-        It has projection layer for getting keys, queries and values. Followed by attention and a connected layer.
-        """
-        self.d_model = d_model
-        self.d_k = d_feature
-        self.h = n_heads
-        self.kq_same = kq_same
-
-        self.v_linear = nn.Linear(d_model, d_model, bias=bias)
-        self.k_linear = nn.Linear(d_model, d_model, bias=bias)
-        if kq_same is False:
-            self.q_linear = nn.Linear(d_model, d_model, bias=bias)
-        self.dropout = nn.Dropout(dropout)
-        self.proj_bias = bias
-        self.out_proj = nn.Linear(d_model, d_model, bias=bias)
-
-        self._reset_parameters()
-
-    def _reset_parameters(self):
-        xavier_uniform_(self.k_linear.weight)
-        xavier_uniform_(self.v_linear.weight)
-        if self.kq_same is False:
-            xavier_uniform_(self.q_linear.weight)
-
-        if self.proj_bias:
-            constant_(self.k_linear.bias, 0.)
-            constant_(self.v_linear.bias, 0.)
-            if self.kq_same is False:
-                constant_(self.q_linear.bias, 0.)
-            constant_(self.out_proj.bias, 0.)
-
-    def forward(self, q, k, v, mask, zero_pad):
-
-        bs = q.size(0)
-
-        # perform linear operation and split into h heads
-
-        k = self.k_linear(k).view(bs, -1, self.h, self.d_k)
-        if self.kq_same is False:
-            q = self.q_linear(q).view(bs, -1, self.h, self.d_k)
-        else:
-            q = self.k_linear(q).view(bs, -1, self.h, self.d_k)
-        v = self.v_linear(v).view(bs, -1, self.h, self.d_k)
-
-        # transpose to get dimensions bs * h * sl * d_model
-
-        k = k.transpose(1, 2)
-        q = q.transpose(1, 2)
-        v = v.transpose(1, 2)
-        # calculate attention using function we will define next
-        scores = attention(q, k, v, self.d_k,
-                           mask, self.dropout, zero_pad)
-
-        # concatenate heads and put through final linear layer
-        concat = scores.transpose(1, 2).contiguous()\
-            .view(bs, -1, self.d_model)
-
-        output = self.out_proj(concat)
-
-        return output
-
-
-def attention(q, k, v, d_k, mask, dropout, zero_pad):
-    """
-    This is called by Multi-head atention object to find the values.
-    """
-    # d_k: 每一个头的dim
-    scores = torch.matmul(q, k.transpose(-2, -1)) / \
-        math.sqrt(d_k)  # BS, 8, seqlen, seqlen
-    bs, head, seqlen = scores.size(0), scores.size(1), scores.size(2)
-
-    scores.masked_fill_(mask == 0, -1e32)
-    scores = F.softmax(scores, dim=-1)  # BS,8,seqlen,seqlen
-    # print(f"before zero pad scores: {scores.shape}")
-    # print(zero_pad)
-    if zero_pad:
-        pad_zero = torch.zeros(bs, head, 1, seqlen).to(device)
-        scores = torch.cat([pad_zero, scores[:, :, 1:, :]], dim=2) # 第一行score置0
-    # print(f"after zero pad scores: {scores}")
-    scores = dropout(scores)
-    output = torch.matmul(scores, v)
-    # import sys
-    # sys.exit()
-    return output
-
-
 class LearnablePositionalEmbedding(nn.Module):
     def __init__(self, d_model, max_len=512):
         super().__init__()
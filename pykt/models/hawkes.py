@@ -8,8 +8,15 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 class HawkesKT(nn.Module):
     # def __init__(self, args, corpus):
-    def __init__(self, n_skills, n_problems, emb_size, time_log, emb_type="qid"):
+    def __init__(self, n_skills, n_problems, emb_size, time_log, emb_type="qid", chunk_size=0, window_size=0):
         super().__init__()
+        """
+        Input:
+            chunk_size: if > 0, the cross effects are summed over blocks of chunk_size target positions
+                in fp32 instead of materializing the full [bs, seq_len, seq_len] tensors in fp64
+            window_size: if > 0, only the most recent window_size interactions excite the current one
+                (implies the chunked path, chunk_size defaults to window_size)
+        """
         self.model_name = "hawkes"
         self.emb_type = emb_type
         self.problem_num = n_problems
@@ -17,6 +24,9 @@ class HawkesKT(nn.Module):
         self.emb_size = emb_size
         self.time_log = time_log
         self.gpu = device
+        self.window_size = window_size
+        self.chunk_size = chunk_size if chunk_size > 0 or window_size <= 0 else window_size
+        self.use_chunk = self.chunk_size > 0
 
         self.problem_base = torch.nn.Embedding(self.problem_num, 1)
         self.skill_base = torch.nn.Embedding(self.skill_num, 1)
@@ -46,6 +56,44 @@ class HawkesKT(nn.Module):
         self.count += 1
         print(f"count: {self.count}")
 
+    def chunk_cross_effects(self, inters, skills, times):
+        """Compute sum_t[b, j] = sum_{i<j} alpha_ij * exp(-beta_ij * delta_t_ij) block by block.
+
+        Only a [bs, src_len, chunk_size] slice of alphas/betas/delta_t is alive at a time, and all of it
+        stays in fp32: time differences are taken on the integer timestamps before the cast, so
+        millisecond epochs do not lose precision.
+        """
+        bs, seq_len = skills.shape
+        alpha_src_emb = self.alpha_inter_embeddings(inters)  # [bs, seq_len, emb]
+        alpha_target_emb = self.alpha_skill_embeddings(skills)
+        beta_src_emb = self.beta_inter_embeddings(inters)
+        beta_target_emb = self.beta_skill_embeddings(skills)
+        has_time = times.shape[1] > 0
+        log_base = np.log(self.time_log)
+        positions = torch.arange(seq_len, device=skills.device)
+
+        sum_t = []
+        for start in range(0, seq_len, self.chunk_size):
+            end = min(start + self.chunk_size, seq_len)
+            src_start = 0 if self.window_size <= 0 else max(0, start - self.window_size)
+            # source positions [src_start, end), target positions [start, end)
+            alphas = torch.matmul(alpha_src_emb[:, src_start:end], alpha_target_emb[:, start:end].transpose(-2, -1))
+            betas = torch.matmul(beta_src_emb[:, src_start:end], beta_target_emb[:, start:end].transpose(-2, -1))
+            betas = torch.clamp(betas + 1, min=0, max=10)
+            if has_time:
+                delta_t = (times[:, src_start:end, None] - times[:, None, start:end]).abs().float() / 1000
+                delta_t = torch.log(delta_t + 1e-10) / log_base
+                cross_effects = alphas * torch.exp(-betas * delta_t)
+            else:
+                # 1 if no timestamps, log(1) = 0
+                cross_effects = alphas
+            src_pos, tgt_pos = positions[src_start:end, None], positions[None, start:end]
+            valid = src_pos < tgt_pos
+            if self.window_size > 0:
+                valid = valid & (tgt_pos - src_pos <= self.window_size)
+            sum_t.append(cross_effects.masked_fill(~valid.unsqueeze(0), 0).sum(-2))
+        return torch.cat(sum_t, dim=-1)
+
     def forward(self, skills, problems, times, labels, qtest=False):
         # self.printparams()
         # assert False
@@ -67,6 +115,16 @@ class HawkesKT(nn.Module):
         # # assert labels == mask_labels
         inters = skills + mask_labels * self.skill_num
         # print(f"inters: {inters}")
+        if self.use_chunk:
+            sum_t = self.chunk_cross_effects(inters, skills, times)
+            problem_bias = self.problem_base(problems).squeeze(dim=-1)
+            skill_bias = self.skill_base(skills).squeeze(dim=-1)
+            h = problem_bias + skill_bias + sum_t
+            prediction = h.sigmoid()
+            if not qtest:
+                return prediction
+            else:
+                return prediction, h
 
         alpha_src_emb = self.alpha_inter_embeddings(inters)  # [bs, seq_len, emb]
         # print(f"alpha_src_emb:{alpha_src_emb}")
@@ -268,4 +268,38 @@ class IEKT(QueBaseModel):
         if return_details:
             return data_new,emb_action_list,p_action_list,states_list,pre_state_list,reward_list,predict_list,ground_truth_list
         else:
-            return prob_tensor[:,1:]
\ No newline at end of file
+            return prob_tensor[:,1:]
+
+    def init_state(self, batch_size):
+        """the knowledge state of new students, the h of the recurrent update"""
+        return (torch.zeros(batch_size, self.model.emb_size).to(self.device),)
+
+    def step(self, state, q, c, r=None):
+        """
+        one interaction of each student from the cached state, instead of replaying the history, as in predict_one_step
+        (the cognition and acquisition levels are sampled).
+        q: the questions [batch_size], c: the concepts [batch_size, max_concepts], r: the responses [batch_size], None only predicts.
+        Returns the new state and the prediction of q made before its response [batch_size].
+        """
+        h, = state
+        ques_h = torch.cat([self.model.get_ques_representation(q=q, c=c), h], dim = 1)
+        emb_p = self.model.cog_matrix[Categorical(self.model.pi_cog_func(ques_h)).sample(),:]
+        h_v, v, logits, _ = self.model.obtain_v(q=q, c=c, h=h, x=None, emb=emb_p)
+        prob = torch.sigmoid(logits)
+        if r is None:
+            return state, prob.squeeze(-1)
+
+        operate = r.unsqueeze(-1)
+        out_x_groundtruth = torch.cat([
+            h_v.mul(operate.repeat(1, h_v.size()[-1]).float()),
+            h_v.mul((1-operate).repeat(1, h_v.size()[-1]).float())],
+            dim = 1)
+        out_operate_logits = torch.where(prob > 0.5, torch.tensor(1).to(self.device), torch.tensor(0).to(self.device))
+        out_x_logits = torch.cat([
+            h_v.mul(out_operate_logits.repeat(1, h_v.size()[-1]).float()),
+            h_v.mul((1-out_operate_logits).repeat(1, h_v.size()[-1]).float())],
+            dim = 1)
+        out_x = torch.cat([out_x_groundtruth, out_x_logits], dim = 1)
+        emb = self.model.acq_matrix[Categorical(self.model.pi_sens_func(out_x)).sample(),:]
+        h = self.model.update_state(h, v, emb, r.unsqueeze(1))
+        return (h,), prob.squeeze(-1)
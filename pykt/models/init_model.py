@@ -2,7 +2,7 @@ import torch
 import numpy as np
 import os
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.optim import SGD, Adam
+from .optim_utils import init_optimizer
 from .dkt import DKT
 from .dkt_plus import DKTPlus
 from .dkvmn import DKVMN
@@ -14,7 +14,7 @@ from .atkt import ATKT
 from .dkt_forget import DKTForget
 from .akt import AKT
 from .gkt import GKT
-from .gkt_utils import get_gkt_graph
+from .gkt_utils import load_gkt_graph
 from .lpkt import LPKT
 from .lpkt_utils import generate_qmatrix
 from .skvmn import SKVMN
@@ -30,6 +30,7 @@ from .parKT import parKT
 from .mikt import MIKT
 from .gnn4kt import GNN4KT
 from .lorekt import LOREKT
+from .quant_utils import quantize_from_config
 from .gnn4kt_util import build_graph, load_graph
 
 device = "cpu" if not torch.cuda.is_available() else "cuda"
@@ -58,15 +59,7 @@ def init_model(model_name, model_config, data_config, emb_type, args=None, num_s
     elif model_name == "atktfix":
         model = ATKT(data_config["num_c"], **model_config, emb_type=emb_type, emb_path=data_config["emb_path"], fix=True).to(device)
     elif model_name == "gkt":
-        graph_type = model_config['graph_type']
-        fname = f"gkt_graph_{graph_type}.npz"
-        graph_path = os.path.join(data_config["dpath"], fname)
-        if os.path.exists(graph_path):
-            graph = torch.tensor(np.load(graph_path, allow_pickle=True)['matrix']).float()
-        else:
-            graph = get_gkt_graph(data_config["num_c"], data_config["dpath"], 
-                    data_config["train_valid_original_file"], data_config["test_original_file"], graph_type=graph_type, tofile=fname)
-            graph = torch.tensor(graph).float()
+        graph = load_gkt_graph(data_config, graph_type=model_config['graph_type'], sparse=model_config.get('sparse_graph', False))
         model = GKT(data_config["num_c"], **model_config,graph=graph,emb_type=emb_type, emb_path=data_config["emb_path"]).to(device)
     elif model_name == "gnn4kt":
         topk = model_config["topk"]
@@ -94,7 +87,8 @@ def init_model(model_name, model_config, data_config, emb_type, args=None, num_s
             print(f"model: {model_name} needs questions ans concepts! but the dataset has no both")
             return None
         model = HawkesKT(data_config["num_c"], data_config["num_q"], **model_config)
-        model = model.double()
+        if not model.use_chunk:
+            model = model.double()
         # print("===before init weights"+"@"*100)
         # model.printparams()
         model.apply(model.init_weights)
@@ -123,9 +117,12 @@ def init_model(model_name, model_config, data_config, emb_type, args=None, num_s
         #     # torch.distributed.init_process_group(backend='nccl')
         #     # torch.cuda.set_device(args.local_rank)
         if emb_type.find("pt") == -1:
-            model = LOREKT(data_config["num_c"], data_config["num_q"], **model_config, emb_type=emb_type, emb_path=data_config["emb_path"]).to(device).to(args.local_rank)
+            model = LOREKT(data_config["num_c"], data_config["num_q"], **model_config, emb_type=emb_type, emb_path=data_config["emb_path"]).to(device)
         else:
-            model = LOREKT(data_config["num_c"], data_config["num_q"], **model_config, emb_type=emb_type, emb_path=data_config["emb_path"], num_sgap=data_config["num_sgap"]).to(device).to(args.local_rank)
+            model = LOREKT(data_config["num_c"], data_config["num_q"], **model_config, emb_type=emb_type, emb_path=data_config["emb_path"], num_sgap=data_config["num_sgap"]).to(device)
+        # the gpu of the process, the model stays on cpu without cuda (e.g. serving)
+        if torch.cuda.is_available():
+            model = model.to(args.local_rank)
         if mode == "train" and train_start:
             model = DDP(model, device_ids=[args.local_rank], output_device=args.local_rank)                 
     elif model_name == "bakt_qikt":
@@ -162,17 +159,27 @@ def load_model(model_name, model_config, data_config, emb_type, ckpt_path, args=
     else:
         mode = 'test'
     
+    # int8 checkpoints (see example/quantize_model.py) are rebuilt on cpu before loading
+    quantization = model_config.get("quantization")
+    # adapter checkpoints (LoRA finetuning, see LOREKT lora_rank) hold only the trained parameters, the others are in the backbone
+    lora_backbone_path = model_config.get("lora_backbone_path")
+    model_config = {k: v for k, v in model_config.items() if k not in ("quantization", "lora_backbone_path")}
     model = init_model(model_name, model_config, data_config, emb_type, args, mode=mode)
+    if quantization is not None:
+        model = quantize_from_config(model, quantization)
     origin_state_dict = model.state_dict()
 
-    net = torch.load(os.path.join(ckpt_path, emb_type+"_model.module.ckpt"),map_location="cpu")
+    adapter_path = os.path.join(ckpt_path, emb_type+"_adapter.ckpt")
+    if os.path.exists(adapter_path):
+        print(f'loading the backbone of the adapters from {lora_backbone_path} ...')
+        net = torch.load(os.path.join(lora_backbone_path, emb_type+"_model.module.ckpt"),map_location="cpu")
+        net.update(torch.load(adapter_path, map_location="cpu"))
+    else:
+        net = torch.load(os.path.join(ckpt_path, emb_type+"_model.module.ckpt"),map_location="cpu")
     opt = None
     if optimizer and finetune:
         try:
-            if optimizer == "sgd":
-                opt = SGD(model.parameters(), 1e-4, momentum=0.9)
-            elif optimizer == "adam":
-                opt = Adam(model.parameters(), 1e-4)
+            opt = init_optimizer(model, optimizer, 1e-4)
             opt_state_dict = torch.load(os.path.join(ckpt_path, "opt.ckpt"),map_location="cpu")
             print(f'loading optimizer for further training from {ckpt_path} ...')
             opt.load_state_dict(opt_state_dict)
@@ -196,6 +203,10 @@ def load_model(model_name, model_config, data_config, emb_type, ckpt_path, args=
             else:
                 k = k.replace('features.module.', 'module.features.')
             new_state_dict[k] = v
+        # the new adapters of LoRA finetuning start from their initialization
+        for k, v in origin_state_dict.items():
+            if "lora_" in k and k not in new_state_dict:
+                new_state_dict[k] = v
         print(f'load state dict for further training from {ckpt_path} ...')
         model.load_state_dict(new_state_dict)
     return model, opt
\ No newline at end of file
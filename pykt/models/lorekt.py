@@ -1,18 +1,15 @@
 import torch
 from torch import nn
-from torch.nn.init import xavier_uniform_
-from torch.nn.init import constant_
 import math
-import torch.nn.functional as F
 from enum import IntEnum
-import numpy as np
-from .utils import transformer_FFN, ut_mask, pos_encode, get_clones
+from .utils import transformer_FFN, ut_mask, pos_encode, get_clones, pooled_concept_emb
 from torch.nn import Module, Embedding, LSTM, Linear, Dropout, LayerNorm, TransformerEncoder, TransformerEncoderLayer, \
         MultiLabelMarginLoss, MultiLabelSoftMarginLoss, CrossEntropyLoss, BCELoss, MultiheadAttention
 from torch.nn.functional import one_hot, cross_entropy, multilabel_margin_loss, binary_cross_entropy
 from .que_base_model import QueBaseModel,QueEmb
 from torch.utils.checkpoint import checkpoint
 import torch.nn.init as nn_init
+from .transformer_utils import TransformerLayer as BaseTransformerLayer, causal_mask, segment_mask, segment_positions
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -28,7 +25,8 @@ class LOREKT(nn.Module):
             kq_same=1, final_fc_dim=512, final_fc_dim2=256, num_attn_heads=8, separate_qa=False, 
             l2=1e-5, emb_type="qid", emb_path="", pretrain_dim=768, cf_weight=0.3, t_weight=0.3, local_rank=1, 
             num_sgap=None, c0=0, max_epoch=0, dataset_special_token_num=1, q_special_token_num=5, c_special_token_num=5, 
-            use_qc_emb=1, add_dataset_embed=1, concat_dataset_embed=1, use_qc_placeholder_embed=1, inference_ensemble=0, **kwargs): 
+            use_qc_emb=1, add_dataset_embed=1, concat_dataset_embed=1, use_qc_placeholder_embed=1, inference_ensemble=0, sparse_emb=0, mem_len=0, pruned_layers=None, 
+            lora_rank=0, lora_alpha=16, lora_dropout=0., lora_targets="k_linear,v_linear,out_proj,linear1,linear2", **kwargs): 
         super().__init__()
         """
         Input:
@@ -37,6 +35,14 @@ class LOREKT(nn.Module):
             num_attn_heads: number of heads in multi-headed attention
             d_ff : dimension for fully conntected net inside the basic block
             kq_same: if key query same, kq_same=1, else = 0
+            sparse_emb: question/concept tables get sparse gradients, updated row-wise by the optimizer from init_optimizer
+            mem_len: segment recurrence, the layer inputs of the last mem_len positions of the previous segments of a lane are
+                attended as memory (Transformer-XL style), fed by datasets.que_stream_loader.KTQueStreamLoader. 0 is off.
+            pruned_layers: per block {"heads": [...], "neurons": [...]}, the heads and d_ff neurons kept by structured pruning
+                (see models.prune_utils), so a pruned checkpoint can be rebuilt with its reduced shapes
+            lora_rank: adapter finetuning, the lora_targets linears of every block get low-rank adapters of this rank
+                (transformer_utils.LoRALinear) and only the adapters, the dataset embedding and the output head are trained,
+                the other parameters are frozen. 0 is off.
         """
         self.model_name = "lorekt"
         print(f"model_name: {self.model_name}, emb_type: {emb_type}")
@@ -59,13 +65,19 @@ class LOREKT(nn.Module):
         self.concat_dataset_embed = concat_dataset_embed
         self.use_qc_placeholder_embed = use_qc_placeholder_embed
         self.inference_ensemble = inference_ensemble
+        self.sparse_emb = bool(sparse_emb)
+        self.mem_len = mem_len
+        self.mems = None
+        self.lora_rank = lora_rank
+        # tables read with F.embedding_bag(..., sparse=True), see optim_utils.get_sparse_params
+        self.sparse_param_names = ["concept_emb"] if self.sparse_emb and self.use_qc_emb else []
 
         if self.inference_ensemble:
             print('using inference ensemble technique ...')
 
 
         if self.use_qc_emb:
-            self.que_emb = nn.Embedding(self.n_pid+1, self.embed_l).to(device) #question embeding
+            self.que_emb = nn.Embedding(self.n_pid+1, self.embed_l, sparse=self.sparse_emb).to(device) #question embeding
             self.concept_emb = nn.Parameter(torch.randn(self.n_question+1, self.embed_l).to(device), requires_grad=True)#concept embeding
         else:
             self.c_bias = nn.Parameter(torch.FloatTensor(1, 1, self.embed_l).to(device), requires_grad=True) # add bias
@@ -102,6 +114,9 @@ class LOREKT(nn.Module):
         # Architecture Object. It contains stack of attention block
         self.model = Architecture(n_question=n_question, n_blocks=n_blocks, n_heads=num_attn_heads, dropout=dropout,
                                     d_model=d_model, d_feature=d_model / num_attn_heads, d_ff=d_ff,  kq_same=self.kq_same, model_type=self.model_type, seq_len=seq_len)
+        if pruned_layers:
+            for block, kept in zip(self.model.blocks_2, pruned_layers):
+                block.prune(kept["heads"], kept["neurons"])
         if self.concat_dataset_embed:
             self.out = nn.Sequential(
                 nn.Linear(d_model + self.embed_l*2,
@@ -137,6 +152,16 @@ class LOREKT(nn.Module):
                 nn.Linear(final_fc_dim2, 1)
             )
         self.reset()
+        if self.lora_rank > 0:
+            for block in self.model.blocks_2:
+                block.add_lora(lora_targets.split(","), lora_rank, lora_alpha, lora_dropout)
+            for name, p in self.named_parameters():
+                p.requires_grad = "lora_" in name or name.split(".")[0] in ("dataset_emb", "out")
+
+    def adapter_state_dict(self):
+        """the trained parameters of adapter finetuning, saved instead of the full state dict (see load_model)"""
+        trained = {name for name, p in self.named_parameters() if p.requires_grad}
+        return {k: v for k, v in self.state_dict().items() if k in trained}
 
     def reset(self):
         for p in self.parameters():
@@ -145,25 +170,17 @@ class LOREKT(nn.Module):
 
     def get_avg_skill_emb(self, c, dataset_emb=None):
 
-        related_concepts = (c+1).long()
-
         if self.use_qc_emb:
-            # add zero for padding
-            concept_emb_cat = torch.cat(
-                [torch.zeros(1, self.embed_l).to(device), 
-                self.concept_emb], dim=0)
-            #[batch_size, seq_len, max_concept, emb_dim]
-            concept_emb_sum = concept_emb_cat[related_concepts, :].sum(
-                axis=-2)
-        else:
-            concept_emb = self.concept_place_embed.sum(1, keepdim=True)
+            #[batch_size, seq_len, emb_dim], -1 is padding
+            return pooled_concept_emb(self.concept_emb, c, sparse=self.sparse_emb)
 
-            expand_related_concepts = related_concepts.unsqueeze(-1)
-            
-            concept_emb_sum = (concept_emb.unsqueeze(0) * expand_related_concepts.float()).sum(axis=-2) + self.c_bias
-            concept_emb_sum = self.c_align_layer(concept_emb_sum)
-            
+        related_concepts = (c+1).long()
+        concept_emb = self.concept_place_embed.sum(1, keepdim=True)
 
+        expand_related_concepts = related_concepts.unsqueeze(-1)
+        
+        concept_emb_sum = (concept_emb.unsqueeze(0) * expand_related_concepts.float()).sum(axis=-2) + self.c_bias
+        concept_emb_sum = self.c_align_layer(concept_emb_sum)
 
         #[batch_size, seq_len,1]
         concept_num = torch.where(related_concepts != 0, 1, 0).sum(
@@ -172,7 +189,91 @@ class LOREKT(nn.Module):
         concept_avg = (concept_emb_sum / concept_num)
         return concept_avg
 
-    
+    def embed_questions(self, pid_data, q_data, dataset_embed_data=None):
+        """the question embeddings (question + average concept, and the dataset embedding if added) [*, emb_size]
+
+        Args:
+            pid_data (torch.tensor): question ids [*]
+            q_data (torch.tensor): concept ids [*, max_concepts], -1 is padding
+            dataset_embed_data (torch.tensor, optional): the dataset embeddings broadcast to the questions. Defaults to None.
+        """
+        if self.use_qc_emb:
+            emb_q = self.que_emb(pid_data)
+            emb_c = self.get_avg_skill_emb(q_data)
+        else:
+            question_emb = self.question_place_embed.sum(1, keepdim=True)
+            emb_q = question_emb * pid_data.unsqueeze(-1).float() + self.q_bias
+            emb_q = self.q_align_layer(emb_q)
+            emb_c = self.get_avg_skill_emb(q_data)
+
+        if self.use_qc_placeholder_embed:
+            emb_q = emb_q + self.question_place_embed.sum(1, keepdim=True)
+            emb_c = emb_c + self.concept_place_embed.sum(1, keepdim=True)
+
+        if dataset_embed_data is not None:
+            return emb_q + emb_c + dataset_embed_data
+        return emb_q + emb_c
+
+    def reset_mems(self):
+        self.mems = None
+
+    def get_mems(self, new_seqs, x):
+        """the memory of the batch lanes, the lanes starting a new student see no memory
+
+        Args:
+            new_seqs (torch.tensor): [bs] bool
+            x (torch.tensor): [bs, seqlen, d_model] the input of the segment
+
+        Returns:
+            (tuple): inputs of each layer [bs, mem, d_model], values [bs, mem, d_model] and validity [bs, mem] of the memory
+        """
+        bs = x.size(0)
+        if self.mems is None or self.mems[2].size(0) != bs:
+            empty = x.new_zeros(bs, 0, x.size(-1))
+            self.mems = ([empty] * len(self.model.blocks_2), empty, torch.zeros(bs, 0, dtype=torch.bool, device=x.device))
+        mem_xs, mem_y, mem_valid = self.mems
+        return mem_xs, mem_y, mem_valid & ~new_seqs.bool()[:, None]
+
+    def update_mems(self, mems, hiddens, values, valid):
+        """append the segment to the memory, except its last position which is the first one of the next segment"""
+        mem_xs, mem_y, mem_valid = mems
+        def append(mem, cur):
+            return torch.cat((mem, cur[:, :-1].detach()), dim=1)[:, -self.mem_len:]
+        self.mems = ([append(m, h) for m, h in zip(mem_xs, hiddens)], append(mem_y, values), append(mem_valid, valid))
+
+    def concat_features(self, d_output, q_embed_data, dataset_embed_data=None):
+        """the input of the heads (out, qclasifier), the backbone output next to the question embedding and the dataset embedding
+
+        Args:
+            d_output (torch.tensor): [bs, seqlen, d_model]
+            q_embed_data (torch.tensor): [bs, seqlen, d_model]
+            dataset_embed_data (torch.tensor, optional): [bs, 1, d_model], with concat_dataset_embed. Defaults to None.
+        """
+        if dataset_embed_data is not None:
+            return torch.cat([d_output, q_embed_data, dataset_embed_data.expand(-1, d_output.size(1), -1)], dim=-1)
+        return torch.cat([d_output, q_embed_data], dim=-1)
+
+    def encode(self, dcur, soft_mask=None):
+        """the backbone part of forward, without the heads
+
+        Returns:
+            (tuple): d_output [bs, seqlen, d_model] and q_embed_data [bs, seqlen, d_model]
+        """
+        assert self.emb_type.find("pt") == -1, "encode does not support the time gaps!"
+        q, c, r = dcur["qseqs"].long().to(device), dcur["cseqs"].long().to(device), dcur["rseqs"].long().to(device)
+        qshft, cshft, rshft = dcur["shft_qseqs"].long().to(device), dcur["shft_cseqs"].long().to(device), dcur["shft_rseqs"].long().to(device)
+        dataset_embed_data = None
+        if self.add_dataset_embed:
+            dataset_embed_data = self.dataset_emb(dcur["dataset_id"].long().to(device)).unsqueeze(1)
+        pid_data = torch.cat((q[:,0:1], qshft), dim=1)
+        q_data = torch.cat((c[:,0:1], cshft), dim=1)
+        target = torch.cat((r[:,0:1], rshft), dim=1)
+        q_embed_data = self.embed_questions(pid_data, q_data, dataset_embed_data)
+        qa_embed_data = q_embed_data + self.qa_embed(target)
+        segs = dcur["segs"].long().to(device) if "segs" in dcur else None
+        d_output = self.model((q_embed_data, qa_embed_data, soft_mask), segs=segs)
+        return d_output, q_embed_data
+
     def forward(self, dcur, qtest=False, train=False, dgaps=None, soft_mask=None):
 
         q, c, r = dcur["qseqs"].long().to(device), dcur["cseqs"].long().to(device), dcur["rseqs"].long().to(device)
@@ -189,36 +290,7 @@ class LOREKT(nn.Module):
         q_data = torch.cat((c[:,0:1], cshft), dim=1)
         target = torch.cat((r[:,0:1], rshft), dim=1)
 
-        if self.use_qc_emb:
-
-            emb_q = self.que_emb(pid_data)#[batch,max_len-1,emb_size]
-
-            emb_c = self.get_avg_skill_emb(q_data)#[batch,max_len-1,emb_size]
-
-        else:
-
-            question_emb = self.question_place_embed.sum(1, keepdim=True)
-            
-  
-            expand_pid_data = pid_data.unsqueeze(-1)
-
-            emb_q = question_emb * expand_pid_data.float() + self.q_bias
-            emb_q = self.q_align_layer(emb_q)
-            
-
-            emb_c = self.get_avg_skill_emb(q_data)
-            
-
-        if self.use_qc_placeholder_embed:
-            emb_q = emb_q + self.question_place_embed.sum(1, keepdim=True)
-            emb_c = emb_c + self.concept_place_embed.sum(1, keepdim=True)
-
-        
-
-        if self.add_dataset_embed:
-            q_embed_data = emb_q + emb_c + dataset_embed_data
-        else:
-            q_embed_data = emb_q + emb_c
+        q_embed_data = self.embed_questions(pid_data, q_data, dataset_embed_data if self.add_dataset_embed else None)
         
         if self.emb_type.find("pt") != -1:
             sg, sgshft = dgaps["sgaps"].long(), dgaps["shft_sgaps"].long()
@@ -235,12 +307,17 @@ class LOREKT(nn.Module):
         y2, y3 = 0, 0
 
 
-        d_output = self.model((q_embed_data, qa_embed_data, soft_mask))
-
-        if self.concat_dataset_embed:
-            concat_q = torch.cat([d_output, q_embed_data, dataset_embed_data.expand(-1, d_output.size(1), -1)], dim=-1)
+        if self.mem_len > 0 and "new_seqs" in dcur:
+            mems = self.get_mems(dcur["new_seqs"].to(device), q_embed_data)
+            d_output, (hiddens, values) = self.model((q_embed_data, qa_embed_data, soft_mask), mems=mems)
+            valid = torch.cat((dcur["masks"][:, 0:1], dcur["masks"]), dim=1).bool().to(device)
+            self.update_mems(mems, hiddens, values, valid)
         else:
-            concat_q = torch.cat([d_output, q_embed_data], dim=-1)
+            # packed rows (see datasets.pack_utils) carry the segment id of each position
+            segs = dcur["segs"].long().to(device) if "segs" in dcur else None
+            d_output = self.model((q_embed_data, qa_embed_data, soft_mask), segs=segs)
+
+        concat_q = self.concat_features(d_output, q_embed_data, dataset_embed_data if self.concat_dataset_embed else None)
 
 
         output = self.out(concat_q).squeeze(-1)
@@ -290,6 +367,86 @@ class LOREKT(nn.Module):
             else:
                 return preds
 
+    def score_candidates(self, dcur, cand_q, cand_c, chunk_size=4096, soft_mask=None):
+        """the probabilities that the students answer each candidate question correctly as their next interaction.
+        The histories are encoded once, then every candidate is a query of the last position attending to the cached
+        keys / values of each block, so the candidates are scored in batched passes instead of one forward each.
+
+        Args:
+            dcur (dict): the histories, a batch of KTQueDataset, the last valid position is the last interaction;
+                at most seq_len - 1 interactions, so the candidate position has a positional embedding
+            cand_q (torch.tensor): the candidate questions [N], shared by the students
+            cand_c (torch.tensor): their concepts [N, max_concepts], -1 is padding
+            chunk_size (int, optional): number of candidates of one pass. Defaults to 4096.
+            soft_mask (dict, optional): the soft masks of finetuning. Defaults to None.
+
+        Returns:
+            torch.tensor: [bs, N]
+        """
+        assert self.emb_type.find("pt") == -1, "candidate scoring does not support the time gaps!"
+        q, c, r = dcur["qseqs"].long().to(device), dcur["cseqs"].long().to(device), dcur["rseqs"].long().to(device)
+        qshft, cshft, rshft = dcur["shft_qseqs"].long().to(device), dcur["shft_cseqs"].long().to(device), dcur["shft_rseqs"].long().to(device)
+        pid_data = torch.cat((q[:,0:1], qshft), dim=1)
+        q_data = torch.cat((c[:,0:1], cshft), dim=1)
+        target = torch.cat((r[:,0:1], rshft), dim=1)
+        bs, seqlen = pid_data.size()
+        lens = dcur["masks"].long().to(device).sum(1) + 1
+        assert lens.max() < self.model.position_emb.weight.size(1), "the histories must be shorter than seq_len!"
+
+        dataset_embed_data = None
+        if self.add_dataset_embed or self.concat_dataset_embed:
+            dataset_embed_data = self.dataset_emb(dcur["dataset_id"].long().to(device)).unsqueeze(1)
+        q_embed_data = self.embed_questions(pid_data, q_data, dataset_embed_data if self.add_dataset_embed else None)
+        qa_embed_data = q_embed_data + self.qa_embed(target)
+
+        # the inputs of each block and the values of the histories, as the memory of Architecture.forward
+        empty = q_embed_data.new_zeros(bs, 0, q_embed_data.size(-1))
+        mems = ([empty] * len(self.model.blocks_2), empty, torch.zeros(bs, 0, dtype=torch.bool, device=device))
+        _, (hiddens, values) = self.model((q_embed_data, qa_embed_data, soft_mask), mems=mems)
+
+        # the candidates see every interaction of the history
+        visible = torch.arange(seqlen, device=device)[None, :] < lens[:, None]
+        cand_posemb = self.model.position_emb(None, lens.unsqueeze(1))
+        cand_q, cand_c = cand_q.long().to(device), cand_c.long().to(device)
+        preds = []
+        for start in range(0, cand_q.size(0), chunk_size):
+            cand_embed = self.embed_questions(cand_q[None, start:start+chunk_size], cand_c[None, start:start+chunk_size],
+                                              dataset_embed_data if self.add_dataset_embed else None)
+            cand_embed = cand_embed.expand(bs, -1, -1)
+            num_cands = cand_embed.size(1)
+            mask = visible[:, None, None, :].expand(-1, 1, num_cands, -1)
+            x = cand_embed + cand_posemb
+            for idx, block in enumerate(self.model.blocks_2):
+                x = block(x, hiddens[idx], values, idx, soft_mask, mask)
+            if self.concat_dataset_embed:
+                concat_q = torch.cat([x, cand_embed, dataset_embed_data.expand(-1, num_cands, -1)], dim=-1)
+            else:
+                concat_q = torch.cat([x, cand_embed], dim=-1)
+            preds.append(torch.sigmoid(self.out(concat_q).squeeze(-1)))
+        return torch.cat(preds, dim=1)
+
+    def recommend(self, dcur, cand_q, cand_c, k=10, target_difficulty=0.7, exclude=None, chunk_size=4096):
+        """the k candidate questions of each student whose predicted correctness is the closest to target_difficulty
+
+        Args:
+            dcur (dict): the histories, see score_candidates
+            cand_q (torch.tensor): the candidate questions [N]
+            cand_c (torch.tensor): their concepts [N, max_concepts]
+            k (int, optional): Defaults to 10.
+            target_difficulty (float, optional): the desired probability of a correct answer. Defaults to 0.7.
+            exclude (torch.tensor, optional): [bs, N] bool, candidates not to recommend (e.g. already answered). Defaults to None.
+            chunk_size (int, optional): Defaults to 4096.
+
+        Returns:
+            (tuple): the indices in the pool [bs, k] and their predictions [bs, k]
+        """
+        preds = self.score_candidates(dcur, cand_q, cand_c, chunk_size=chunk_size)
+        distance = (preds - target_difficulty).abs()
+        if exclude is not None:
+            distance = distance.masked_fill(exclude.to(device), float("inf"))
+        _, indices = torch.topk(distance, min(k, preds.size(1)), dim=1, largest=False)
+        return indices, preds.gather(1, indices)
+
 class Architecture(nn.Module):
     def __init__(self, n_question,  n_blocks, d_model, d_feature,
                  d_ff, n_heads, dropout, kq_same, model_type, seq_len):
@@ -311,15 +468,20 @@ class Architecture(nn.Module):
             ])
         self.position_emb = CosinePositionalEmbedding(d_model=self.d_model, max_len=seq_len)
 
-    def forward(self, inputs):
+    def forward(self, inputs, segs=None, mems=None):
         # target shape  bs, seqlen
+        # segs: [bs, seqlen] segment ids of packed rows, the attention is block-diagonal causal and the positions restart at each segment
+        # mems: memory of the previous segments (see LOREKT.get_mems), attended before the segment, then the layer inputs are returned too
 
         q_embed_data, qa_embed_data, soft_mask = inputs
         seqlen, batch_size = q_embed_data.size(1), q_embed_data.size(0)
 
-        q_posemb = self.position_emb(q_embed_data)
+        mask, positions = 0, None
+        if segs is not None:
+            mask, positions = segment_mask(segs, 0), segment_positions(segs)
+        q_posemb = self.position_emb(q_embed_data, positions)
         q_embed_data = q_embed_data + q_posemb
-        qa_posemb = self.position_emb(qa_embed_data)
+        qa_posemb = self.position_emb(qa_embed_data, positions)
         qa_embed_data = qa_embed_data + qa_posemb
 
         qa_pos_embed = qa_embed_data
@@ -329,187 +491,42 @@ class Architecture(nn.Module):
         seqlen, batch_size = y.size(1), y.size(0)
         x = q_pos_embed
 
-        # encoder
+        if mems is not None:
+            mem_xs, mem_y, mem_valid = mems
+            mem_mask = mem_valid[:, None, None, :].expand(-1, 1, seqlen, -1)
+            mask = torch.cat([mem_mask, causal_mask(seqlen, 0, y.device).expand(batch_size, -1, -1, -1)], dim=-1)
+            values = torch.cat([mem_y, y], dim=1)
+            hiddens = []
 
+        # encoder
+        # reentrant checkpointing leaves the block parameters without gradients when no input needs one (adapters over frozen embeddings)
+        use_reentrant = x.requires_grad or y.requires_grad
         for idx, block in enumerate(self.blocks_2):
            
-            x = checkpoint(block, x, x, y, idx, soft_mask)
+            if mems is None:
+                x = checkpoint(block, x, x, y, idx, soft_mask, mask, use_reentrant=use_reentrant)
+            else:
+                hiddens.append(x)
+                x = checkpoint(block, x, torch.cat([mem_xs[idx], x], dim=1), values, idx, soft_mask, mask, use_reentrant=use_reentrant)
         
+        if mems is not None:
+            return x, (hiddens, y)
         return x
 
-class TransformerLayer(nn.Module):
-    def __init__(self, d_model, d_feature,
-                 d_ff, n_heads, dropout,  kq_same):
-        super().__init__()
-        """
-            This is a Basic Block of Transformer paper. It containts one Multi-head attention object. Followed by layer norm and postion wise feedforward net and dropout layer.
-        """
-        kq_same = kq_same == 1
-        # Multi-Head Attention Block
-        self.masked_attn_head = MultiHeadAttention(
-            d_model, d_feature, n_heads, dropout, kq_same=kq_same)
-
-        # Two layer norm layer and two droput layer
-        self.layer_norm1 = nn.LayerNorm(d_model)
-        self.dropout1 = nn.Dropout(dropout)
-
-        self.linear1 = nn.Linear(d_model, d_ff)
-        self.activation = nn.ReLU()
-        self.dropout = nn.Dropout(dropout)
-        self.linear2 = nn.Linear(d_ff, d_model)
-
-        self.layer_norm2 = nn.LayerNorm(d_model)
-        self.dropout2 = nn.Dropout(dropout)
-
-
-    def forward(self, query, key, values, idx=None, soft_mask=None):
+class TransformerLayer(BaseTransformerLayer):
+    def forward(self, query, key, values, idx=None, soft_mask=None, mask=0):
         """
         Input:
-            block : object of type BasicBlock(nn.Module). It contains masked_attn_head objects which is of type MultiHeadAttention(nn.Module).
-            mask : 0 means, it can peek only past values. 1 means, block can peek only current and pas values
-            query : Query. In transformer paper it is the input for both encoder and decoder
-            key : Keys. In transformer paper it is the input for both encoder and decoder
-            Values. In transformer paper it is the input for encoder and  encoded output for decoder (in masked attention part)
+            query, key, values : see transformer_utils.TransformerLayer, the blocks of LoReKT can peek only past values (mask=0)
+            idx : index of the layer, used to look up the soft masks
+            soft_mask : dict of the soft masks of attention heads, input_projection and output_projection
+            mask : 0, or the block-diagonal causal mask of packed rows
 
         Output:
             query: Input gets changed over the layer and returned.
 
         """
-        mask = 0
-        apply_pos=True
-        seqlen, batch_size = query.size(1), query.size(0)
-        nopeek_mask = np.triu(
-            np.ones((1, 1, seqlen, seqlen)), k=mask).astype('uint8')
-        src_mask = (torch.from_numpy(nopeek_mask) == 0).to(device)
-
-        if mask == 0:  # If 0, zero-padding is needed.
-            # Calls block.masked_attn_head.forward() method
-            query2 = self.masked_attn_head(
-                query, key, values, mask=src_mask, zero_pad=True, idx=idx, soft_mask=soft_mask) # 只能看到之前的信息，当前的信息也看不到，此时会把第一行score全置0，表示第一道题看不到历史的interaction信息，第一题attn之后，对应value全0
-        else:
-            query2 = self.masked_attn_head(
-                query, key, values, mask=src_mask, zero_pad=False, soft_mask=soft_mask)
-
-        query = query + self.dropout1((query2)) # 残差1
-        query = self.layer_norm1(query) # layer norm
-        if apply_pos:
-
-            hidden_1 = self.linear1(query)
-            if soft_mask:
-                if soft_mask['input_projection'] != None:
-                    hidden_1 = hidden_1 * soft_mask['input_projection'][idx] #softmask
-            hidden_1_act = self.activation(hidden_1)
-            hidden_1_act_drop = self.dropout(hidden_1_act)
-
-
-            hidden_2 = self.linear2(hidden_1_act_drop)
-            if soft_mask:
-                if soft_mask['output_projection'] != None:
-                    hidden_2 = hidden_2 * soft_mask['output_projection'][idx] #softmask
-            query = query + self.dropout2(hidden_2)
-            query = self.layer_norm2(query) # lay norm
-
-   
-        return query
-
-
-class MultiHeadAttention(nn.Module):
-    def __init__(self, d_model, d_feature, n_heads, dropout, kq_same, bias=True):
-        super().__init__()
-        """
-        It has projection layer for getting keys, queries and values. Followed by attention and a connected layer.
-        """
-        self.d_model = d_model
-        self.d_k = d_feature
-        self.h = n_heads
-        self.kq_same = kq_same
-
-        self.v_linear = nn.Linear(d_model, d_model, bias=bias)
-        self.k_linear = nn.Linear(d_model, d_model, bias=bias)
-        if kq_same is False:
-            self.q_linear = nn.Linear(d_model, d_model, bias=bias)
-        self.dropout = nn.Dropout(dropout)
-        self.proj_bias = bias
-        self.out_proj = nn.Linear(d_model, d_model, bias=bias)
-
-        self._reset_parameters()
-
-    def _reset_parameters(self):
-        xavier_uniform_(self.k_linear.weight)
-        xavier_uniform_(self.v_linear.weight)
-        if self.kq_same is False:
-            xavier_uniform_(self.q_linear.weight)
-
-        if self.proj_bias:
-            constant_(self.k_linear.bias, 0.)
-            constant_(self.v_linear.bias, 0.)
-            if self.kq_same is False:
-                constant_(self.q_linear.bias, 0.)
-            constant_(self.out_proj.bias, 0.)
-
-    def forward(self, q, k, v, mask, zero_pad, idx=None, soft_mask=None):
-
-        bs = q.size(0)
-
-
-        k = self.k_linear(k).view(bs, -1, self.h, self.d_k)
-        if self.kq_same is False:
-            q = self.q_linear(q).view(bs, -1, self.h, self.d_k)
-        else:
-            q = self.k_linear(q).view(bs, -1, self.h, self.d_k)
-        v = self.v_linear(v).view(bs, -1, self.h, self.d_k)
-
-        # transpose to get dimensions bs * h * sl * d_model
-
-
-        k = k.transpose(1, 2)
-        q = q.transpose(1, 2)
-        v = v.transpose(1, 2)
-        # calculate attention using function we will define next
-
-        scores = attention(q, k, v, self.d_k,
-                           mask, self.dropout, zero_pad, idx=idx, soft_mask=soft_mask)
-
-        # concatenate heads and put through final linear layer
-
-        concat = scores.transpose(1, 2).contiguous()\
-            .view(bs, -1, self.d_model)
-
-        output = self.out_proj(concat)
-
-        return output
-
-
-def attention(q, k, v, d_k, mask, dropout, zero_pad, idx=None,soft_mask=None):
-    """
-    This is called by Multi-head atention object to find the values.
-    """
-
-    scores = torch.matmul(q, k.transpose(-2, -1)) / \
-        math.sqrt(d_k)  # BS, 8, seqlen, seqlen
-    bs, head, seqlen = scores.size(0), scores.size(1), scores.size(2)
-
-    scores.masked_fill_(mask == 0, -1e32)
-    scores = F.softmax(scores, dim=-1)  # BS,8,seqlen,seqlen
-
-    if zero_pad:
-        pad_zero = torch.zeros(bs, head, 1, seqlen).to(device)
-        scores = torch.cat([pad_zero, scores[:, :, 1:, :]], dim=2) # 第一行score置0
-    # print(f"after zero pad scores: {scores}")
-
-    #! batch, head_num, seq_len, seq_len
-    scores = dropout(scores)
-
-    #softmask
-    if soft_mask:
-        if soft_mask['attention'] != None:
-            scores= scores * soft_mask['attention'][idx].unsqueeze(0).unsqueeze(2).unsqueeze(3)
-        # scores= scores * soft_mask['attention'][idx]
-
-    output = torch.matmul(scores, v)
-    # import sys
-    # sys.exit()
-    return output
+        return super().forward(mask, query, key, values, apply_pos=True, idx=idx, soft_mask=soft_mask)
 
 
 class LearnablePositionalEmbedding(nn.Module):
@@ -537,5 +554,7 @@ class CosinePositionalEmbedding(nn.Module):
         pe = pe.unsqueeze(0)
         self.weight = nn.Parameter(pe, requires_grad=False)
 
-    def forward(self, x):
+    def forward(self, x, positions=None):
+        if positions is not None:
+            return self.weight[0, positions, :]  # ( bs,seq,  Feature)
         return self.weight[:, :x.size(Dim.seq), :]  # ( 1,seq,  Feature)
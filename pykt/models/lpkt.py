@@ -144,4 +144,62 @@ class LPKT(nn.Module):
         if not qtest:
             return pred
         else:
-            return pred, hidden_state[:,:-1,:], e_embed_data
\ No newline at end of file
+            return pred, hidden_state[:,:-1,:], e_embed_data
+
+    def init_state(self, batch_size):
+        """the knowledge state of new students, (h_pre, learning_pre), h_pre is initialized as in forward"""
+        h_pre = nn.init.xavier_uniform_(torch.zeros(self.n_question + 1, self.d_k)).repeat(batch_size, 1, 1).to(device)
+        learning_pre = torch.zeros(batch_size, self.d_k).to(device)
+        return (h_pre, learning_pre)
+
+    def step(self, state, e, a=None, it=None, at=None):
+        """
+        one interaction of each student from the cached state, instead of replaying the history.
+        e: the exercises [batch_size], a: the responses [batch_size], None only predicts,
+        it: the interval times [batch_size] (use_time), at: the answer times [batch_size], optional.
+        Returns the new state and the prediction of e made before its response [batch_size].
+        """
+        h_pre, learning_pre = state
+        batch_size = e.size(0)
+        e_embed = self.e_embed(e)
+        q_e = self.q_matrix[e].view(batch_size, 1, -1).to(device)
+        c_tilde = torch.unsqueeze(torch.sum(torch.squeeze(q_e, dim=1), 1), -1)
+        h_tilde = q_e.bmm(h_pre).view(batch_size, self.d_k) / c_tilde
+
+        # Predicting Module
+        prob = self.sig(self.linear_5(torch.cat((e_embed, h_tilde), 1))).sum(1) / self.d_k
+        if a is None:
+            return state, prob
+
+        # Learning Module
+        a = a.view(-1, 1).repeat(1, self.d_a).float()
+        if self.use_time and at is not None:
+            learning = self.linear_1(torch.cat((e_embed, self.at_embed(at), a), 1))
+        else:
+            learning = self.linear_0(torch.cat((e_embed, a), 1))
+        if self.use_time:
+            it = self.it_embed(it)
+            learning_gain = self.tanh(self.linear_2(torch.cat((learning_pre, it, learning, h_tilde), 1)))
+            gamma_l = self.linear_3(torch.cat((learning_pre, it, learning, h_tilde), 1))
+        else:
+            learning_gain = self.tanh(self.linear_6(torch.cat((learning_pre, learning, h_tilde), 1)))
+            gamma_l = self.linear_7(torch.cat((learning_pre, learning, h_tilde), 1))
+        gamma_l = self.sig(gamma_l)
+        LG = gamma_l * ((learning_gain + 1) / 2)
+        LG_tilde = self.dropout(q_e.transpose(1, 2).bmm(LG.view(batch_size, 1, -1)))
+
+        # Forgetting Module
+        n_skill = LG_tilde.size(1)
+        if self.use_time:
+            gamma_f = self.sig(self.linear_4(torch.cat((
+                h_pre,
+                LG.repeat(1, n_skill).view(batch_size, -1, self.d_k),
+                it.repeat(1, n_skill).view(batch_size, -1, self.d_k)
+            ), 2)))
+        else:
+            gamma_f = self.sig(self.linear_8(torch.cat((
+                h_pre,
+                LG.repeat(1, n_skill).view(batch_size, -1, self.d_k)
+            ), 2)))
+        h = LG_tilde + gamma_f * h_pre
+        return (h, learning), prob
@@ -0,0 +1,92 @@
+import torch
+from torch.optim import SGD, Adam, SparseAdam
+
+
+class MultiOptimizer:
+    """ Drive several optimizers over disjoint parameter sets as a single one (e.g. SparseAdam for the
+    sparse-gradient embedding tables and Adam for the rest), exposing the parts of the optimizer
+    interface used by train_model and load_model.
+
+    Args:
+        optimizers (list): torch.optim optimizers
+    """
+    def __init__(self, optimizers):
+        self.optimizers = optimizers
+
+    @property
+    def param_groups(self):
+        return [group for opt in self.optimizers for group in opt.param_groups]
+
+    def step(self):
+        for opt in self.optimizers:
+            opt.step()
+
+    def zero_grad(self, set_to_none=True):
+        for opt in self.optimizers:
+            opt.zero_grad(set_to_none=set_to_none)
+
+    def state_dict(self):
+        states = [opt.state_dict() for opt in self.optimizers]
+        return {"param_groups": [group for state in states for group in state["param_groups"]], "optimizers": states}
+
+    def load_state_dict(self, state_dict):
+        assert len(state_dict["optimizers"]) == len(self.optimizers), "the saved optimizer has a different number of parts!"
+        for opt, state in zip(self.optimizers, state_dict["optimizers"]):
+            opt.load_state_dict(state)
+
+
+def get_sparse_params(model):
+    """ Split the parameters into the ones receiving sparse gradients and the dense ones.
+    Sparse parameters are the weights of nn.Embedding / nn.EmbeddingBag built with sparse=True and the
+    parameters a model lists in its `sparse_param_names` (tables read with F.embedding_bag(..., sparse=True)).
+    Frozen parameters are in neither.
+
+    Args:
+        model (nn.Module): the model, optionally wrapped by DDP
+
+    Returns:
+        (tuple): list of sparse parameters and list of dense parameters
+    """
+    module = model.module if hasattr(model, "module") else model
+    sparse_ids = set()
+    for m in module.modules():
+        if isinstance(m, (torch.nn.Embedding, torch.nn.EmbeddingBag)) and m.sparse:
+            sparse_ids.add(id(m.weight))
+    names = getattr(module, "sparse_param_names", ())
+    for name, p in module.named_parameters():
+        if name in names:
+            sparse_ids.add(id(p))
+    sparse_params, dense_params = [], []
+    for p in module.parameters():
+        # frozen parameters (e.g. the backbone of adapter finetuning) are not optimized
+        if not p.requires_grad:
+            continue
+        (sparse_params if id(p) in sparse_ids else dense_params).append(p)
+    return sparse_params, dense_params
+
+
+def init_optimizer(model, optimizer, learning_rate):
+    """ Build the optimizer of a model. Parameters with sparse gradients are updated row-wise (lazily) by
+    SparseAdam for "adam" and by plain SGD for "sgd", so only the rows referenced in the batch are touched.
+
+    Args:
+        model (nn.Module): the model, optionally wrapped by DDP
+        optimizer (str): "adam" or "sgd"
+        learning_rate (float): learning rate
+
+    Returns:
+        optimizer: a torch optimizer, or a MultiOptimizer when the model has sparse-gradient parameters
+    """
+    sparse_params, dense_params = get_sparse_params(model)
+    if optimizer == "sgd":
+        dense_opt = SGD(dense_params, learning_rate, momentum=0.9)
+        sparse_opt = SGD(sparse_params, learning_rate) if sparse_params else None
+    elif optimizer == "adam":
+        dense_opt = Adam(dense_params, learning_rate)
+        sparse_opt = SparseAdam(sparse_params, learning_rate) if sparse_params else None
+    else:
+        return None
+    if sparse_opt is None:
+        return dense_opt
+    print(f"using sparse {optimizer} for {sum(p.numel() for p in sparse_params)} embedding parameters ..")
+    return MultiOptimizer([dense_opt, sparse_opt])
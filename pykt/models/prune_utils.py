@@ -0,0 +1,53 @@
+import os
+import math
+import numpy as np
+
+
+def load_prune_impt(impt_dirs):
+    """load the head / intermediate importances saved by compute_soft_mask (head_impt.npy, intermediate_impt.npy).
+    The importances are accumulated gradients of the masks, so their magnitude is used, normalized by the max of each layer;
+    with several datasets the max over them is taken, so a unit important for any dataset is kept.
+
+    Args:
+        impt_dirs (list[str]): the {dataset_name}_softmasks dirs
+
+    Returns:
+        (tuple): head importance [n_blocks, n_heads] and intermediate importance [n_blocks, d_ff]
+    """
+    head_impts, intermediate_impts = [], []
+    for impt_dir in impt_dirs:
+        print(f'loading importance from {impt_dir} ...')
+        for name, impts in [("head_impt.npy", head_impts), ("intermediate_impt.npy", intermediate_impts)]:
+            impt = np.abs(np.load(os.path.join(impt_dir, name)))
+            impts.append(impt / np.maximum(impt.max(axis=1, keepdims=True), 1e-12))
+    return np.stack(head_impts).max(0), np.stack(intermediate_impts).max(0)
+
+
+def kept_units(impt, ratio):
+    """the indices (sorted) of the most important units of one layer after removing a ratio of them, at least one is kept"""
+    num_keep = max(1, len(impt) - int(math.floor(len(impt) * ratio)))
+    return sorted(np.argsort(-impt, kind="stable")[:num_keep].tolist())
+
+
+def prune_lorekt(model, head_impt, intermediate_impt, head_ratio, ffn_ratio):
+    """structured pruning of the blocks of LoReKT, in every block the head_ratio least important attention heads and the
+    ffn_ratio least important linear1/linear2 neurons are removed from the weights (see TransformerLayer.prune)
+
+    Args:
+        model (LOREKT): the model, optionally wrapped by DDP, pruned in place
+        head_impt (np.array): [n_blocks, n_heads]
+        intermediate_impt (np.array): [n_blocks, d_ff]
+        head_ratio (float): ratio of the heads removed in each block
+        ffn_ratio (float): ratio of the d_ff neurons removed in each block
+
+    Returns:
+        list: the pruned_layers of the model config, per block {"heads": [...], "neurons": [...]}
+    """
+    module = model.module if hasattr(model, "module") else model
+    pruned_layers = []
+    for idx, block in enumerate(module.model.blocks_2):
+        assert block.kept_heads is None, "the model is already pruned!"
+        heads, neurons = kept_units(head_impt[idx], head_ratio), kept_units(intermediate_impt[idx], ffn_ratio)
+        block.prune(heads, neurons)
+        pruned_layers.append({"heads": heads, "neurons": neurons})
+    return pruned_layers
@@ -0,0 +1,109 @@
+import fnmatch
+import torch
+from torch import nn
+
+try:
+    from torch.ao import quantization as tq
+except ImportError:
+    from torch import quantization as tq
+
+
+def quantizable_linears(model, patterns=None, skip_patterns=None):
+    """the names of the nn.Linear modules of the model to quantize
+
+    Args:
+        model (nn.Module): the model
+        patterns (list[str], optional): fnmatch patterns of the names to keep, None keeps every linear. Defaults to None.
+        skip_patterns (list[str], optional): fnmatch patterns of the names to leave in float. Defaults to None.
+
+    Returns:
+        list[str]
+    """
+    names = []
+    for name, module in model.named_modules():
+        if type(module) is not nn.Linear:
+            continue
+        if patterns and not any(fnmatch.fnmatch(name, p) for p in patterns):
+            continue
+        if skip_patterns and any(fnmatch.fnmatch(name, p) for p in skip_patterns):
+            continue
+        names.append(name)
+    return names
+
+
+class StaticQuantLinear(nn.Module):
+    """a linear with int8 weights and int8 activations, the input scale is observed in the calibration pass"""
+    def __init__(self, linear):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.linear = linear
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def _set_module(model, name, module):
+    parent_name, _, child_name = name.rpartition(".")
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, child_name, module)
+
+
+def quantize_dynamic_linears(model, modules, dtype=torch.qint8):
+    """dynamic int8 quantization of the given linears in place: int8 weights, the activations are quantized on the fly
+
+    Args:
+        model (nn.Module): the model on cpu in eval mode
+        modules (list[str]): names of the linears, see quantizable_linears
+
+    Returns:
+        nn.Module: the model
+    """
+    return tq.quantize_dynamic(model, qconfig_spec=set(modules), dtype=dtype, inplace=True)
+
+
+def prepare_static_linears(model, modules, backend="fbgemm"):
+    """wrap the given linears with quant / dequant stubs and insert the observers of static quantization in place,
+    then run the calibration data through the model and call convert_static_linears
+
+    Args:
+        model (nn.Module): the model on cpu in eval mode
+        modules (list[str]): names of the linears, see quantizable_linears
+        backend (str, optional): fbgemm (x86) or qnnpack (arm). Defaults to "fbgemm".
+
+    Returns:
+        nn.Module: the model
+    """
+    torch.backends.quantized.engine = backend
+    qconfig = tq.get_default_qconfig(backend)
+    for name in modules:
+        wrapper = StaticQuantLinear(model.get_submodule(name))
+        wrapper.qconfig = qconfig
+        _set_module(model, name, wrapper)
+    return tq.prepare(model, inplace=True)
+
+
+def convert_static_linears(model):
+    """replace the observed linears with the quantized ones in place"""
+    return tq.convert(model, inplace=True)
+
+
+def quantize_from_config(model, quantization):
+    """rebuild the structure of a quantized model from the "quantization" entry of its model config, so that the
+    quantized state dict can be loaded (see load_model); the scales come from the state dict
+
+    Args:
+        model (nn.Module): the float model
+        quantization (dict): {"mode": "dynamic" or "static", "modules": [...], "backend": ...}
+
+    Returns:
+        nn.Module: the model on cpu
+    """
+    model = model.cpu().eval()
+    if quantization["mode"] == "dynamic":
+        return quantize_dynamic_linears(model, quantization["modules"])
+    prepare_static_linears(model, quantization["modules"], quantization.get("backend", "fbgemm"))
+    # the observers have seen no data, the state dict overwrites the placeholder scales
+    for observer in [m for m in model.modules() if isinstance(m, tq.ObserverBase)]:
+        observer(torch.zeros(1))
+    return convert_static_linears(model)
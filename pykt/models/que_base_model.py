@@ -7,6 +7,7 @@ import pandas as pd
 from torch.utils.data import DataLoader
 from torch.utils.data import TensorDataset
 from sklearn import metrics
+from .utils import pooled_concept_emb
 
 emb_type_list = ["qc_merge","qid","qaid","qcid_merge"]
 emb_type_map = {"akt-iekt":"qc_merge",
@@ -87,23 +88,8 @@ class QueEmb(nn.Module):
         self.output_emb_dim = emb_size
 
     def get_avg_skill_emb(self,c):
-        # add zero for padding
-        concept_emb_cat = torch.cat(
-            [torch.zeros(1, self.emb_size).to(self.device), 
-            self.concept_emb], dim=0)
-        # shift c
-
-        related_concepts = (c+1).long()
-        #[batch_size, seq_len, emb_dim]
-        concept_emb_sum = concept_emb_cat[related_concepts, :].sum(
-            axis=-2)
-
-        #[batch_size, seq_len,1]
-        concept_num = torch.where(related_concepts != 0, 1, 0).sum(
-            axis=-1).unsqueeze(-1)
-        concept_num = torch.where(concept_num == 0, 1, concept_num)
-        concept_avg = (concept_emb_sum / concept_num)
-        return concept_avg
+        #[batch_size, seq_len, emb_dim], -1 is padding
+        return pooled_concept_emb(self.concept_emb, c)
 
     def forward(self,q,c,r=None):
         emb_type = self.emb_type
@@ -0,0 +1,230 @@
+import asyncio
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from .distill_utils import predict_probs
+from ..datasets.que_data_loader import datasets_dic
+
+
+def concept_ids(concepts):
+    """the concepts of one interaction, a list of ids, one id or a "_" joined string as in the sequence files"""
+    if isinstance(concepts, str):
+        return [int(_) for _ in concepts.split("_")]
+    elif isinstance(concepts, int):
+        return [concepts]
+    return [int(_) for _ in concepts]
+
+
+def parse_concepts(concepts, max_concepts, pad_val=-1):
+    """the concepts of one interaction (see concept_ids) padded to max_concepts"""
+    concepts = concept_ids(concepts)[:max_concepts]
+    return concepts + [pad_val] * (max_concepts - len(concepts))
+
+
+def check_request(req, default_dataset=None, num_q=None, num_c=None):
+    """raise ValueError for a malformed prediction request, default_dataset is the dataset of the requests without one;
+    with num_q / num_c, the questions / concepts must be in the embeddings of the model"""
+    for key in ["questions", "concepts", "responses", "next_question", "next_concepts"]:
+        if key not in req:
+            raise ValueError(f"missing {key}")
+    dataset = req.get("dataset", default_dataset)
+    if dataset is None:
+        raise ValueError("missing dataset")
+    if dataset not in datasets_dic:
+        raise ValueError(f"unknown dataset {dataset}, one of {list(datasets_dic)}")
+    if not len(req["questions"]) == len(req["concepts"]) == len(req["responses"]):
+        raise ValueError("questions, concepts and responses must have the same length")
+    if len(req["questions"]) == 0:
+        raise ValueError("at least one past interaction is needed")
+    questions = list(req["questions"]) + [req["next_question"]]
+    concepts = [c for cs in list(req["concepts"]) + [req["next_concepts"]] for c in concept_ids(cs)]
+    if num_q is not None and any(not 0 <= int(q) < num_q for q in questions):
+        raise ValueError(f"unknown question, the ids are in [0, {num_q})")
+    if num_c is not None and any(not 0 <= c < num_c for c in concepts):
+        raise ValueError(f"unknown concept, the ids are in [0, {num_c})")
+
+
+def build_batch(requests, max_concepts, seq_len, default_dataset=None, pad_val=-1):
+    """pad the histories of several students into one batch with the keys of KTQueDataset, the requests are checked
+    by check_request. The next question is appended to each history with a placeholder response, which the model cannot see
+    (the attention only peeks the past responses); histories longer than seq_len - 1 keep their last interactions.
+
+    Args:
+        requests (list[dict]): questions, concepts, responses (the history), next_question, next_concepts and optionally dataset
+        max_concepts (int): max number of concepts of a question
+        seq_len (int): max sequence length of the model
+        default_dataset (str, optional): dataset of the requests without one. Defaults to None.
+        pad_val (int, optional): pad value. Defaults to -1.
+
+    Returns:
+        (tuple): the batch dict and the index [bs] of the next-step prediction in the [bs, seqlen-1] outputs
+    """
+    rows = []
+    for req in requests:
+        q = list(req["questions"]) + [req["next_question"]]
+        c = [parse_concepts(_, max_concepts, pad_val) for _ in req["concepts"]] + [parse_concepts(req["next_concepts"], max_concepts, pad_val)]
+        r = list(req["responses"]) + [0]
+        rows.append((q[-seq_len:], c[-seq_len:], r[-seq_len:], req.get("dataset", default_dataset)))
+    bs, maxlen = len(rows), max(len(row[0]) for row in rows)
+    qseqs, rseqs = np.zeros((bs, maxlen), dtype=np.int64), np.zeros((bs, maxlen), dtype=np.float32)
+    cseqs = np.full((bs, maxlen, max_concepts), pad_val, dtype=np.int64)
+    lens, dataset_ids = np.zeros(bs, dtype=np.int64), np.zeros(bs, dtype=np.int64)
+    for i, (q, c, r, dataset) in enumerate(rows):
+        lens[i] = len(q)
+        qseqs[i, :len(q)], cseqs[i, :len(q)], rseqs[i, :len(q)] = q, c, r
+        dataset_ids[i] = datasets_dic[dataset]
+    qseqs, cseqs, rseqs = torch.from_numpy(qseqs), torch.from_numpy(cseqs), torch.from_numpy(rseqs)
+    valid = torch.arange(maxlen)[None, :] < torch.from_numpy(lens)[:, None]
+    masks = valid[:, :-1] * valid[:, 1:]
+    dcur = {"qseqs": qseqs[:, :-1] * masks, "shft_qseqs": qseqs[:, 1:] * masks,
+            "cseqs": cseqs[:, :-1], "shft_cseqs": cseqs[:, 1:],
+            "rseqs": rseqs[:, :-1] * masks, "shft_rseqs": rseqs[:, 1:] * masks,
+            "masks": masks, "smasks": masks, "dataset_id": torch.from_numpy(dataset_ids)}
+    return dcur, lens - 2
+
+
+class ServingMetrics:
+    """counters and latency window of the prediction service"""
+    def __init__(self, window=10000):
+        self.start = time.time()
+        self.requests, self.errors, self.batches, self.model_seconds = 0, 0, 0, 0.
+        self.latencies = collections.deque(maxlen=window)
+
+    def record_batch(self, batch_size, model_seconds, latencies):
+        self.batches += 1
+        self.requests += batch_size
+        self.model_seconds += model_seconds
+        self.latencies.extend(latencies)
+
+    def snapshot(self):
+        elapsed = time.time() - self.start
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        return {
+            "requests": self.requests, "errors": self.errors, "batches": self.batches,
+            "mean_batch_size": self.requests / max(self.batches, 1),
+            "requests_per_second": self.requests / max(elapsed, 1e-12),
+            "model_seconds": self.model_seconds,
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p95": float(np.percentile(latencies, 95)),
+            "latency_ms_p99": float(np.percentile(latencies, 99)),
+        }
+
+
+class MicroBatcher:
+    """coalesce the concurrent prediction requests into padded batches. A batch is run when it has max_batch_size
+    requests or max_wait_ms after its first request arrived; the model runs in one worker thread so the event loop keeps
+    accepting requests meanwhile.
+
+    Args:
+        model (nn.Module): a PROB_MODELS member (see predict_probs), in eval mode
+        max_concepts (int): max number of concepts of a question
+        seq_len (int): max sequence length of the model
+        max_batch_size (int, optional): Defaults to 64.
+        max_wait_ms (float, optional): Defaults to 5.
+        default_dataset (str, optional): dataset of the requests without one. Defaults to None.
+        num_q (int, optional): number of questions of the model, the requests with other ids are rejected. Defaults to None.
+        num_c (int, optional): number of concepts of the model, the requests with other ids are rejected. Defaults to None.
+    """
+    def __init__(self, model, max_concepts, seq_len, max_batch_size=64, max_wait_ms=5., default_dataset=None, num_q=None, num_c=None):
+        self.model = model
+        self.max_concepts = max_concepts
+        self.seq_len = seq_len
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        if default_dataset is not None and default_dataset not in datasets_dic:
+            raise ValueError(f"unknown dataset {default_dataset}, one of {list(datasets_dic)}")
+        self.default_dataset = default_dataset
+        self.num_q, self.num_c = num_q, num_c
+        self.metrics = ServingMetrics()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self._loop())
+
+    async def predict(self, req):
+        """the probability that the student answers next_question correctly"""
+        check_request(req, self.default_dataset, self.num_q, self.num_c)
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((req, future, time.time()))
+        return await future
+
+    def _run(self, requests):
+        with torch.no_grad():
+            dcur, index = build_batch(requests, self.max_concepts, self.seq_len, self.default_dataset)
+            y = predict_probs(self.model, dcur)
+            return y[torch.arange(len(requests)), torch.from_numpy(index).to(y.device)].tolist()
+
+    async def _loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            start = time.time()
+            try:
+                probs = await loop.run_in_executor(self.executor, self._run, [item[0] for item in items])
+            except Exception as e:
+                for _, future, _ in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            end = time.time()
+            self.metrics.record_batch(len(items), end - start, [end - arrival for _, _, arrival in items])
+            for (_, future, _), prob in zip(items, probs):
+                if not future.done():
+                    future.set_result(prob)
+
+
+async def handle_client(reader, writer, batcher):
+    """JSON lines protocol, one request per line and one response per line with the same id. A request is either
+    {"id", "questions", "concepts", "responses", "next_question", "next_concepts", "dataset"} -> {"id", "prob"}
+    or {"op": "metrics"} -> the ServingMetrics snapshot. Requests of one connection are answered as they complete."""
+    async def respond(line):
+        req = dict()
+        try:
+            req = json.loads(line)
+            if req.get("op") == "metrics":
+                res = batcher.metrics.snapshot()
+            else:
+                res = {"prob": await batcher.predict(req)}
+        except Exception as e:
+            batcher.metrics.errors += 1
+            res = {"error": str(e)}
+        if isinstance(req, dict) and "id" in req:
+            res["id"] = req["id"]
+        writer.write((json.dumps(res) + "\n").encode())
+        await writer.drain()
+
+    tasks = set()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        task = asyncio.ensure_future(respond(line))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+    writer.close()
+
+
+async def serve(batcher, host="127.0.0.1", port=8765):
+    """run the prediction service until cancelled"""
+    batcher.start()
+    server = await asyncio.start_server(lambda r, w: handle_client(r, w, batcher), host, port)
+    print(f"serving on {host}:{port}, max_batch_size: {batcher.max_batch_size}, max_wait_ms: {batcher.max_wait * 1000}")
+    async with server:
+        await server.serve_forever()
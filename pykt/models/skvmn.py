@@ -197,32 +197,15 @@ class SKVMN(Module):
         return torch.triu(torch.ones(seq_len, seq_len), diagonal=0).to(dtype=torch.bool)
 
     def triangular_layer(self, correlation_weight, batch_size=64, a=0.075, b=0.088, c=1.00):
-        batch_identity_indices = []
-
         # w'= max((w-a)/(b-a), (c-w)/(c-b))
         # min(w', 0)
-        correlation_weight = correlation_weight.view(batch_size * self.seqlen, -1) # (seqlen * bz) * |K|
-        correlation_weight = torch.cat([correlation_weight[i] for i in range(correlation_weight.shape[0])], 0).unsqueeze(0) # 1*(seqlen*bz*|K|)
-        correlation_weight = torch.cat([(correlation_weight-a)/(b-a), (c-correlation_weight)/(c-b)], 0)
-        correlation_weight, _ = torch.min(correlation_weight, 0)
-        w0 = torch.zeros(correlation_weight.shape[0]).to(device)
-        correlation_weight = torch.cat([correlation_weight.unsqueeze(0), w0.unsqueeze(0)], 0)
-        correlation_weight, _ = torch.max(correlation_weight, 0)
-
-        identity_vector_batch = torch.zeros(correlation_weight.shape[0]).to(device)
+        correlation_weight = correlation_weight.view(batch_size, self.seqlen, -1) # bz * seqlen * |K|
+        correlation_weight = torch.min((correlation_weight-a)/(b-a), (c-correlation_weight)/(c-b))
+        correlation_weight = torch.clamp(correlation_weight, min=0)
 
         # >=0.6的值置2，0.1-0.6的值置1，0.1以下的值置0
-        # mask = correlation_weight.lt(0.1)
-        identity_vector_batch = identity_vector_batch.masked_fill(correlation_weight.lt(0.1), 0)
-        # mask = correlation_weight.ge(0.1)
-        identity_vector_batch = identity_vector_batch.masked_fill(correlation_weight.ge(0.1), 1)
-        # mask = correlation_weight.ge(0.6)
-        _identity_vector_batch = identity_vector_batch.masked_fill(correlation_weight.ge(0.6), 2)
-
-        # identity_vector_batch = torch.chunk(identity_vector_batch.view(self.batch_size, -1), self.batch_size, 0)
+        identity_vector_batch = correlation_weight.ge(0.1).float() + correlation_weight.ge(0.6).float() #输出u(x) [bs, seqlen, size_m]
 
-        # 输入：_identity_vector_batch
-        # 输出：indices
         """
         >>> identity_vector_batch [bs, seqlen, size_m]
         tensor([[[0., 1., 1.],
@@ -236,36 +219,7 @@ class SKVMN(Module):
          [2., 2., 0.],
          [2., 2., 0.],
          [0., 1., 2.]]])
-        """
-        identity_vector_batch = _identity_vector_batch.view(batch_size * self.seqlen, -1)
-        identity_vector_batch = torch.reshape(identity_vector_batch,[batch_size, self.seqlen, -1]) #输出u(x) [bs, seqlen, size_m]
-        
-        """
-        >>> iv_square_norm (A^2)
-        tensor([[[ 2.,  2.,  2.,  2.,  2.], 
-         [ 3.,  3.,  3.,  3.,  3.],
-         [12., 12., 12., 12., 12.],
-         [ 3.,  3.,  3.,  3.,  3.],
-         [ 1.,  1.,  1.,  1.,  1.]],
-
-        [[ 2.,  2.,  2.,  2.,  2.],
-         [ 6.,  6.,  6.,  6.,  6.],
-         [ 8.,  8.,  8.,  8.,  8.],
-         [ 8.,  8.,  8.,  8.,  8.],
-         [ 5.,  5.,  5.,  5.,  5.]]])
-        >>> unique_iv_square_norm (B^2.T)
-        tensor([[[ 2.,  3., 12.,  3.,  1.],
-         [ 2.,  3., 12.,  3.,  1.],
-         [ 2.,  3., 12.,  3.,  1.],
-         [ 2.,  3., 12.,  3.,  1.],
-         [ 2.,  3., 12.,  3.,  1.]],
-
-        [[ 2.,  6.,  8.,  8.,  5.],
-         [ 2.,  6.,  8.,  8.,  5.],
-         [ 2.,  6.,  8.,  8.,  5.],
-         [ 2.,  6.,  8.,  8.,  5.],
-         [ 2.,  6.,  8.,  8.,  5.]]])
-        >>> iv_distances
+        >>> iv_distances (A^2 + B^2 - 2A*B.T)
         tensor(
         [[[0., 1., 6., 1., 1.],
          [1., 0., 3., 0., 2.],
@@ -278,79 +232,46 @@ class SKVMN(Module):
          [6., 6., 0., 0., 9.],
          [6., 6., 0., 0., 9.],
          [3., 1., 9., 9., 0.]]])
+        >>> hop_idx
+        tensor([[-1, -1, -1,  1, -1],
+                [-1, -1, -1,  2, -1]])
+        In 0th sequence, the identity in t3 is same to the ones in t1.
+        In 1th sequence, the identity in t3 is same to the ones in t2.
         """
-
-        # A^2
-        iv_square_norm = torch.sum(torch.pow(identity_vector_batch, 2), dim=2, keepdim=True)
-        iv_square_norm = iv_square_norm.repeat((1, 1, iv_square_norm.shape[1]))
-        # B^2.T
-        unique_iv_square_norm = torch.sum(torch.pow(identity_vector_batch, 2), dim=2, keepdim=True)
-        unique_iv_square_norm = unique_iv_square_norm.repeat((1, 1, self.seqlen)).transpose(2, 1)
-        # A * B.T
-        iv_matrix_product = torch.bmm(identity_vector_batch, identity_vector_batch.transpose(2,1)) # A * A.T 
         # A^2 + B^2 - 2A*B.T
-        iv_distances = iv_square_norm + unique_iv_square_norm - 2 * iv_matrix_product
-        iv_distances = torch.where(iv_distances>0.0, torch.tensor(-1e32).to(device), iv_distances) #求每个batch内时间步t与t-lambda的相似距离（如果identity_vector一样，距离为0）
-        masks = self.ut_mask(iv_distances.shape[1]).to(device)
-        mask_iv_distances = iv_distances.masked_fill(masks, value=torch.tensor(-1e32).to(device)) #当前时刻t以前相似距离为0的依旧为0，其他为mask（即只看对角线以前）
-        idx_matrix = torch.arange(0,self.seqlen * self.seqlen,1).reshape(self.seqlen,-1).repeat(batch_size,1,1).to(device)
-        final_iv_distance = mask_iv_distances + idx_matrix 
-        values, indices = torch.topk(final_iv_distance, 1, dim=2, largest=True) #防止t以前存在多个相似距离为0的,因此加上idx取距离它最近的t - lambda
+        iv_square_norm = torch.sum(torch.pow(identity_vector_batch, 2), dim=2, keepdim=True)
+        iv_matrix_product = torch.bmm(identity_vector_batch, identity_vector_batch.transpose(2,1)) # A * A.T
+        iv_distances = iv_square_norm + iv_square_norm.transpose(2, 1) - 2 * iv_matrix_product
+        # 只看对角线以前相似距离为0的时刻，取距离t最近的t - lambda，没有则为-1
+        masks = self.ut_mask(self.seqlen).to(device)
+        same_identity = iv_distances.eq(0) & ~masks
+        steps = torch.arange(1, self.seqlen + 1, device=same_identity.device)
+        hop_idx = (same_identity.long() * steps).max(dim=2).values - 1 # [bs, seqlen]
 
-        """
-        >>> values
-        tensor([[[-1.0000e+32],
-         [-1.0000e+32],
-         [-1.0000e+32],
-         [ 1.6000e+01],
-         [-1.0000e+32]],
-
-        [[-1.0000e+32],
-         [-1.0000e+32],
-         [-1.0000e+32],
-         [ 1.7000e+01],
-         [-1.0000e+32]]])
-        >>> indices --> 在dim=2的idx
-        tensor([[[2],
-         [2],
-         [2],
-         [1],
-         [2]],
-
-        [[2],
-         [2],
-         [2],
-         [2],
-         [2]]])
-        >>> batch_identity_indices --> 在dim=0 & dim=1的idx
-        [[3, 0, 0],
-        [3, 1, 0]]
-
-        lookup the indexes of same identities
-        Examples
-        >>> identity_idx
-        tensor([[3, 0, 1],
-               [3, 1, 2]]) 
-        In 0th sequence, the identity in t3 is same to the ones in t1.
-        In 1th sequence, the identity in t3 is same to the ones in t2.
+        return hop_idx
 
-        """
-        
-        _values = values.permute(1,0,2)
-        _indices = indices.permute(1,0,2)
-        batch_identity_indices = (_values >= 0).nonzero() #找到t
-        identity_idx = []
-        for identity_indices in batch_identity_indices:
-            pre_idx = _indices[identity_indices[0],identity_indices[1]] #找到t-lamda
-            idx = torch.cat([identity_indices[:-1],pre_idx], dim=-1)
-            identity_idx.append(idx)
-        if len(identity_idx) > 0:
-            identity_idx = torch.stack(identity_idx, dim=0)
-        else:
-            identity_idx = torch.tensor([]).to(device)
+    def hop_schedule(self, hop_idx):
+        """group the hops by time step, so the hidden states of a step can be replaced with one scatter
 
-        return identity_idx 
+        Args:
+            hop_idx (torch.tensor): [bs, seqlen], the hop source t - lambda of each student at each step, -1 for no hop
 
+        Returns:
+            list: for each step, None or (students, the position of their source in sources, sources)
+        """
+        schedule = [None] * self.seqlen
+        hop_t, hop_b = (hop_idx.permute(1, 0) >= 0).nonzero(as_tuple=True)
+        if hop_t.shape[0] == 0:
+            return schedule
+        hop_src = hop_idx[hop_b, hop_t]
+        counts = torch.bincount(hop_t, minlength=self.seqlen).tolist()
+        hop_b, hop_src = hop_b.split(counts), hop_src.split(counts)
+        for i in range(self.seqlen):
+            if counts[i] == 0:
+                continue
+            sources, positions = torch.unique(hop_src[i], return_inverse=True)
+            schedule[i] = (hop_b[i], positions, sources.tolist())
+        return schedule
 
     def forward(self, q, r, qtest=False):
         emb_type = self.emb_type
@@ -448,31 +369,20 @@ class SKVMN(Module):
 
         #Sequential dependencies
         # print(f"idx values start:{datetime.datetime.now()}")
-        idx_values = self.triangular_layer(w, bs) #[t,bs_n,t-lambda]
-        # print(f"idx values end:{datetime.datetime.now()}")
-        # print(f"idx_values: {idx_values.shape}")
+        hop_idx = self.triangular_layer(w, bs) #[bs, seqlen], t-lambda
+        schedule = self.hop_schedule(hop_idx)
 
-        """
-        >>> idx_values
-        tensor([[3, 0, 1],
-               [3, 1, 2]]) 
-        In 0th sequence, the identity in t3 is same to the ones in t1.
-        In 1th sequence, the identity in t3 is same to the ones in t2.
-        """
         #Hop-LSTM
-        # original
-
         hidden_state, cell_state = [], []
         hx, cx = self.hx.repeat(bs, 1), self.cx.repeat(bs, 1)
-        # print(f"replace_hidden_start:{datetime.datetime.now()}")
         for i in range(self.seqlen): # 逐个ex进行计算
-            for j in range(bs):
-                if idx_values.shape[0] != 0 and i == idx_values[0][0] and j == idx_values[0][1]:
-                    # e.g 在t=3时，第2个序列的hidden应该用t=1时的hidden,同理cell_state
-                    hx[j,:] = hidden_state[idx_values[0][2]][j]
-                    cx = cx.clone()
-                    cx[j,:] = cell_state[idx_values[0][2]][j]
-                    idx_values = idx_values[1:]
+            if schedule[i] is not None:
+                # e.g 在t=3时，第2个序列的hidden应该用t=1时的hidden,同理cell_state
+                students, positions, sources = schedule[i]
+                hop_h = torch.stack([hidden_state[t] for t in sources], dim=0)[positions, students]
+                hop_c = torch.stack([cell_state[t] for t in sources], dim=0)[positions, students]
+                hx = hx.index_put((students,), hop_h)
+                cx = cx.index_put((students,), hop_c)
             hx, cx = self.lstm_cell(ft[i], (hx, cx)) # input[i]是序列中的第i个ex
             hidden_state.append(hx) #记录中间层的h
             cell_state.append(cx) #记录中间层的c
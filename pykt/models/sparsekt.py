@@ -10,7 +10,6 @@ from .utils import transformer_FFN, ut_mask, pos_encode, get_clones
 from torch.nn import Module, Embedding, LSTM, Linear, Dropout, LayerNorm, TransformerEncoder, TransformerEncoderLayer, \
         MultiLabelMarginLoss, MultiLabelSoftMarginLoss, CrossEntropyLoss, BCELoss, MultiheadAttention
 from torch.nn.functional import one_hot, cross_entropy, multilabel_margin_loss, binary_cross_entropy
-import random
 import time
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -523,6 +522,25 @@ class MultiHeadAttention(nn.Module):
         return output, attn_weights
 
 
+def random_prefix_index(n, seqlen, start=2, low=0, keep_last=False):
+    """
+    Build gather indices that randomly shuffle the visible prefix of every attention row.
+
+    For row i >= start, columns [low, i) (or [low, i-1) when keep_last) are shuffled uniformly and
+    independently per row, the other columns < i keep their position, and columns >= i point to 0.
+    Rows < start point to 0 everywhere. The permutation is drawn by sorting random keys, so the
+    whole [n*seqlen, seqlen] index is built with a handful of device ops.
+    """
+    cols = torch.arange(seqlen, device=device)
+    rows = cols.unsqueeze(-1)
+    high = rows - 1 if keep_last else rows
+    shuffle = (cols >= low) & (cols < high)
+    keys = torch.rand(n, seqlen, seqlen, device=device) * (high - low).clamp(min=0) + low
+    keys = torch.where(shuffle, keys, cols.float())
+    index = torch.argsort(keys, dim=-1)
+    index = index.masked_fill((cols >= rows) | (rows < start), 0)
+    return index.reshape(n*seqlen, seqlen)
+
 def attention(q, k, v, d_k, mask, dropout, zero_pad, emb_type="qid", sparse_ratio=0.8, k_index=5, attn_grads=None, stride=1, save_path="", save_attn_path="", save_grad_path="",attn_cnt_path="",q_data=None,n_question=None):
     """
     This is called by Multi-head atention object to find the values.
@@ -554,13 +572,7 @@ def attention(q, k, v, d_k, mask, dropout, zero_pad, emb_type="qid", sparse_rati
     elif emb_type.find("random_attn") != -1:
         # print(f"running emb_type is {emb_type}")
         scores = torch.reshape(scores, (bs*head*seqlen,-1))
-        total_idx = torch.tensor([]).to(device)
-        for j in range(bs*head):
-            index = torch.zeros(2*seqlen).to(device)
-            for i in range(2,seqlen):
-                tmp_idx = torch.tensor(random.sample(range(0,i),i) + [0] * (seqlen - i)).to(device)
-                index = torch.cat([index,tmp_idx])
-            total_idx = torch.cat([total_idx,torch.reshape(index, (seqlen,-1))]).long()
+        total_idx = random_prefix_index(bs*head, seqlen, start=2)
         new_scores = torch.gather(scores, -1, total_idx).reshape(bs,head,seqlen,-1)
         new_scores.masked_fill_(mask == 0, 0)
         scores = new_scores
@@ -569,16 +581,8 @@ def attention(q, k, v, d_k, mask, dropout, zero_pad, emb_type="qid", sparse_rati
     elif emb_type.find("random_fast_attn") != -1:
         # print(f"running emb_type is {emb_type}")
         scores = torch.reshape(scores, (bs*head*seqlen,-1))
-        total_idx = torch.tensor([]).to(device)
         # print(f"before sorted:{scores}")
-        for j in range(head):
-            index = torch.zeros(2*seqlen).to(device)
-            for i in range(2,seqlen):
-                tmp_sample = torch.randperm(i)
-                tmp_sample = tmp_sample.unsqueeze(0).unsqueeze(0)
-                tmp_idx = torch.nn.functional.pad(tmp_sample, pad = [0, (seqlen-i), 0, 0]).squeeze(0).squeeze(0).to(device)
-                index = torch.cat([index,tmp_idx])
-            total_idx = torch.cat([total_idx,torch.reshape(index, (seqlen,-1))]).long()
+        total_idx = random_prefix_index(head, seqlen, start=2)
         total_idx = total_idx.reshape(head,seqlen,-1).repeat(bs,1,1).reshape(bs*head*seqlen,-1)
         new_scores = torch.gather(scores, -1, total_idx).reshape(bs,head,seqlen,-1)
         new_scores.masked_fill_(mask == 0, 0)
@@ -589,13 +593,7 @@ def attention(q, k, v, d_k, mask, dropout, zero_pad, emb_type="qid", sparse_rati
         # print(f"running emb_type is {emb_type}")
         scores = torch.reshape(scores, (bs*head*seqlen,-1))
         # print(f"before sorted:{scores}")
-        total_idx = torch.tensor([]).to(device)
-        for j in range(bs*head):
-            index = torch.zeros(3*seqlen).to(device)
-            for i in range(3,seqlen):
-                tmp_idx = torch.tensor([0] + random.sample(range(1,i),i-1) + [0] * (seqlen - i)).to(device)
-                index = torch.cat([index,tmp_idx])
-            total_idx = torch.cat([total_idx,torch.reshape(index, (seqlen,-1))]).long()
+        total_idx = random_prefix_index(bs*head, seqlen, start=3, low=1)
         new_scores = torch.gather(scores, -1, total_idx).reshape(bs,head,seqlen,-1)
         new_scores.masked_fill_(mask == 0, 0)
         scores = new_scores
@@ -604,17 +602,7 @@ def attention(q, k, v, d_k, mask, dropout, zero_pad, emb_type="qid", sparse_rati
     elif emb_type.find("permute_fast_attn") != -1:
         # print(f"running emb_type is {emb_type}")
         scores = torch.reshape(scores, (bs*head*seqlen,-1))
-        total_idx = torch.tensor([]).to(device)
-        for j in range(head):
-            index = torch.zeros(2*seqlen).to(device)
-            for i in range(2,seqlen):
-                tmp_sample = np.arange(1,i-1)
-                random.shuffle(tmp_sample)
-                tmp_sample = torch.tensor(tmp_sample).unsqueeze(0).unsqueeze(0)
-                tmp_sample = torch.nn.functional.pad(tmp_sample, pad = [0, 1, 0, 0], value=i-1)
-                tmp_idx = torch.nn.functional.pad(tmp_sample, pad = [1, (seqlen-i), 0, 0]).squeeze(0).squeeze(0).to(device)
-                index = torch.cat([index,tmp_idx])
-            total_idx = torch.cat([total_idx,torch.reshape(index, (seqlen,-1))]).long()
+        total_idx = random_prefix_index(head, seqlen, start=2, low=1, keep_last=True)
         total_idx = total_idx.reshape(head,seqlen,-1).repeat(bs,1,1).reshape(bs*head*seqlen,-1)
         new_scores = torch.gather(scores, -1, total_idx).reshape(bs,head,seqlen,-1)
         new_scores.masked_fill_(mask == 0, 0)
@@ -0,0 +1,125 @@
+import os
+import time
+import hashlib
+import collections
+import torch
+
+
+def stack_states(states):
+    """batch the states of several students (tuples of tensors with the batch at dim 0)"""
+    return tuple(torch.cat(parts, dim=0) for parts in zip(*states))
+
+
+def split_states(state):
+    """the per-student states [1, ...] of a batched state"""
+    return list(zip(*[part.split(1, dim=0) for part in state]))
+
+
+class KTStateCache:
+    """a bounded cache of the knowledge states of the students, so the next prediction of an active student is one
+    model.step from the cached state instead of replaying the whole history. The least recently used students are
+    evicted beyond capacity, and the states older than ttl seconds are expired; with spill_dir the evicted states are
+    saved to disk and loaded back on their next get.
+
+    Args:
+        capacity (int): max number of states in memory
+        ttl (float, optional): seconds after the last update a state expires, None never. Defaults to None.
+        spill_dir (str, optional): dir of the evicted states, None drops them. Defaults to None.
+    """
+    def __init__(self, capacity, ttl=None, spill_dir=None):
+        assert capacity > 0, "the capacity of the state cache must be positive!"
+        self.capacity = capacity
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.states = collections.OrderedDict()
+        self.hits, self.misses, self.spills = 0, 0, 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def _spill_path(self, student_id):
+        return os.path.join(self.spill_dir, hashlib.md5(str(student_id).encode()).hexdigest() + ".pt")
+
+    def _expired(self, updated):
+        return self.ttl is not None and time.time() - updated > self.ttl
+
+    def get(self, student_id):
+        """the cached state of the student, or None if it is unknown or expired"""
+        if student_id in self.states:
+            state, updated = self.states[student_id]
+            if self._expired(updated):
+                del self.states[student_id]
+                self.misses += 1
+                return None
+            self.states.move_to_end(student_id)
+            self.hits += 1
+            return state
+        if self.spill_dir is not None and os.path.exists(self._spill_path(student_id)):
+            path = self._spill_path(student_id)
+            saved = torch.load(path, map_location="cpu")
+            os.remove(path)
+            if not self._expired(saved["updated"]):
+                self.hits += 1
+                self._insert(student_id, saved["state"], saved["updated"])
+                return self.states[student_id][0]
+        self.misses += 1
+        return None
+
+    def put(self, student_id, state):
+        """cache the state of the student, evicting the least recently used ones beyond capacity"""
+        self.states.pop(student_id, None)
+        self._insert(student_id, state, time.time())
+
+    def _insert(self, student_id, state, updated):
+        self.states[student_id] = (state, updated)
+        while len(self.states) > self.capacity:
+            evicted, (evicted_state, evicted_updated) = self.states.popitem(last=False)
+            if self.spill_dir is not None and not self._expired(evicted_updated):
+                torch.save({"state": tuple(part.cpu() for part in evicted_state), "updated": evicted_updated},
+                           self._spill_path(evicted))
+                self.spills += 1
+
+    def evict(self, student_id):
+        """forget the student, e.g. when the history is edited"""
+        self.states.pop(student_id, None)
+        if self.spill_dir is not None and os.path.exists(self._spill_path(student_id)):
+            os.remove(self._spill_path(student_id))
+
+
+def observe(model, cache, student_ids, *interaction):
+    """predict the next interaction of several students and update their cached states with its response, new
+    students start from model.init_state. The interaction is the arguments of model.step after the state, e.g.
+    (q, r) for DKT / DKVMN, (e, a, it) for LPKT and (q, c, r) for IEKT, each with the batch of the students at dim 0;
+    a None response only predicts and keeps the states. A student appears at most once per call, the consecutive
+    interactions of a student depend on each other and need one call each.
+
+    Args:
+        model (nn.Module): a model with init_state / step, optionally wrapped by DDP
+        cache (KTStateCache): the state cache
+        student_ids (list): ids of the students
+        interaction: the step arguments
+
+    Returns:
+        torch.tensor: the predictions [len(student_ids)] made before the responses
+    """
+    module = model.module if hasattr(model, "module") else model
+    if len(set(student_ids)) != len(student_ids):
+        raise ValueError("a student appears several times in one observe call, observe its interactions one call each")
+    states = []
+    for student_id in student_ids:
+        state = cache.get(student_id)
+        if state is None:
+            state = module.init_state(1)
+        states.append(state)
+    with torch.no_grad():
+        device = interaction[0].device
+        state = tuple(part.to(device) for part in stack_states(states))
+        new_state, prob = module.step(state, *interaction)
+    # without a response the states are unchanged, nothing is written back
+    if any(x is None for x in interaction):
+        return prob
+    for student_id, student_state in zip(student_ids, split_states(new_state)):
+        cache.put(student_id, student_state)
+    return prob
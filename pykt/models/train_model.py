@@ -2,12 +2,14 @@ from faulthandler import disable
 import os, sys
 import torch
 import torch.nn as nn
-from torch.nn.functional import one_hot, binary_cross_entropy, cross_entropy
+from torch.nn.functional import binary_cross_entropy, cross_entropy
 from torch.nn.utils.clip_grad import clip_grad_norm_
 import numpy as np
 from .evaluate_model import evaluate
 from torch.autograd import Variable, grad
 from .atkt import _l2_normalize_adv
+from .utils import gather_readout
+from .distill_utils import predict_probs
 from ..utils.utils import debug_print
 from pykt.config import que_type_models
 import pickle
@@ -121,7 +123,11 @@ def cal_loss(model, ys, r, rshft, sm, preloss=[]):
 
         t = torch.masked_select(rshft, sm)
         # print(f"y: {y.shape}")
-        loss1 = binary_cross_entropy(y.double(), t.double())
+        if y.numel() == 0:
+            # nothing selected (the idle lanes of a stream loader rank), a zero loss still runs the DDP gradient sync
+            loss1 = ys[0].sum().double() * 0
+        else:
+            loss1 = binary_cross_entropy(y.double(), t.double())
 
         if model.module.emb_type.find("predcurc") != -1:
             if model.module.emb_type.find("his") != -1:
@@ -215,7 +221,7 @@ def model_forward(model, data, attn_grads=None, soft_mask=None):
         # is_repeat = dcur["is_repeat"]
         y, y2, y3 = model(dcur, train=True)
         if model.module.emb_type.find("bkt") == -1 and model.module.emb_type.find("addcshft") == -1:
-            y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+            y = gather_readout(y, cshft)
         # y2 = (y2 * one_hot(cshft.long(), model.module.num_c)).sum(-1)
         ys = [y, y2, y3] # first: yshft
     elif model_name in ["bakt"]:
@@ -256,17 +262,15 @@ def model_forward(model, data, attn_grads=None, soft_mask=None):
         # cat = torch.cat((d["at_seqs"][:,0:1], dshft["at_seqs"]), dim=1)
         cit = torch.cat((dcur["itseqs"][:,0:1], dcur["shft_itseqs"]), dim=1)
     elif model_name in ["dkt"]:
-        y = model(c.long(), r.long())
-        y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+        y = model(c.long(), r.long(), target=cshft)
         ys.append(y) # first: yshft
     elif model_name == "dkt+":
         y = model(c.long(), r.long())
-        y_next = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
-        y_curr = (y * one_hot(c.long(), model.module.num_c)).sum(-1)
+        y_next = gather_readout(y, cshft)
+        y_curr = gather_readout(y, c)
         ys = [y_next, y_curr, y]
     elif model_name in ["dkt_forget"]:
-        y = model(c.long(), r.long(), dgaps)
-        y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+        y = model(c.long(), r.long(), dgaps, target=cshft)
         ys.append(y)
     elif model_name in ["dkvmn","deep_irt", "skvmn"]:
         y = model(cc.long(), cr.long())
@@ -282,25 +286,22 @@ def model_forward(model, data, attn_grads=None, soft_mask=None):
         ys.append(y[:,1:])
         preloss.append(reg_loss)
     elif model_name in ["atkt", "atktfix"]:
-        y, features = model(c.long(), r.long())
-        y = (y * one_hot(cshft.long(), model.module.num_c)).sum(-1)
+        y, features = model(c.long(), r.long(), target=cshft)
         loss = cal_loss(model, [y], r, rshft, sm)
         # at
         features_grad = grad(loss, features, retain_graph=True)
         p_adv = torch.FloatTensor(model.module.epsilon * _l2_normalize_adv(features_grad[0].data))
         p_adv = Variable(p_adv).to(device)
-        pred_res, _ = model(c.long(), r.long(), p_adv)
+        pred_res, _ = model(c.long(), r.long(), p_adv, target=cshft)
         # second loss
-        pred_res = (pred_res * one_hot(cshft.long(), model.module.num_c)).sum(-1)
         adv_loss = cal_loss(model, [pred_res], r, rshft, sm)
         loss = loss + model.module.beta * adv_loss
     elif model_name == "gkt":
         y = model(cc.long(), cr.long())
         ys.append(y)  
     elif model_name == "gnn4kt":
-        y = model(dcur)
+        y = model(dcur, readout=True)
         if model.module.emb_type.find("lstm") != -1:
-            y = (y * one_hot(qshft.long(), model.module.num_q)).sum(-1)
             ys.append(y) # first: yshft     
         else:
             ys.append(y[:, 1:]) # first: yshft                 
@@ -324,6 +325,38 @@ def model_forward(model, data, attn_grads=None, soft_mask=None):
         loss = cal_loss(model, ys, r, rshft, sm, preloss)
     return loss
 
+def distill_forward(model, teacher, data, args):
+    """the loss of knowledge distillation on the selected interactions (smasks):
+    (1 - distill_alpha) * BCE(student, responses) + distill_alpha * T^2 * BCE(student_T, teacher_T),
+    where p_T = sigmoid(logit(p) / T) with T = distill_temperature. The teacher gets the same batch (dataset_id included),
+    its predictions are read from the batch when they were cached (teacher_preds, see distill_utils.cache_teacher_preds).
+    """
+    module = model.module
+    # the (dcur, dgaps) batches of the time gap emb_types would need the gaps in the teacher pass too
+    assert isinstance(data, dict), f"distillation does not support the batches of the emb_type {module.emb_type}!"
+    dcur = data
+    rshft, sm = dcur["shft_rseqs"].to(device), dcur["smasks"].to(device)
+    preloss = 0
+    if module.model_name in ["lorekt", "gpt4kt"]:
+        outputs = model(dcur, train=True)
+        y = outputs[0][:, 1:]
+        if len(outputs) == 4:
+            preloss = outputs[3]
+    else:
+        y, _ = module.train_one_step(dcur)
+    if "teacher_preds" in dcur:
+        t = dcur["teacher_preds"].to(device)
+    else:
+        with torch.no_grad():
+            t = predict_probs(teacher, dcur)
+
+    y, t, rshft = torch.masked_select(y, sm).double(), torch.masked_select(t, sm).double(), torch.masked_select(rshft, sm).double()
+    temperature, alpha = args.distill_temperature, args.distill_alpha
+    soften = lambda p: torch.sigmoid(torch.logit(p, eps=1e-6) / temperature)
+    loss_gt = binary_cross_entropy(y, rshft)
+    loss_kd = binary_cross_entropy(soften(y), soften(t)) * temperature ** 2
+    return (1 - alpha) * loss_gt + alpha * loss_kd + preloss
+
 def sample4cl(curtrain, batch_size, i, c0, max_epoch):
     # print(f"curtrain:{type(curtrain)}")
     print(f"curtrain:{len(curtrain)}")
@@ -344,7 +377,7 @@ def sample4cl(curtrain, batch_size, i, c0, max_epoch):
 
 
 
-def train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, test_loader=None, test_window_loader=None, save_model=False, dataset_name=None, fold=None, curtrain=None,batch_size=None, gradient_accumulation_steps=4.0, softmask_for_forward=None, softmask_for_backward=None, model_config=None, args=None):    
+def train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, test_loader=None, test_window_loader=None, save_model=False, dataset_name=None, fold=None, curtrain=None,batch_size=None, gradient_accumulation_steps=4.0, softmask_for_forward=None, softmask_for_backward=None, model_config=None, args=None, teacher=None):    
     max_auc, best_epoch = 0, -1
     train_step = 0
 
@@ -398,6 +431,9 @@ def train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, t
                 # if model.module.model_name.find("qikt") == -1:
                 #     if j != 0:pre_attn_weights = model.module.attn_weights
                 loss = model_forward(model, data, attn_grads)
+            elif teacher is not None:
+                teacher.eval()
+                loss = distill_forward(model, teacher, data, args)
             else:
   
                 loss = model_forward(model, data, i, soft_mask=None)
@@ -439,7 +475,11 @@ def train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, t
 
                     # if not args.only_train_learnable_softmask:
                     print(f'save model ...')
-                    torch.save(model.module.state_dict(), os.path.join(ckpt_path, model.module.emb_type+"_model.module.ckpt"))
+                    if getattr(model.module, "lora_rank", 0) > 0:
+                        # adapter finetuning, the frozen backbone is loaded from its own checkpoint
+                        torch.save(model.module.adapter_state_dict(), os.path.join(ckpt_path, model.module.emb_type+"_adapter.ckpt"))
+                    else:
+                        torch.save(model.module.state_dict(), os.path.join(ckpt_path, model.module.emb_type+"_model.module.ckpt"))
                     if args.save_opt:
                         print(f'saving optimizer ..')
                         torch.save(opt.state_dict(), os.path.join(ckpt_path, "opt.ckpt"))
@@ -466,3 +506,51 @@ def train_model(model, train_loader, valid_loader, num_epochs, opt, ckpt_path, t
             break
     
     return testauc, testacc, window_testauc, window_testacc, validauc, validacc, best_epoch
+
+
+def incremental_update(model, update_dataset, replay_dataset, opt, num_steps, batch_size, replay_ratio=0.5, soft_mask=None):
+    """a bounded number of update steps of LoReKT from its checkpoint on the windows of new interactions (see
+    datasets.incremental_utils.append_interactions), only their new interactions are selected. Every batch gets
+    round(batch_size * replay_ratio) more rows sampled from the previous training data (replay) against forgetting.
+
+    Args:
+        model (LOREKT): the model, optionally wrapped by DDP
+        update_dataset (KTQueDataset): the update windows
+        replay_dataset (KTQueDataset): the previous training data, None disables replay
+        opt (optimizer): the optimizer
+        num_steps (int): number of update steps
+        batch_size (int): number of update windows of a batch
+        replay_ratio (float, optional): replay rows per update window. Defaults to 0.5.
+        soft_mask (dict, optional): the soft masks of the forward. Defaults to None.
+
+    Returns:
+        list: the loss of each step
+    """
+    if len(update_dataset) == 0:
+        return []
+    update_loader = DataLoader(update_dataset, batch_size=batch_size, shuffle=True)
+    replay_bs = int(round(batch_size * replay_ratio)) if replay_dataset is not None else 0
+    replay_iter = None
+    if replay_bs > 0:
+        sampler = torch.utils.data.RandomSampler(replay_dataset, replacement=True, num_samples=num_steps * replay_bs)
+        replay_iter = iter(DataLoader(replay_dataset, batch_size=replay_bs, sampler=sampler))
+    losses = []
+    while len(losses) < num_steps:
+        for data in update_loader:
+            if len(losses) == num_steps:
+                break
+            if replay_iter is not None:
+                replay = next(replay_iter)
+                data = {k: torch.cat([v, replay[k]]) for k, v in data.items()}
+            model.train()
+            # the forward of the wrapper, so DDP synchronizes the gradients
+            outputs = model(data, train=True, soft_mask=soft_mask)
+            y = outputs[0][:, 1:]
+            preloss = outputs[3] if len(outputs) == 4 else 0
+            rshft, sm = data["shft_rseqs"].to(device), data["smasks"].to(device)
+            loss = binary_cross_entropy(torch.masked_select(y, sm).double(), torch.masked_select(rshft, sm).double()) + preloss
+            opt.zero_grad()
+            loss.backward()
+            opt.step()
+            losses.append(loss.item())
+    return losses
@@ -0,0 +1,423 @@
+import math
+import torch
+from torch import nn
+from torch.nn.init import xavier_uniform_
+from torch.nn.init import constant_
+import torch.nn.functional as F
+
+# (seqlen, peek, device) -> [1, 1, seqlen, seqlen] bool mask
+_causal_mask_cache = dict()
+# (seqlen, device) -> [1, 1, seqlen, seqlen] |i - j|
+_position_effect_cache = dict()
+
+def causal_mask(seqlen, peek, device):
+    """the causal mask shared by the attention based models, True means can attend
+
+    Args:
+        seqlen (int): sequence length
+        peek (int): 1 can peek the current and past values, 0 only the past values
+        device (torch.device): device of the mask
+
+    Returns:
+        torch.tensor: [1, 1, seqlen, seqlen]
+    """
+    key = (seqlen, peek, str(device))
+    if key not in _causal_mask_cache:
+        ones = torch.ones(seqlen, seqlen, dtype=torch.bool, device=device)
+        _causal_mask_cache[key] = ~torch.triu(ones, diagonal=peek)[None, None, :, :]
+    return _causal_mask_cache[key]
+
+def segment_mask(segs, peek):
+    """the causal mask of packed rows, where several students are concatenated in one row and a query only
+    attends to the keys of its own segment (block-diagonal causal), True means can attend
+
+    Args:
+        segs (torch.tensor): [bs, seqlen] segment id of each position, consecutive segments have different ids
+        peek (int): 1 can peek the current and past values, 0 only the past values
+
+    Returns:
+        torch.tensor: [bs, 1, seqlen, seqlen]
+    """
+    same = segs[:, None, :, None] == segs[:, None, None, :]
+    return same & causal_mask(segs.size(1), peek, segs.device)
+
+def segment_positions(segs):
+    """the position of each element inside its segment, i.e. the positions restart from 0 at every segment, [bs, seqlen]"""
+    idx = torch.arange(segs.size(1), device=segs.device).expand_as(segs)
+    starts = torch.ones_like(segs, dtype=torch.bool)
+    starts[:, 1:] = segs[:, 1:] != segs[:, :-1]
+    return idx - torch.where(starts, idx, torch.zeros_like(idx)).cummax(dim=1).values
+
+def position_effect(seqlen, device):
+    """the distance |i - j| between query i and key j, [1, 1, seqlen, seqlen]"""
+    key = (seqlen, str(device))
+    if key not in _position_effect_cache:
+        x1 = torch.arange(seqlen, device=device, dtype=torch.float)
+        _position_effect_cache[key] = (x1[None, :] - x1[:, None]).abs()[None, None, :, :]
+    return _position_effect_cache[key]
+
+def distance_scores(scores, mask, posi):
+    """the cumulative distance term of AKT: sqrt(sum_{j'>j} softmax(scores)_{j'} * |i - j|), computed in place on one buffer
+
+    Args:
+        scores (torch.tensor): [bs, head, lq, seqlen] raw attention scores
+        mask (torch.tensor): [1, 1, lq, seqlen] bool mask
+        posi (torch.tensor): [1, 1, lq, seqlen] position effect
+
+    Returns:
+        torch.tensor: [bs, head, lq, seqlen], detached
+    """
+    with torch.no_grad():
+        probs = F.softmax(scores.masked_fill(mask == 0, -1e32), dim=-1)
+        probs.mul_(mask)
+        disttotal_scores = probs.sum(dim=-1, keepdim=True)
+        dist = probs.cumsum_(dim=-1) # reuse the buffer
+        dist.neg_().add_(disttotal_scores).mul_(posi).clamp_(min=0.).sqrt_()
+    return dist
+
+
+class DistanceDecay:
+    """
+    Score modifier of AKT, scales the scores with exp(-softplus(gamma) * distance) per head.
+
+    Args:
+        gamma (torch.tensor): [head, 1, 1] decay rate of each head
+        pdiff (torch.tensor, optional): [bs, seqlen, 1] difficulty of the questions. Defaults to None.
+    """
+    stage = "score"
+
+    def __init__(self, gamma, pdiff=None):
+        self.gamma = -1. * F.softplus(gamma).unsqueeze(0)  # 1,8,1,1 一个头一个gamma参数， 对应论文里的theta
+        self.pdiff = pdiff
+
+    def __call__(self, scores, mask, start, end):
+        posi = position_effect(mask.size(-1), scores.device)[:, :, start:end]
+        dist_scores = distance_scores(scores, mask, posi)
+        # Now after do exp(gamma*distance) and then clamp to 1e-5 to 1e5
+        if self.pdiff is None:
+            total_effect = (dist_scores * self.gamma).exp().clamp(min=1e-5, max=1e5)
+        else:
+            diff = self.pdiff[:, start:end].unsqueeze(1).sigmoid().exp()
+            total_effect = (dist_scores * self.gamma * diff).exp().clamp(min=1e-5, max=1e5)
+        return scores * total_effect
+
+
+def _use_sdpa(mask, zero_pad, modifiers, q, k):
+    if not hasattr(F, "scaled_dot_product_attention") or len(modifiers) != 0:
+        return False
+    if isinstance(mask, int):
+        return q.size(2) == k.size(2) and (mask == 1 or zero_pad)
+    # a bool mask may leave queries without visible keys, only fused when they are zero padded
+    return zero_pad
+
+def attention(q, k, v, d_k, mask, dropout, zero_pad, modifiers=(), head_scale=None, chunk_size=0):
+    """
+    The scaled dot product attention shared by the attention based KT models.
+    Without score modifiers the causal cases are dispatched to F.scaled_dot_product_attention, so the fused kernels
+    are used and no [bs, head, seqlen, seqlen] tensor is materialized. Otherwise the scores are computed explicitly,
+    optionally in blocks of chunk_size queries, and the modifiers are applied in order.
+
+    Args:
+        q, k, v (torch.tensor): [bs, head, seqlen, d_k], k and v may be longer than q with a bool mask (e.g. cached memory)
+        d_k (int): dim of each head
+        mask (int or torch.tensor): 1 can peek the current and past values, 0 only the past values, or a bool mask [*, *, seqlen, klen]
+        dropout (nn.Dropout): dropout on the attention weights
+        zero_pad (bool): the first query attends to nothing, with a bool mask every query without a visible key
+            (e.g. the first one of each packed segment) outputs zeros
+        modifiers (list, optional): score ("score" stage, before softmax) or probability ("prob" stage, after softmax) modifiers. Defaults to ().
+        head_scale (torch.tensor, optional): [head], scales the attention weights of each head (e.g. the soft mask of LoReKT). Defaults to None.
+        chunk_size (int, optional): number of queries per block on the explicit path, 0 means no chunking. Defaults to 0.
+
+    Returns:
+        torch.tensor: [bs, head, seqlen, d_k]
+    """
+    seqlen = q.size(2)
+    visible = None
+    if not isinstance(mask, int) and zero_pad:
+        visible = mask.any(dim=-1, keepdim=True)
+    if _use_sdpa(mask, zero_pad, modifiers, q, k):
+        dropout_p = dropout.p if dropout.training else 0.
+        if visible is not None:
+            # the queries without visible keys attend to the first key instead of nothing (NaN), they are zeroed below
+            first = torch.zeros(1, k.size(2), dtype=torch.bool, device=q.device)
+            first[0, 0] = True
+            output = F.scaled_dot_product_attention(q, k, v, attn_mask=mask | (first & ~visible), dropout_p=dropout_p)
+        elif mask == 0:
+            # query i can see keys j < i, i.e. a causal attention of q[1:] over k[:-1], the first query is zero padded
+            output = torch.zeros_like(q[:, :, :1])
+            if seqlen > 1:
+                rest = F.scaled_dot_product_attention(q[:, :, 1:], k[:, :, :-1], v[:, :, :-1], dropout_p=dropout_p, is_causal=True)
+                output = torch.cat([output, rest], dim=2)
+            zero_pad = False
+        else:
+            output = F.scaled_dot_product_attention(q, k, v, dropout_p=dropout_p, is_causal=True)
+    else:
+        if isinstance(mask, int):
+            mask = causal_mask(seqlen, mask, q.device)
+        chunk_size = seqlen if chunk_size <= 0 else chunk_size
+        outputs = []
+        for start in range(0, seqlen, chunk_size):
+            end = min(start + chunk_size, seqlen)
+            cmask = mask[:, :, start:end]
+            scores = torch.matmul(q[:, :, start:end], k.transpose(-2, -1)) / math.sqrt(d_k)  # BS, 8, chunk, seqlen
+            for modifier in modifiers:
+                if modifier.stage == "score":
+                    scores = modifier(scores, cmask, start, end)
+            scores = scores.masked_fill(cmask == 0, -1e32)
+            scores = F.softmax(scores, dim=-1)
+            for modifier in modifiers:
+                if modifier.stage == "prob":
+                    scores = modifier(scores, cmask, start, end)
+            scores = dropout(scores)
+            outputs.append(torch.matmul(scores, v))
+        output = outputs[0] if len(outputs) == 1 else torch.cat(outputs, dim=2)
+    if visible is not None:
+        output = output.masked_fill(~visible, 0.)
+    elif zero_pad:
+        # 第一行score置0, 等价于第一个query的输出置0
+        output = torch.cat([torch.zeros_like(output[:, :, :1]), output[:, :, 1:]], dim=2)
+    if head_scale is not None:
+        output = output * head_scale.view(1, -1, 1, 1)
+    return output
+
+
+def prune_linear(layer, index, dim=0):
+    """a copy of a nn.Linear keeping only the output (dim=0) or input (dim=1) features in index
+
+    Args:
+        layer (nn.Linear): the layer
+        index (torch.tensor): indices of the features to keep
+        dim (int, optional): 0 prunes the output features, 1 the input features. Defaults to 0.
+
+    Returns:
+        nn.Linear: the smaller layer
+    """
+    index = index.to(layer.weight.device)
+    weight = layer.weight.index_select(dim, index).detach().clone()
+    has_bias = layer.bias is not None
+    new_layer = nn.Linear(weight.size(1), weight.size(0), bias=has_bias).to(layer.weight.device, layer.weight.dtype)
+    new_layer.weight.data.copy_(weight)
+    if has_bias:
+        new_layer.bias.data.copy_(layer.bias.detach()[index] if dim == 0 else layer.bias.detach())
+    return new_layer
+
+
+class LoRALinear(nn.Linear):
+    """a nn.Linear with a trainable low-rank adapter (LoRA), y = x W^T + b + scaling * dropout(x) A^T B^T.
+    The weight and bias keep their names, so a pretrained state dict loads as is, and B starts at zero, so the layer
+    starts as the pretrained one.
+
+    Args:
+        in_features (int): input features
+        out_features (int): output features
+        rank (int): rank of the adapter
+        alpha (float, optional): the adapter output is scaled by alpha / rank. Defaults to 16.
+        dropout (float, optional): dropout on the adapter input. Defaults to 0..
+        bias (bool, optional): Defaults to True.
+    """
+    def __init__(self, in_features, out_features, rank, alpha=16, dropout=0., bias=True):
+        super().__init__(in_features, out_features, bias=bias)
+        self.rank = rank
+        self.scaling = alpha / rank
+        self.lora_A = nn.Parameter(torch.empty(rank, in_features))
+        self.lora_B = nn.Parameter(torch.zeros(out_features, rank))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.lora_dropout = nn.Dropout(dropout)
+
+    @classmethod
+    def from_linear(cls, layer, rank, alpha=16, dropout=0.):
+        """a LoRALinear with the weights of a nn.Linear"""
+        new_layer = cls(layer.in_features, layer.out_features, rank, alpha, dropout, bias=layer.bias is not None)
+        new_layer = new_layer.to(layer.weight.device, layer.weight.dtype)
+        new_layer.weight.data.copy_(layer.weight.detach())
+        if layer.bias is not None:
+            new_layer.bias.data.copy_(layer.bias.detach())
+        return new_layer
+
+    def merge(self):
+        """a nn.Linear with the adapter folded into the weight, for inference"""
+        layer = nn.Linear(self.in_features, self.out_features, bias=self.bias is not None).to(self.weight.device, self.weight.dtype)
+        layer.weight.data.copy_(self.weight.detach() + self.scaling * (self.lora_B @ self.lora_A).detach())
+        if self.bias is not None:
+            layer.bias.data.copy_(self.bias.detach())
+        return layer
+
+    def forward(self, x):
+        return F.linear(x, self.weight, self.bias) + F.linear(F.linear(self.lora_dropout(x), self.lora_A), self.lora_B) * self.scaling
+
+
+class MultiHeadAttention(nn.Module):
+    def __init__(self, d_model, d_feature, n_heads, dropout, kq_same, bias=True, chunk_size=0):
+        super().__init__()
+        """
+        It has projection layer for getting keys, queries and values. Followed by attention and a connected layer.
+        The parameter names are the same as the per-model copies, so existing checkpoints can be loaded.
+        """
+        self.d_model = d_model
+        self.d_k = d_feature
+        self.h = n_heads
+        self.kq_same = kq_same
+        self.chunk_size = chunk_size
+
+        self.v_linear = nn.Linear(d_model, d_model, bias=bias)
+        self.k_linear = nn.Linear(d_model, d_model, bias=bias)
+        if kq_same is False:
+            self.q_linear = nn.Linear(d_model, d_model, bias=bias)
+        self.dropout = nn.Dropout(dropout)
+        self.proj_bias = bias
+        self.out_proj = nn.Linear(d_model, d_model, bias=bias)
+
+        self._reset_parameters()
+
+    def _reset_parameters(self):
+        xavier_uniform_(self.k_linear.weight)
+        xavier_uniform_(self.v_linear.weight)
+        if self.kq_same is False:
+            xavier_uniform_(self.q_linear.weight)
+
+        if self.proj_bias:
+            constant_(self.k_linear.bias, 0.)
+            constant_(self.v_linear.bias, 0.)
+            if self.kq_same is False:
+                constant_(self.q_linear.bias, 0.)
+            constant_(self.out_proj.bias, 0.)
+
+    def project(self, q, k, v):
+        """the q, k, v projections, fused into one matmul when the inputs are the same tensor (and the linears are not quantized)"""
+        if k is v and type(self.k_linear) is nn.Linear and type(self.v_linear) is nn.Linear:
+            weight = torch.cat([self.k_linear.weight, self.v_linear.weight], dim=0)
+            bias = torch.cat([self.k_linear.bias, self.v_linear.bias], dim=0) if self.proj_bias else None
+            k_proj, v_proj = F.linear(k, weight, bias).chunk(2, dim=-1)
+        else:
+            k_proj, v_proj = self.k_linear(k), self.v_linear(v)
+        if self.kq_same is False:
+            q_proj = self.q_linear(q)
+        else:
+            q_proj = k_proj if q is k else self.k_linear(q)
+        return q_proj, k_proj, v_proj
+
+    def prune_heads(self, heads):
+        """keep only the given heads, their rows of the q/k/v projections and columns of out_proj
+
+        Args:
+            heads (list[int]): indices of the heads to keep
+        """
+        index = torch.cat([torch.arange(h * self.d_k, (h + 1) * self.d_k) for h in heads])
+        self.k_linear = prune_linear(self.k_linear, index, dim=0)
+        self.v_linear = prune_linear(self.v_linear, index, dim=0)
+        if self.kq_same is False:
+            self.q_linear = prune_linear(self.q_linear, index, dim=0)
+        self.out_proj = prune_linear(self.out_proj, index, dim=1)
+        self.h = len(heads)
+
+    def forward(self, q, k, v, mask, zero_pad, modifiers=(), head_scale=None):
+        bs = q.size(0)
+        # perform linear operation and split into h heads, bs * h * sl * d_k
+        q, k, v = [x.reshape(bs, -1, self.h, self.d_k).transpose(1, 2) for x in self.project(q, k, v)]
+        scores = attention(q, k, v, self.d_k, mask, self.dropout, zero_pad,
+                           modifiers=modifiers, head_scale=head_scale, chunk_size=self.chunk_size)
+        # concatenate heads and put through final linear layer
+        concat = scores.transpose(1, 2).reshape(bs, -1, self.h * self.d_k)
+        output = self.out_proj(concat)
+        return output
+
+
+class TransformerLayer(nn.Module):
+    def __init__(self, d_model, d_feature,
+                 d_ff, n_heads, dropout,  kq_same, chunk_size=0):
+        super().__init__()
+        """
+            This is a Basic Block of Transformer paper. It containts one Multi-head attention object. Followed by layer norm and postion wise feedforward net and dropout layer.
+        """
+        kq_same = kq_same == 1
+        # Multi-Head Attention Block
+        self.masked_attn_head = MultiHeadAttention(
+            d_model, d_feature, n_heads, dropout, kq_same=kq_same, chunk_size=chunk_size)
+
+        # Two layer norm layer and two droput layer
+        self.layer_norm1 = nn.LayerNorm(d_model)
+        self.dropout1 = nn.Dropout(dropout)
+
+        self.linear1 = nn.Linear(d_model, d_ff)
+        self.activation = nn.ReLU()
+        self.dropout = nn.Dropout(dropout)
+        self.linear2 = nn.Linear(d_ff, d_model)
+
+        self.layer_norm2 = nn.LayerNorm(d_model)
+        self.dropout2 = nn.Dropout(dropout)
+        # original indices of the heads / linear1 neurons kept by prune, the soft masks are indexed with them
+        self.register_buffer("kept_heads", None, persistent=False)
+        self.register_buffer("kept_neurons", None, persistent=False)
+
+    def prune(self, heads, neurons):
+        """structured pruning, keep only the given attention heads and linear1/linear2 neurons
+
+        Args:
+            heads (list[int]): indices of the heads to keep
+            neurons (list[int]): indices of the d_ff neurons to keep
+        """
+        device = self.linear1.weight.device
+        self.masked_attn_head.prune_heads(heads)
+        index = torch.as_tensor(neurons, dtype=torch.long)
+        self.linear1 = prune_linear(self.linear1, index, dim=0)
+        self.linear2 = prune_linear(self.linear2, index, dim=1)
+        self.kept_heads = torch.as_tensor(heads, dtype=torch.long, device=device)
+        self.kept_neurons = index.to(device)
+
+    def add_lora(self, targets, rank, alpha=16, dropout=0.):
+        """replace linears of the block by LoRALinear, the soft masks still scale their outputs
+
+        Args:
+            targets (list[str]): k_linear, v_linear, q_linear, out_proj of the attention and linear1, linear2
+            rank (int): rank of the adapters
+            alpha (float, optional): the adapter outputs are scaled by alpha / rank. Defaults to 16.
+            dropout (float, optional): dropout on the adapter inputs. Defaults to 0..
+        """
+        for name in targets:
+            owner = self if name in ("linear1", "linear2") else self.masked_attn_head
+            # q_linear only exists when kq_same is False, the queries go through k_linear otherwise
+            if type(getattr(owner, name, None)) is nn.Linear:
+                setattr(owner, name, LoRALinear.from_linear(getattr(owner, name), rank, alpha, dropout))
+
+    def forward(self, mask, query, key, values, apply_pos=True, idx=None, soft_mask=None, modifiers=()):
+        """
+        Input:
+            mask : 0 means, it can peek only past values. 1 means, block can peek only current and pas values.
+                A bool mask (e.g. segment_mask of packed rows) is used as is, queries without visible keys output zeros
+            query : Query. In transformer paper it is the input for both encoder and decoder
+            key : Keys. In transformer paper it is the input for both encoder and decoder
+            Values. In transformer paper it is the input for encoder and  encoded output for decoder (in masked attention part)
+            idx, soft_mask : the layer index and the soft masks of LoReKT finetuning
+            modifiers : score modifiers of the attention, e.g. DistanceDecay
+
+        Output:
+            query: Input gets changed over the layer and returned.
+
+        """
+        if not soft_mask:
+            soft_mask = None
+        head_scale = None
+        if soft_mask is not None and soft_mask['attention'] != None:
+            head_scale = soft_mask['attention'][idx]
+            if self.kept_heads is not None:
+                head_scale = head_scale[self.kept_heads]
+        # If mask is 0, zero-padding is needed.
+        zero_pad = (mask == 0) if isinstance(mask, int) else True
+        query2 = self.masked_attn_head(
+            query, key, values, mask=mask, zero_pad=zero_pad, modifiers=modifiers, head_scale=head_scale)
+
+        query = query + self.dropout1((query2)) # 残差1
+        query = self.layer_norm1(query) # layer norm
+        if apply_pos:
+            hidden_1 = self.linear1(query)
+            if soft_mask is not None and soft_mask['input_projection'] != None:
+                inp_mask = soft_mask['input_projection'][idx]
+                if self.kept_neurons is not None:
+                    inp_mask = inp_mask[self.kept_neurons]
+                hidden_1 = hidden_1 * inp_mask #softmask
+            hidden_2 = self.linear2(self.dropout(self.activation(hidden_1)))
+            if soft_mask is not None and soft_mask['output_projection'] != None:
+                hidden_2 = hidden_2 * soft_mask['output_projection'][idx] #softmask
+            query = query + self.dropout2(hidden_2)
+            query = self.layer_norm2(query) # lay norm
+        return query
@@ -47,3 +47,39 @@ def get_clones(module, N):
 
 
 
+def gather_readout(y, idx):
+    """ Read the prediction of the target of each position, the same as (y * one_hot(idx, y.size(-1))).sum(-1)
+    without materializing the [batch, seqlen, num_class] one-hot tensor
+    """
+    return torch.gather(y, -1, idx.long().unsqueeze(-1)).squeeze(-1)
+
+def linear_readout(layer, x, idx):
+    """ Compute layer(x)[..., idx] of a nn.Linear only for the target of each position
+    """
+    idx = idx.long()
+    y = (x * layer.weight[idx]).sum(-1)
+    if layer.bias is not None:
+        y = y + layer.bias[idx]
+    return y
+
+def pooled_concept_emb(weight, c, pad_val=-1, sparse=False):
+    """ Average the embeddings of the concepts of each question with a fused embedding bag, the same as
+    concatenating a zero row onto the table, gathering [..., max_concepts, emb_size] and dividing the sum
+    by the number of concepts, without copying the table or building the gathered tensor
+
+    Args:
+        weight (torch.tensor): [num_concepts, emb_size] concept table, row k is concept k
+        c (torch.tensor): [..., max_concepts] concept ids padded with pad_val
+        pad_val (int, optional): pad value of c. Defaults to -1.
+        sparse (bool, optional): return a sparse gradient for weight. Defaults to False.
+
+    Returns:
+        torch.tensor: [..., emb_size], zeros for positions without concepts
+    """
+    c = c.long()
+    valid = c != pad_val
+    concept_num = valid.sum(-1, keepdim=True).clamp(min=1)
+    per_sample_weights = (valid / concept_num).to(weight.dtype).reshape(-1, c.size(-1))
+    idx = torch.where(valid, c, torch.zeros_like(c)).reshape(-1, c.size(-1))
+    concept_avg = F.embedding_bag(idx, weight, per_sample_weights=per_sample_weights, mode="sum", sparse=sparse)
+    return concept_avg.reshape(*c.shape[:-1], weight.size(-1))